@@ -0,0 +1,19 @@
+#!/bin/bash
+
+
+export PROJECT_ROOT_PATH="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+cd $PROJECT_ROOT_PATH
+
+
+echo "Prepared statements against plain SQL text"
+python3 src/bench_queries.py
+echo "Precompiled BRL formatter against babel"
+python3 src/bench_formatting.py
+echo "CRUD methods and request handlers over a fake database"
+python3 src/bench_services.py
+echo "Synchronous against queued and sampled logging"
+python3 src/bench_logging.py
+echo "WSGI (gunicorn) against ASGI (uvicorn) under high concurrency"
+python3 src/bench_serving.py
+echo "End-to-end load of the six endpoints under gunicorn"
+python3 src/bench_load.py
@@ -0,0 +1,37 @@
+"""Gunicorn settings, read from the project root by "main-app.sh".
+
+The workers keep their metrics in files under PROMETHEUS_MULTIPROC_DIR, so
+that "/metrics", whichever worker answers it, reports those of all of them.
+The variable must be set before prometheus_client is imported, hence here.
+"""
+
+
+import os
+import shutil
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/titulo_tesouro_metrics_{}'.format(os.getpid()))
+
+import prometheus_client.multiprocess
+
+
+# An event stream ("/titulo_tesouro/eventos") holds its connection for up to
+# EVENT_STREAM_MAX_DURATION seconds, which would hold a whole sync worker, so
+# the workers serve requests from threads. What a worker keeps across requests
+# (connection pool, response cache, series engine) is thread-safe. The pool
+# should have at least as many connections as threads.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+
+def on_starting(server):
+    # Files left by a previous run would be summed with the new ones.
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def child_exit(server, worker):
+    prometheus_client.multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+export PROJECT_ROOT_PATH="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+cd $PROJECT_ROOT_PATH
+
+# Workers share their metrics through this directory, see "gunicorn.conf.py".
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/titulo_tesouro_metrics_asgi}"
+rm -rf $PROMETHEUS_MULTIPROC_DIR && mkdir -p $PROMETHEUS_MULTIPROC_DIR
+
+python3 src/asgi.py --workers ${ASGI_WORKERS:-$(nproc)}
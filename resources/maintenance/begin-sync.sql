@@ -0,0 +1,10 @@
+SELECT pg_advisory_xact_lock(hashtext('tesouro_direto_sync'));
+
+CREATE TEMPORARY TABLE tesouro_direto_staging (
+    category        category_type                   NOT NULL,
+    action          action_type                     NOT NULL,
+    expire_at       TIMESTAMP WITHOUT TIME ZONE     NOT NULL,
+    amount          DECIMAL                         NOT NULL,
+
+    PRIMARY KEY (category, action, expire_at)
+) ON COMMIT DROP;
\ No newline at end of file
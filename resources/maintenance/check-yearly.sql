@@ -0,0 +1,36 @@
+SELECT
+    coalesce(Y.category, R.category) AS category,
+    coalesce(Y.action, R.action) AS action,
+    coalesce(Y.year, R.year) AS year,
+    Y.amount AS stored_amount,
+    R.amount AS expected_amount,
+    Y.count AS stored_count,
+    R.count AS expected_count
+FROM
+    tesouro_direto_yearly Y
+FULL OUTER JOIN
+    (
+        SELECT
+            category,
+            action,
+            year,
+            sum(amount) AS amount,
+            count(*) AS count
+        FROM
+            tesouro_direto_series
+        GROUP BY
+            category,
+            action,
+            year
+    ) R
+ON
+    Y.category = R.category
+    AND Y.action = R.action
+    AND Y.year = R.year
+WHERE
+    Y.amount IS DISTINCT FROM R.amount
+    OR Y.count IS DISTINCT FROM R.count
+ORDER BY
+    category,
+    action,
+    year;
\ No newline at end of file
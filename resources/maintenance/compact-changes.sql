@@ -0,0 +1,27 @@
+-- Entries older than the retention that a later entry makes useless: one of
+-- the same row, or a truncate. The last entry of each row, and the last
+-- truncate, are kept, so a client reading from an old watermark still ends
+-- with the current state of every row.
+DELETE FROM tesouro_direto_changes C
+WHERE
+    C.seq IS NOT NULL
+    AND C.changed_at < now() - %(retention_hours)s * INTERVAL '1 hour'
+    AND (
+        EXISTS (
+            SELECT
+                1
+            FROM
+                tesouro_direto_changes L
+            WHERE
+                L.id = C.id
+                AND L.seq > C.seq
+        )
+        OR C.seq < (
+            SELECT
+                max(seq)
+            FROM
+                tesouro_direto_changes
+            WHERE
+                op = 'truncate'
+        )
+    );
\ No newline at end of file
@@ -0,0 +1 @@
+SELECT source, loaded_at FROM tesouro_direto_loads WHERE fingerprint = %s;
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- Whether "create-all.sql" already ran: the last table it creates exists.
+SELECT to_regclass('tesouro_direto_changes') IS NOT NULL;
\ No newline at end of file
@@ -0,0 +1,17 @@
+LOCK TABLE tesouro_direto_series IN SHARE MODE;
+
+DELETE FROM tesouro_direto_yearly;
+
+INSERT INTO tesouro_direto_yearly (category, action, year, amount, count)
+SELECT
+    category,
+    action,
+    year,
+    sum(amount),
+    count(*)
+FROM
+    tesouro_direto_series
+GROUP BY
+    category,
+    action,
+    year;
\ No newline at end of file
@@ -0,0 +1,9 @@
+INSERT INTO tesouro_direto_loads (fingerprint, source, inserted, updated, deleted)
+VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (fingerprint) DO UPDATE
+SET
+    source = EXCLUDED.source,
+    loaded_at = now(),
+    inserted = EXCLUDED.inserted,
+    updated = EXCLUDED.updated,
+    deleted = EXCLUDED.deleted;
\ No newline at end of file
@@ -0,0 +1,34 @@
+-- Rows the workbook no longer has, only between the first and last month it
+-- has of each series: a workbook of some years leaves the other years, and
+-- the rows created through the API outside of its months, alone.
+DELETE FROM tesouro_direto_series T
+USING
+    (
+        SELECT
+            category,
+            action,
+            min(expire_at) AS first_expire_at,
+            max(expire_at) AS last_expire_at
+        FROM
+            tesouro_direto_staging
+        GROUP BY
+            category,
+            action
+    ) R
+WHERE
+    T.category = R.category
+    AND T.action = R.action
+    AND T.expire_at >= R.first_expire_at
+    AND T.expire_at <= R.last_expire_at
+    AND NOT EXISTS (
+        SELECT
+            1
+        FROM
+            tesouro_direto_staging S
+        WHERE
+            S.category = T.category
+            AND S.action = T.action
+            AND S.expire_at = T.expire_at
+    )
+RETURNING
+    T.id;
\ No newline at end of file
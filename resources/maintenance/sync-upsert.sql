@@ -0,0 +1,23 @@
+-- Only new or changed rows reach the INSERT, so unchanged rows neither
+-- consume ids from the sequence nor fire the triggers.
+INSERT INTO tesouro_direto_series (category, action, expire_at, amount)
+SELECT
+    S.category,
+    S.action,
+    S.expire_at,
+    S.amount
+FROM
+    tesouro_direto_staging S
+LEFT JOIN
+    tesouro_direto_series T
+ON
+    T.category = S.category
+    AND T.action = S.action
+    AND T.expire_at = S.expire_at
+WHERE
+    T.amount IS DISTINCT FROM S.amount
+ON CONFLICT (category, action, expire_at) DO UPDATE
+SET
+    amount = EXCLUDED.amount
+RETURNING
+    (xmax = 0) AS inserted;
\ No newline at end of file
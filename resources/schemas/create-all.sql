@@ -22,6 +22,13 @@ BEGIN
 END$$;
 
 
+-- Months since year 0, as in "comparison.month_key", so that consecutive
+-- months have consecutive keys: the year is key / 12 and the month key % 12 + 1.
+CREATE OR REPLACE FUNCTION tesouro_direto_month_key(expire_at TIMESTAMP WITHOUT TIME ZONE) RETURNS INTEGER AS $$
+    SELECT (extract(year FROM expire_at) * 12 + extract(month FROM expire_at) - 1)::INTEGER;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+
+
 CREATE TABLE IF NOT EXISTS tesouro_direto_series (
     id              SERIAL                          NOT NULL,
     category        category_type                   NOT NULL,
@@ -33,5 +40,322 @@ CREATE TABLE IF NOT EXISTS tesouro_direto_series (
     UNIQUE (category, action, expire_at)
 );
 
+-- The series are monthly, so the reads group, filter and order by these
+-- integers instead of formatting "expire_at". Added apart from the CREATE
+-- TABLE so that the tables of existing databases get them too.
+ALTER TABLE tesouro_direto_series
+    ADD COLUMN IF NOT EXISTS month_key INTEGER GENERATED ALWAYS AS (tesouro_direto_month_key(expire_at)) STORED,
+    ADD COLUMN IF NOT EXISTS year SMALLINT GENERATED ALWAYS AS (extract(year FROM expire_at)::SMALLINT) STORED;
+
+-- The history reads both actions of a category month by month, the values by
+-- action (and the comparison) one action: index only scans of these give the
+-- rows already in the order of the GROUP BY, or ORDER BY.
+DROP INDEX IF EXISTS tesouro_direto_series_history;
+CREATE INDEX IF NOT EXISTS tesouro_direto_series_month
+    ON tesouro_direto_series (category, month_key, action) INCLUDE (amount);
+CREATE INDEX IF NOT EXISTS tesouro_direto_series_action_month
+    ON tesouro_direto_series (category, action, month_key) INCLUDE (amount);
+
+
+CREATE TABLE IF NOT EXISTS tesouro_direto_loads (
+    fingerprint     TEXT                            NOT NULL,
+    source          TEXT                            NOT NULL,
+    loaded_at       TIMESTAMP WITHOUT TIME ZONE     NOT NULL DEFAULT now(),
+    inserted        INTEGER                         NOT NULL,
+    updated         INTEGER                         NOT NULL,
+    deleted         INTEGER                         NOT NULL,
+
+    PRIMARY KEY (fingerprint)
+);
+
+
+CREATE TABLE IF NOT EXISTS tesouro_direto_yearly (
+    category        category_type                   NOT NULL,
+    action          action_type                     NOT NULL,
+    year            SMALLINT                        NOT NULL,
+    amount          DECIMAL                         NOT NULL,
+    count           INTEGER                         NOT NULL,
+
+    PRIMARY KEY (category, action, year)
+);
+
+
+CREATE OR REPLACE FUNCTION tesouro_direto_yearly_maintain() RETURNS TRIGGER AS $$
+DECLARE
+    remaining INTEGER;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE tesouro_direto_yearly
+        SET
+            amount = amount - OLD.amount,
+            count = count - 1
+        WHERE
+            category = OLD.category
+            AND action = OLD.action
+            AND year = OLD.year
+        RETURNING count INTO remaining;
+
+        IF remaining = 0 THEN
+            DELETE FROM tesouro_direto_yearly
+            WHERE
+                category = OLD.category
+                AND action = OLD.action
+                AND year = OLD.year;
+        END IF;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO tesouro_direto_yearly (category, action, year, amount, count)
+        VALUES (NEW.category, NEW.action, NEW.year, NEW.amount, 1)
+        ON CONFLICT (category, action, year) DO UPDATE
+        SET
+            amount = tesouro_direto_yearly.amount + EXCLUDED.amount,
+            count = tesouro_direto_yearly.count + 1;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION tesouro_direto_yearly_truncate() RETURNS TRIGGER AS $$
+BEGIN
+    TRUNCATE tesouro_direto_yearly;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS tesouro_direto_yearly_maintain ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_yearly_maintain
+    AFTER INSERT OR UPDATE OR DELETE ON tesouro_direto_series
+    FOR EACH ROW EXECUTE PROCEDURE tesouro_direto_yearly_maintain();
+
+DROP TRIGGER IF EXISTS tesouro_direto_yearly_truncate ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_yearly_truncate
+    AFTER TRUNCATE ON tesouro_direto_series
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_yearly_truncate();
+
+
+-- Data version of each category, bumped by every write to its rows. Versions
+-- come from a single sequence, so they are unique across categories and the
+-- greatest version of a set of categories changes whenever any of them does.
+-- The sequence starts at the creation time, in microseconds, so versions keep
+-- growing when the database is dropped and created again.
+CREATE SEQUENCE IF NOT EXISTS tesouro_direto_version_seq;
+
+SELECT setval('tesouro_direto_version_seq',
+              GREATEST(last_value, (extract(epoch FROM clock_timestamp()) * 1000000)::BIGINT))
+FROM tesouro_direto_version_seq;
+
+
+CREATE TABLE IF NOT EXISTS tesouro_direto_versions (
+    category        category_type                   NOT NULL,
+    version         BIGINT                          NOT NULL DEFAULT nextval('tesouro_direto_version_seq'),
+    updated_at      TIMESTAMP WITH TIME ZONE        NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (category)
+);
+
+INSERT INTO tesouro_direto_versions (category)
+SELECT unnest(enum_range(NULL::category_type))
+ON CONFLICT (category) DO NOTHING;
+
+
+-- Statement level, so a COPY or a bulk UPDATE bumps each category once.
+CREATE OR REPLACE FUNCTION tesouro_direto_versions_bump() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE tesouro_direto_versions
+        SET
+            version = nextval('tesouro_direto_version_seq'),
+            updated_at = now();
+    ELSIF TG_OP = 'INSERT' THEN
+        UPDATE tesouro_direto_versions
+        SET
+            version = nextval('tesouro_direto_version_seq'),
+            updated_at = now()
+        WHERE
+            category IN (SELECT category FROM new_rows);
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE tesouro_direto_versions
+        SET
+            version = nextval('tesouro_direto_version_seq'),
+            updated_at = now()
+        WHERE
+            category IN (SELECT category FROM old_rows UNION SELECT category FROM new_rows);
+    ELSE
+        UPDATE tesouro_direto_versions
+        SET
+            version = nextval('tesouro_direto_version_seq'),
+            updated_at = now()
+        WHERE
+            category IN (SELECT category FROM old_rows);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS tesouro_direto_versions_insert ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_versions_insert
+    AFTER INSERT ON tesouro_direto_series
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_versions_bump();
+
+DROP TRIGGER IF EXISTS tesouro_direto_versions_update ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_versions_update
+    AFTER UPDATE ON tesouro_direto_series
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_versions_bump();
+
+DROP TRIGGER IF EXISTS tesouro_direto_versions_delete ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_versions_delete
+    AFTER DELETE ON tesouro_direto_series
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_versions_bump();
+
+DROP TRIGGER IF EXISTS tesouro_direto_versions_truncate ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_versions_truncate
+    AFTER TRUNCATE ON tesouro_direto_series
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_versions_bump();
+
+
+-- Every change to the rows is sent on channel "tesouro_direto_changes" to the
+-- workers LISTENing on it (see "src/notifications.py"). Statement level, with
+-- one notification per (op, category, action) and the number of rows, so that
+-- a bulk write or a COPY does not send one per row. Notifications are only
+-- delivered once their transaction commits.
+CREATE OR REPLACE FUNCTION tesouro_direto_notify() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('tesouro_direto_changes', json_build_object('op', TG_OP)::text);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('tesouro_direto_changes', json_build_object(
+            'op', TG_OP, 'category', category, 'action', action, 'count', count(*))::text)
+        FROM old_rows
+        GROUP BY category, action
+        ORDER BY category, action;
+    ELSE
+        PERFORM pg_notify('tesouro_direto_changes', json_build_object(
+            'op', TG_OP, 'category', category, 'action', action, 'count', count(*))::text)
+        FROM new_rows
+        GROUP BY category, action
+        ORDER BY category, action;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- The row level trigger of previous schemas.
+DROP TRIGGER IF EXISTS tesouro_direto_notify ON tesouro_direto_series;
+
+DROP TRIGGER IF EXISTS tesouro_direto_notify_insert ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_notify_insert
+    AFTER INSERT ON tesouro_direto_series
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_notify();
+
+DROP TRIGGER IF EXISTS tesouro_direto_notify_update ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_notify_update
+    AFTER UPDATE ON tesouro_direto_series
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_notify();
+
+DROP TRIGGER IF EXISTS tesouro_direto_notify_delete ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_notify_delete
+    AFTER DELETE ON tesouro_direto_series
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_notify();
+
+DROP TRIGGER IF EXISTS tesouro_direto_notify_truncate ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_notify_truncate
+    AFTER TRUNCATE ON tesouro_direto_series
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_notify();
+
+
+-- Append-only log of the changes to the rows, read by "GET
+-- /titulo_tesouro/changes". Entries get their "seq" only once the transaction
+-- that wrote them is over ("sequence-changes.sql"), one reader at a time, so
+-- that an entry never gets a smaller "seq" than one already read. As for the
+-- versions, the sequence starts at the creation time, in microseconds, so
+-- watermarks keep growing when the database is dropped and created again.
+CREATE SEQUENCE IF NOT EXISTS tesouro_direto_change_seq;
+
+SELECT setval('tesouro_direto_change_seq',
+              GREATEST(last_value, (extract(epoch FROM clock_timestamp()) * 1000000)::BIGINT))
+FROM tesouro_direto_change_seq;
+
+
+CREATE TABLE IF NOT EXISTS tesouro_direto_changes (
+    entry           BIGSERIAL                       NOT NULL,
+    seq             BIGINT,
+    txid            BIGINT                          NOT NULL DEFAULT txid_current(),
+    op              TEXT                            NOT NULL,
+    id              INTEGER,
+    category        category_type,
+    action          action_type,
+    expire_at       TIMESTAMP WITHOUT TIME ZONE,
+    amount          DECIMAL,
+    changed_at      TIMESTAMP WITH TIME ZONE        NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (entry)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS tesouro_direto_changes_seq ON tesouro_direto_changes (seq);
+CREATE INDEX IF NOT EXISTS tesouro_direto_changes_unsequenced ON tesouro_direto_changes (entry) WHERE seq IS NULL;
+CREATE INDEX IF NOT EXISTS tesouro_direto_changes_id ON tesouro_direto_changes (id, seq);
+
+-- A new log starts with a truncate, so that clients with a watermark of a
+-- previous database start over.
+INSERT INTO tesouro_direto_changes (op)
+SELECT 'truncate'
+WHERE NOT EXISTS (SELECT 1 FROM tesouro_direto_changes);
+
+
+-- Statement level, so a COPY appends its rows in a single INSERT.
+CREATE OR REPLACE FUNCTION tesouro_direto_changes_append() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO tesouro_direto_changes (op) VALUES ('truncate');
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO tesouro_direto_changes (op, id, category, action, expire_at)
+        SELECT 'delete', id, category, action, expire_at FROM old_rows ORDER BY id;
+    ELSE
+        INSERT INTO tesouro_direto_changes (op, id, category, action, expire_at, amount)
+        SELECT lower(TG_OP), id, category, action, expire_at, amount FROM new_rows ORDER BY id;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS tesouro_direto_changes_insert ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_changes_insert
+    AFTER INSERT ON tesouro_direto_series
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_changes_append();
+
+DROP TRIGGER IF EXISTS tesouro_direto_changes_update ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_changes_update
+    AFTER UPDATE ON tesouro_direto_series
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_changes_append();
+
+DROP TRIGGER IF EXISTS tesouro_direto_changes_delete ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_changes_delete
+    AFTER DELETE ON tesouro_direto_series
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_changes_append();
+
+DROP TRIGGER IF EXISTS tesouro_direto_changes_truncate ON tesouro_direto_series;
+CREATE TRIGGER tesouro_direto_changes_truncate
+    AFTER TRUNCATE ON tesouro_direto_series
+    FOR EACH STATEMENT EXECUTE PROCEDURE tesouro_direto_changes_append();
+
 
 COMMIT;
\ No newline at end of file
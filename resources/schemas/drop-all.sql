@@ -1,7 +1,19 @@
 BEGIN;
 
 
+DROP TABLE IF EXISTS tesouro_direto_yearly;
+DROP TABLE IF EXISTS tesouro_direto_loads;
+DROP TABLE IF EXISTS tesouro_direto_versions;
+DROP TABLE IF EXISTS tesouro_direto_changes;
 DROP TABLE IF EXISTS tesouro_direto_series;
+DROP SEQUENCE IF EXISTS tesouro_direto_version_seq;
+DROP SEQUENCE IF EXISTS tesouro_direto_change_seq;
+DROP FUNCTION IF EXISTS tesouro_direto_yearly_maintain();
+DROP FUNCTION IF EXISTS tesouro_direto_yearly_truncate();
+DROP FUNCTION IF EXISTS tesouro_direto_versions_bump();
+DROP FUNCTION IF EXISTS tesouro_direto_notify();
+DROP FUNCTION IF EXISTS tesouro_direto_changes_append();
+DROP FUNCTION IF EXISTS tesouro_direto_month_key(TIMESTAMP WITHOUT TIME ZONE);
 
 DO $$
 BEGIN
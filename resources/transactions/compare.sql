@@ -1,13 +1,18 @@
 SELECT
-    to_char(expire_at, 'YYYY') AS year,
-    to_char(expire_at, 'MM') AS month,
-    id,
-    category,
-    action,
-    amount
+    selected.position - 1 AS column_index,
+    series.month_key,
+    series.amount::double precision AS amount
 FROM
-    tesouro_direto_series
+    unnest($3::bigint[]) WITH ORDINALITY AS selected(id, position)
+JOIN
+    tesouro_direto_series chosen
+ON
+    chosen.id = selected.id
+JOIN
+    tesouro_direto_series series
+ON
+    series.category = chosen.category
+    AND series.action = chosen.action
 WHERE
-    expire_at >= '{}'
-    AND expire_at <= '{}'
-    AND id IN ({});
\ No newline at end of file
+    series.month_key >= tesouro_direto_month_key($1)
+    AND series.month_key <= tesouro_direto_month_key($2);
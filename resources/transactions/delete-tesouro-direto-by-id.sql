@@ -0,0 +1,7 @@
+DELETE FROM
+    tesouro_direto_series
+WHERE
+    id = ANY($1::bigint[])
+RETURNING
+    id,
+    category;
@@ -1,7 +1 @@
-BEGIN;
-
-
-DELETE FROM tesouro_direto_series WHERE id = {};
-
-
-COMMIT;
\ No newline at end of file
+DELETE FROM tesouro_direto_series WHERE id = $1::bigint RETURNING category;
\ No newline at end of file
@@ -1 +0,0 @@
-SELECT category, id FROM tesouro_direto_series WHERE id IN ({});
\ No newline at end of file
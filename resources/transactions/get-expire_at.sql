@@ -1 +1 @@
-SELECT to_char(expire_at, 'YYYY'), to_char(expire_at, 'MM') FROM tesouro_direto_series WHERE id = {};
\ No newline at end of file
+SELECT year, month_key % 12 + 1, category FROM tesouro_direto_series WHERE id = $1::bigint;
\ No newline at end of file
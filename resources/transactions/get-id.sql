@@ -1 +0,0 @@
-SELECT id FROM tesouro_direto_series WHERE category = '{}' AND action = '{}' AND expire_at = '{}';
\ No newline at end of file
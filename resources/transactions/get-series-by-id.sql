@@ -0,0 +1 @@
+SELECT id, category, action FROM tesouro_direto_series WHERE id = ANY($1::bigint[]);
@@ -0,0 +1,14 @@
+SELECT
+    max(version),
+    max(updated_at)
+FROM
+    tesouro_direto_versions
+WHERE
+    category IN (
+        SELECT
+            category
+        FROM
+            tesouro_direto_series
+        WHERE
+            id = ANY($1::bigint[])
+    );
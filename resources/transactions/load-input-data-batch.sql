@@ -0,0 +1,14 @@
+INSERT INTO tesouro_direto_series (category, action, expire_at, amount)
+SELECT
+    category::category_type,
+    action::action_type,
+    expire_at,
+    amount
+FROM
+    unnest($1::text[], $2::text[], $3::timestamp[], $4::numeric[]) AS input (category, action, expire_at, amount)
+ON CONFLICT (category, action, expire_at) DO NOTHING
+RETURNING
+    id,
+    category,
+    action,
+    expire_at;
\ No newline at end of file
@@ -1,9 +1,5 @@
-BEGIN;
-
-
 INSERT INTO tesouro_direto_series (category, action, expire_at, amount)
 VALUES
-    {};
-
-
-COMMIT;
\ No newline at end of file
+    ($1::text::category_type, $2::text::action_type, $3, $4)
+RETURNING
+    id;
\ No newline at end of file
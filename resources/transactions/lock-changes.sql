@@ -0,0 +1 @@
+SELECT pg_try_advisory_xact_lock(hashtext('tesouro_direto_changes'));
\ No newline at end of file
@@ -1,14 +1,44 @@
+WITH bounds AS (
+    -- Years entirely inside the interval are read from the yearly totals, the
+    -- months of the partial years at its ends from the raw series.
+    SELECT
+        (tesouro_direto_month_key($3) + 11) / 12 AS first_year,
+        (tesouro_direto_month_key($4) + 1) / 12 - 1 AS last_year
+)
 SELECT
-    to_char(expire_at, 'YYYY') AS year,
+    year,
     sum(amount)
 FROM
-    tesouro_direto_series
-WHERE
-    action = '{}'
-    AND category = '{}'
-    AND expire_at >= '{}'
-    AND expire_at <= '{}'
+(
+    SELECT
+        year,
+        amount
+    FROM
+        tesouro_direto_yearly,
+        bounds
+    WHERE
+        action = $1::text::action_type
+        AND category = $2::text::category_type
+        AND year >= first_year
+        AND year <= last_year
+    UNION ALL
+    SELECT
+        year,
+        amount
+    FROM
+        tesouro_direto_series,
+        bounds
+    WHERE
+        action = $1::text::action_type
+        AND category = $2::text::category_type
+        AND month_key >= tesouro_direto_month_key($3)
+        AND month_key <= tesouro_direto_month_key($4)
+        AND (month_key < first_year * 12
+             OR month_key >= (last_year + 1) * 12)
+) A
 GROUP BY
     year
 ORDER BY
-    year;
\ No newline at end of file
+    year
+LIMIT
+    $5;
\ No newline at end of file
@@ -1,14 +1,15 @@
 SELECT
-    to_char(expire_at, 'YYYY') AS year,
-    to_char(expire_at, 'MM') AS month,
+    month_key / 12 AS year,
+    month_key % 12 + 1 AS month,
     amount
 FROM
     tesouro_direto_series
 WHERE
-    action = '{}'
-    AND category = '{}'
-    AND expire_at >= '{}'
-    AND expire_at <= '{}'
+    action = $1::text::action_type
+    AND category = $2::text::category_type
+    AND month_key >= tesouro_direto_month_key($3)
+    AND month_key <= tesouro_direto_month_key($4)
 ORDER BY
-    year,
-    month;
\ No newline at end of file
+    month_key
+LIMIT
+    $5;
\ No newline at end of file
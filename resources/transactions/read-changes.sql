@@ -0,0 +1,17 @@
+SELECT
+    seq,
+    op,
+    id,
+    category::text,
+    lower(action::text),
+    extract(month FROM expire_at)::integer,
+    extract(year FROM expire_at)::integer,
+    amount::float8
+FROM
+    tesouro_direto_changes
+WHERE
+    seq > $1
+ORDER BY
+    seq
+LIMIT
+    $2;
\ No newline at end of file
@@ -1,40 +1,45 @@
-SELECT
-    A.year,
-    A.valor_venda,
-    B.valor_resgate
-FROM
-(
+WITH bounds AS (
+    -- Years entirely inside the interval are read from the yearly totals, the
+    -- months of the partial years at its ends from the raw series. Read
+    -- through subqueries, evaluated once, rather than joined to the tables.
+    SELECT
+        (tesouro_direto_month_key($2) + 11) / 12 AS first_year,
+        (tesouro_direto_month_key($3) + 1) / 12 - 1 AS last_year
+),
+totals AS (
+    SELECT
+        action,
+        year,
+        amount
+    FROM
+        tesouro_direto_yearly
+    WHERE
+        category = $1::text::category_type
+        AND year >= (SELECT first_year FROM bounds)
+        AND year <= (SELECT last_year FROM bounds)
+    UNION ALL
     SELECT
-        to_char(expire_at, 'YYYY') AS year,
-        sum(amount) AS valor_venda
+        action,
+        year,
+        amount
     FROM
         tesouro_direto_series
     WHERE
-        category = '{0}'
-        AND expire_at >= '{1}'
-        AND expire_at <= '{2}'
-        AND action = 'VENDA'
-    GROUP BY
-        year
-    ORDER BY
-        year
-) A
-JOIN
-    (
-        SELECT
-            to_char(expire_at, 'YYYY') AS year,
-            sum(amount) AS valor_resgate
-        FROM
-            tesouro_direto_series
-        WHERE
-            category = '{0}'
-            AND expire_at >= '{1}'
-            AND expire_at <= '{2}'
-            AND action = 'RESGATE'
-        GROUP BY
-            year
-        ORDER BY
-            year
-    ) B
-ON
-    A.year = B.year;
\ No newline at end of file
+        category = $1::text::category_type
+        AND month_key >= tesouro_direto_month_key($2)
+        AND month_key <= tesouro_direto_month_key($3)
+        AND (month_key < (SELECT first_year * 12 FROM bounds)
+             OR month_key >= (SELECT (last_year + 1) * 12 FROM bounds))
+)
+SELECT
+    year,
+    sum(amount) FILTER (WHERE action = 'VENDA') AS valor_venda,
+    sum(amount) FILTER (WHERE action = 'RESGATE') AS valor_resgate
+FROM
+    totals
+GROUP BY
+    year
+ORDER BY
+    year
+LIMIT
+    $4;
\ No newline at end of file
@@ -1,30 +1,17 @@
 SELECT
-    to_char(A.expire_at, 'MM') AS month,
-    to_char(A.expire_at, 'YYYY') AS year,
-    A.amount AS valor_venda,
-    B.amount AS valor_resgate
+    month_key % 12 + 1 AS month,
+    month_key / 12 AS year,
+    sum(amount) FILTER (WHERE action = 'VENDA') AS valor_venda,
+    sum(amount) FILTER (WHERE action = 'RESGATE') AS valor_resgate
 FROM
-    tesouro_direto_series A
-JOIN
-    (
-        SELECT
-            amount,
-            category,
-            action,
-            expire_at
-        FROM
-            tesouro_direto_series
-        WHERE
-            action = 'RESGATE'
-    ) B
-ON
-    A.category = B.category
-    AND A.expire_at = B.expire_at
+    tesouro_direto_series
 WHERE
-    A.category = '{}'
-    AND A.expire_at >= '{}'
-    AND A.expire_at <= '{}'
-    AND A.action = 'VENDA'
+    category = $1::text::category_type
+    AND month_key >= tesouro_direto_month_key($2)
+    AND month_key <= tesouro_direto_month_key($3)
+GROUP BY
+    month_key
 ORDER BY
-    year,
-    month;
\ No newline at end of file
+    month_key
+LIMIT
+    $4;
\ No newline at end of file
@@ -0,0 +1 @@
+SELECT id, category, action, expire_at, amount FROM tesouro_direto_series;
\ No newline at end of file
@@ -0,0 +1,23 @@
+-- Entries of transactions older than every one still running are final: they
+-- are committed, or gone if their transaction rolled back.
+UPDATE tesouro_direto_changes C
+SET
+    seq = S.seq
+FROM (
+    SELECT
+        entry,
+        nextval('tesouro_direto_change_seq') AS seq
+    FROM (
+        SELECT
+            entry
+        FROM
+            tesouro_direto_changes
+        WHERE
+            seq IS NULL
+            AND txid < txid_snapshot_xmin(txid_current_snapshot())
+        ORDER BY
+            entry
+    ) U
+) S
+WHERE
+    C.entry = S.entry;
\ No newline at end of file
@@ -0,0 +1,15 @@
+UPDATE tesouro_direto_series
+SET
+    action = COALESCE($5::text::action_type, action),
+    amount = COALESCE($6, amount)
+WHERE
+    ($1::text IS NULL OR category = $1::text::category_type)
+    AND ($2::text IS NULL OR action = $2::text::action_type)
+    AND ($3::timestamp IS NULL OR expire_at >= $3::timestamp)
+    AND ($4::timestamp IS NULL OR expire_at <= $4::timestamp)
+RETURNING
+    id,
+    action,
+    amount,
+    expire_at,
+    category;
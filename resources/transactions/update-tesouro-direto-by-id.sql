@@ -0,0 +1,12 @@
+UPDATE tesouro_direto_series
+SET
+    action = COALESCE($2::text::action_type, action),
+    amount = COALESCE($3, amount)
+WHERE
+    id = ANY($1::bigint[])
+RETURNING
+    id,
+    action,
+    amount,
+    expire_at,
+    category;
@@ -1,7 +1,7 @@
-BEGIN;
-
-
-UPDATE tesouro_direto_series SET {} WHERE id = {};
-
-
-COMMIT;
\ No newline at end of file
+UPDATE tesouro_direto_series
+SET
+    action = COALESCE($2::text::action_type, action),
+    amount = COALESCE($3, amount),
+    expire_at = $4
+WHERE
+    id = $1::bigint;
\ No newline at end of file
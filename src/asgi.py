@@ -0,0 +1,141 @@
+"""Builds all objects and inject dependencies of the ASGI app, the asyncio
+alternative to "main.py": same endpoints and responses, served by uvicorn,
+with coroutine handlers over an asyncpg pool. Each worker keeps serving other
+requests while it waits on the database.
+
+    python3 src/asgi.py [--host HOST] [--port PORT] [--workers N]
+"""
+
+
+import argparse
+import asyncpg
+import falcon.asgi
+import logging
+import multiprocessing
+import os
+import prometheus_client.multiprocess
+import signal
+import socket
+import sys
+import uvicorn
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+from src.async_endpoints import AsyncEndpointExpositor
+from src.async_notifications import AsyncChangeListener
+from src.async_services import AsyncTituloTesouroCRUD
+from src.basics import DATABASE_PARAMS, DATABASE_POOL_MIN_SIZE, DATABASE_POOL_MAX_SIZE
+from src.basics import SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_EXPLAIN_RATE, SLOW_QUERY_LOG_SIZE
+from src.basics import LOG_QUEUE_SIZE, ACCESS_LOG_ENABLED, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES
+from src.basics import CHANGE_LISTENER_ENABLED, CHANGE_LISTENER_RECONNECT_INTERVAL
+from src.logs import BackgroundLogging, AccessLogMiddleware, access_logger
+from src.metrics import MetricsMiddleware, SlowQueryLog
+from src.queries import QueryCatalog
+from src.response_cache import ResponseCache
+
+
+class ConnectionPoolLifecycle(object):
+    """Opens the asyncpg pool, and starts the AsyncChangeListener if any, when
+    the worker starts, inside its event loop, and closes them when the worker
+    stops.
+    """
+
+    def __init__(self, titulo_tesouro_crud, change_listener=None):
+        self.titulo_tesouro_crud = titulo_tesouro_crud
+        self.change_listener = change_listener
+
+    async def process_startup(self, scope, event):
+        self.titulo_tesouro_crud.pool = await asyncpg.create_pool(host=DATABASE_PARAMS['host'],
+                                                                  port=DATABASE_PARAMS['port'],
+                                                                  user=DATABASE_PARAMS['user'],
+                                                                  database=DATABASE_PARAMS['dbname'],
+                                                                  password=DATABASE_PARAMS['password'],
+                                                                  min_size=DATABASE_POOL_MIN_SIZE,
+                                                                  max_size=DATABASE_POOL_MAX_SIZE)
+        logging.info('Connection pool open.')
+
+        if self.change_listener is not None:
+            await self.change_listener.start()
+
+    async def process_shutdown(self, scope, event):
+        if self.change_listener is not None:
+            await self.change_listener.stop()
+
+        await self.titulo_tesouro_crud.pool.close()
+        logging.info('Connection pool closed.')
+
+
+BackgroundLogging(queue_size=LOG_QUEUE_SIZE).install()
+if not ACCESS_LOG_ENABLED:
+    access_logger.disabled = True
+
+logging.info('Starting web service (ASGI).')
+
+query_catalog = QueryCatalog()
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_THRESHOLD_MS, explain_rate=SLOW_QUERY_EXPLAIN_RATE, size=SLOW_QUERY_LOG_SIZE)
+
+response_cache = None
+if RESPONSE_CACHE_MAX_ENTRIES > 0:
+    response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+
+titulo_tesouro_crud = AsyncTituloTesouroCRUD(None, query_catalog, slow_query_log, response_cache)
+
+change_listener = None
+if CHANGE_LISTENER_ENABLED:
+    change_listener = AsyncChangeListener(titulo_tesouro_crud, DATABASE_PARAMS,
+                                          reconnect_interval=CHANGE_LISTENER_RECONNECT_INTERVAL)
+
+falcon_api = app = falcon.asgi.App(middleware=[ConnectionPoolLifecycle(titulo_tesouro_crud, change_listener),
+                                                MetricsMiddleware(titulo_tesouro_crud),
+                                                AccessLogMiddleware()])
+# Default of Falcon 1: "/titulo_tesouro/comparar/" and "/titulo_tesouro/comparar" are the same route.
+falcon_api.req_options.strip_url_path_trailing_slash = True
+
+endpoint_expositor = AsyncEndpointExpositor(falcon_api, titulo_tesouro_crud, change_listener)
+endpoint_expositor.expose()
+
+logging.info('Web service listening.\n')
+
+
+def serve(host, port, workers):
+    """Runs "workers" uvicorn processes sharing one listening socket. Unlike
+    "uvicorn --workers", the socket is created as IPPROTO_TCP, which is what
+    asyncio checks before setting TCP_NODELAY on the accepted connections.
+    Without it, every response written in more than one piece waits ~40ms for
+    the delayed ACK of the client.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+
+    config = uvicorn.Config('src.asgi:app', host=host, port=port, access_log=False)
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=uvicorn.Server(config).run, kwargs={'sockets': [sock]})
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for process in processes:
+        process.join()
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            prometheus_client.multiprocess.mark_process_dead(process.pid)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,379 @@
+import falcon
+import json
+import logging
+import time
+
+from src import metrics
+from src.async_notifications import AsyncSubscription
+from src.basics import EVENT_STREAM_HEARTBEAT_INTERVAL, EVENT_STREAM_MAX_DURATION
+from src.endpoints import EndpointExpositor, RequestHandler, HelpRequestHandler, MetricsRequestHandler
+from src.endpoints import SlowQueryRequestHandler
+from src.endpoints import TituloTesouroRequestHandler, TituloTesouroCompareRequestHandler
+from src.endpoints import TituloTesouroByActionRequestHandler, TituloTesouroEventsRequestHandler
+from src.endpoints import TituloTesouroChangesRequestHandler
+
+
+class AsyncEndpointExpositor(EndpointExpositor):
+    """Same endpoints as EndpointExpositor, for a falcon.asgi.App, with the
+    coroutine handlers below over an AsyncTituloTesouroCRUD.
+    """
+
+    def request_handler_classes(self):
+        return (AsyncHelpRequestHandler, AsyncMetricsRequestHandler, AsyncSlowQueryRequestHandler,
+                AsyncTituloTesouroRequestHandler, AsyncTituloTesouroCompareRequestHandler,
+                AsyncTituloTesouroByActionRequestHandler, AsyncTituloTesouroEventsRequestHandler,
+                AsyncTituloTesouroChangesRequestHandler)
+
+
+class AsyncRequestHandler(RequestHandler):
+    """Superclass for all coroutine request handlers. Falcon's ASGI app only
+    takes coroutine responders, so it comes first in the bases of the handlers
+    and replaces the ones of RequestHandler.
+    """
+
+    async def on_post(self, req, resp):
+        logging.debug('POST request received at endpoint "%s"', req.path)
+
+    async def on_delete(self, req, resp):
+        logging.debug('DELETE request received at endpoint "%s"', req.path)
+
+    async def on_put(self, req, resp):
+        logging.debug('PUT request received at endpoint "%s"', req.path)
+
+    async def on_patch(self, req, resp):
+        logging.debug('PATCH request received at endpoint "%s"', req.path)
+
+    async def on_get(self, req, resp):
+        logging.debug('GET request received at endpoint "%s"', req.path)
+
+    async def read_body(self, req):
+        stream = (await req.bounded_stream.read()).decode('utf8')
+        return json.loads(stream)
+
+    def ok_stream(self, resp, message, key, store=None):
+        """Same as RequestHandler.ok_stream, for "message[key]" an asynchronous
+        iterator.
+        """
+        (head, chunks, tail) = self._stream_frame(message, key)
+
+        async def body():
+            parts = [head]
+            yield head
+
+            separator = b''
+            async for rows in chunks:
+                if rows:
+                    parts.append(separator + self._encode_rows(rows))
+                    yield parts[-1]
+                    separator = b', '
+
+            yield tail
+
+            if store is not None:
+                parts.append(tail)
+                store(b''.join(parts))
+
+        resp.stream = body()
+        self.set_response_status_code(resp, 200)
+
+
+class AsyncHelpRequestHandler(AsyncRequestHandler, HelpRequestHandler):
+    """Checks system health and provides instructions.
+    """
+
+    async def on_get(self, req, resp):
+        await super(AsyncHelpRequestHandler, self).on_get(req, resp)
+
+        cache = self.titulo_tesouro_crud.response_cache
+        resp.body = 'System healthy. \nEndpoints: {}\nConnection pool: {}\nResponse cache: {}'.format(
+            self.endpoints, self.titulo_tesouro_crud.pool_stats(), cache.stats() if cache is not None else None)
+
+        self.set_response_status_code(resp, 200)
+
+
+class AsyncMetricsRequestHandler(AsyncRequestHandler, MetricsRequestHandler):
+    """Coroutine version of MetricsRequestHandler.
+    """
+
+    async def on_get(self, req, resp):
+        resp.content_type = metrics.prometheus_client.CONTENT_TYPE_LATEST
+        resp.data = metrics.render()
+
+        self.set_response_status_code(resp, 200)
+
+
+class AsyncSlowQueryRequestHandler(AsyncRequestHandler, SlowQueryRequestHandler):
+    """Coroutine version of SlowQueryRequestHandler.
+    """
+
+    async def on_get(self, req, resp):
+        await super(AsyncSlowQueryRequestHandler, self).on_get(req, resp)
+
+        self.ok(resp, self.report())
+
+
+class AsyncTituloTesouroRequestHandler(AsyncRequestHandler, TituloTesouroRequestHandler):
+    """Coroutine version of TituloTesouroRequestHandler.
+    """
+
+    async def on_post(self, req, resp):
+        await super(AsyncTituloTesouroRequestHandler, self).on_post(req, resp)
+
+        if req.content_length == 0:
+            self.err_bad_request(resp, 'No request body.')
+            return
+
+        body = await self.read_body(req)
+
+        if isinstance(body, list):
+            await self._post_batch(req, resp, body)
+            return
+
+        missing_fields = self._check_missing_fields(body)
+        if missing_fields:
+            self.err_bad_request(resp, 'Mandatory fields {} missing.'.format(missing_fields))
+            return
+
+        try:
+            ret = await self.titulo_tesouro_crud.create(body['categoria_titulo'], body['mês'],
+                                                        body['ano'], body['ação'], body['valor'])
+
+            self.created(resp, ret)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    async def _post_batch(self, req, resp, body):
+        kwargs = dict()
+        if 'on_error' in req.params:
+            kwargs['on_error'] = req.params['on_error']
+
+        try:
+            (created, errors) = await self.titulo_tesouro_crud.create_many(body, **kwargs)
+
+            self.batch(resp, created, errors, success_code=201)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    async def _read_bulk_body(self, req, resp):
+        if not req.content_length:
+            self.err_bad_request(resp, 'No request body.')
+            return None
+
+        body = await self.read_body(req)
+
+        if not body:
+            self.err_bad_request(resp, 'Empty request body.')
+            return None
+
+        return body
+
+    async def on_patch(self, req, resp, titulo_id=None):
+        await super(AsyncTituloTesouroRequestHandler, self).on_patch(req, resp)
+
+        if titulo_id is not None:
+            raise falcon.HTTPMethodNotAllowed(['DELETE', 'GET', 'PUT'])
+
+        body = await self._read_bulk_body(req, resp)
+        if body is None:
+            return
+
+        try:
+            ret = await self.titulo_tesouro_crud.update_many(body)
+
+            self.ok(resp, ret)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    async def _delete_many(self, req, resp):
+        body = await self._read_bulk_body(req, resp)
+        if body is None:
+            return
+
+        try:
+            ret = await self.titulo_tesouro_crud.delete_many(body)
+
+            self.ok(resp, ret)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    async def on_delete(self, req, resp, titulo_id=None):
+        await super(AsyncTituloTesouroRequestHandler, self).on_delete(req, resp)
+
+        if titulo_id is None:
+            await self._delete_many(req, resp)
+            return
+
+        try:
+            ret = await self.titulo_tesouro_crud.delete(titulo_id)
+
+            if ret:
+                self.ok(resp, 'Deleted.')
+            else:
+                self.err_not_found(resp, '"titulo_id" has no register.')
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    async def on_put(self, req, resp, titulo_id):
+        await super(AsyncTituloTesouroRequestHandler, self).on_put(req, resp)
+
+        if req.content_length == 0:
+            self.err_bad_request(resp, 'No request body.')
+            return
+
+        body = await self.read_body(req)
+
+        if not body:
+            self.err_bad_request(resp, 'Empty request body.')
+            return
+
+        try:
+            ret = await self.titulo_tesouro_crud.update(titulo_id, body)
+
+            if ret:
+                body['id'] = int(titulo_id)
+                self.ok(resp, body)
+            else:
+                self.err_not_found(resp, '"titulo_id" has no register.')
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    async def on_get(self, req, resp, titulo_id):
+        await super(AsyncTituloTesouroRequestHandler, self).on_get(req, resp)
+
+        params = req.params
+
+        try:
+            version = await self.titulo_tesouro_crud.data_version([titulo_id])
+            if self.not_modified(req, resp, version):
+                return
+
+            cache_key = self.titulo_tesouro_crud.response_key('historico', titulo_id, params)
+            if self.from_cache(resp, cache_key, version):
+                return
+
+            if self.paginated(req):
+                ret = await self.titulo_tesouro_crud.read_history(titulo_id, params)
+            else:
+                ret = await self.titulo_tesouro_crud.stream_history(titulo_id, params)
+
+            store = self.cache_store(cache_key, version, [ret['categoria_titulo']]) if ret else None
+            if ret and self.paginated(req):
+                self.ok_page(req, resp, ret, store)
+            elif ret:
+                self.ok_stream(resp, ret, 'historico', store)
+            else:
+                self.err_not_found(resp, '"titulo_id" has no register.')
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+
+class AsyncTituloTesouroCompareRequestHandler(AsyncRequestHandler, TituloTesouroCompareRequestHandler):
+    """Coroutine version of TituloTesouroCompareRequestHandler.
+    """
+
+    async def on_get(self, req, resp):
+        await super(AsyncTituloTesouroCompareRequestHandler, self).on_get(req, resp)
+
+        params = req.params
+
+        try:
+            ids = params.get('ids', list())
+            version = await self.titulo_tesouro_crud.data_version(ids) if isinstance(ids, list) else None
+            if self.not_modified(req, resp, version):
+                return
+
+            cache_key = self.titulo_tesouro_crud.response_key('comparar', None, params)
+            if self.from_cache(resp, cache_key, version):
+                return
+
+            ret = await self.titulo_tesouro_crud.compare(params)
+
+            if ret:
+                self.ok(resp, ret, self.cache_store(cache_key, version,
+                                                    [series['categoria_titulo'] for series in ret['series']]))
+            else:
+                self.err_not_found(resp, 'One of the ids was not found.')
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+
+class AsyncTituloTesouroChangesRequestHandler(AsyncRequestHandler, TituloTesouroChangesRequestHandler):
+    """Coroutine version of TituloTesouroChangesRequestHandler.
+    """
+
+    async def on_get(self, req, resp):
+        await super(AsyncTituloTesouroChangesRequestHandler, self).on_get(req, resp)
+
+        try:
+            self.ok(resp, await self.titulo_tesouro_crud.read_changes(req.params))
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+
+class AsyncTituloTesouroByActionRequestHandler(AsyncRequestHandler, TituloTesouroByActionRequestHandler):
+    """Coroutine version of TituloTesouroByActionRequestHandler.
+    """
+
+    async def on_get(self, req, resp, titulo_id):
+        await super(AsyncTituloTesouroByActionRequestHandler, self).on_get(req, resp)
+
+        action = req.path.split('/')[2]
+        params = req.params
+
+        try:
+            version = await self.titulo_tesouro_crud.data_version([titulo_id])
+            if self.not_modified(req, resp, version):
+                return
+
+            cache_key = self.titulo_tesouro_crud.response_key(action, titulo_id, params)
+            if self.from_cache(resp, cache_key, version):
+                return
+
+            if self.paginated(req):
+                ret = await self.titulo_tesouro_crud.read_by_action(titulo_id, action, params)
+            else:
+                ret = await self.titulo_tesouro_crud.stream_by_action(titulo_id, action, params)
+
+            store = self.cache_store(cache_key, version, [ret['categoria_titulo']]) if ret else None
+            if ret and self.paginated(req):
+                self.ok_page(req, resp, ret, store)
+            elif ret:
+                self.ok_stream(resp, ret, 'valores_{}'.format(action), store)
+            else:
+                self.err_not_found(resp, '"titulo_id" has no register for action "{}".'.format(action))
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+
+class AsyncTituloTesouroEventsRequestHandler(AsyncRequestHandler, TituloTesouroEventsRequestHandler):
+    """Coroutine version of TituloTesouroEventsRequestHandler. A stream does
+    not hold the worker, it only waits in the event loop.
+    """
+
+    async def on_get(self, req, resp):
+        await super(AsyncTituloTesouroEventsRequestHandler, self).on_get(req, resp)
+
+        try:
+            subscription = self._subscription(req, AsyncSubscription)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+            return
+
+        async def events():
+            self.change_feed.subscribe(subscription)
+            try:
+                yield 'retry: {}\n\n'.format(self.retry_ms).encode('utf8')
+
+                deadline = time.monotonic() + EVENT_STREAM_MAX_DURATION
+                while not subscription.overflowed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    event = await subscription.get(min(remaining, EVENT_STREAM_HEARTBEAT_INTERVAL))
+                    yield self._encode(event) if event is not None else b': keep-alive\n\n'
+            finally:
+                self.change_feed.unsubscribe(subscription)
+
+        resp.stream = events()
+        self._start_stream(resp)
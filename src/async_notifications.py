@@ -0,0 +1,94 @@
+import asyncio
+import logging
+
+import asyncpg
+
+from src.notifications import CHANNEL, RESYNC, ChangeFeed, Subscription
+
+
+class AsyncChangeListener(ChangeFeed):
+    """ChangeFeed fed by an asyncpg connection of the worker, for the ASGI app.
+    The notifications are handled in the event loop. When the connection is
+    lost, a task connects again every "reconnect_interval" seconds and then
+    publishes RESYNC.
+    """
+
+    def __init__(self, titulo_tesouro_crud, database_params, reconnect_interval=5.0):
+        super(AsyncChangeListener, self).__init__(titulo_tesouro_crud)
+
+        self.database_params = database_params
+        self.reconnect_interval = reconnect_interval
+
+        self._conn = None
+        self._reconnecting = None
+        self._stopped = False
+
+    def _on_notification(self, conn, pid, channel, payload):
+        self.notified(payload, pid)
+
+    def _on_termination(self, conn):
+        if not self._stopped:
+            logging.error('Change listener disconnected.')
+            self._reconnecting = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _connect(self):
+        self._conn = await asyncpg.connect(host=self.database_params['host'],
+                                           port=self.database_params['port'],
+                                           user=self.database_params['user'],
+                                           database=self.database_params['dbname'],
+                                           password=self.database_params['password'])
+        self._conn.add_termination_listener(self._on_termination)
+        await self._conn.add_listener(CHANNEL, self._on_notification)
+        logging.info('Listening to changes on channel "%s".', CHANNEL)
+
+    async def _reconnect(self):
+        while not self._stopped:
+            await asyncio.sleep(self.reconnect_interval)
+            try:
+                await self._connect()
+            except (OSError, asyncpg.PostgresError) as e:
+                logging.error('Change listener could not reconnect: %s', e)
+                continue
+
+            self.publish(RESYNC)
+            return
+
+    async def start(self):
+        self._stopped = False
+        try:
+            await self._connect()
+        except (OSError, asyncpg.PostgresError) as e:
+            logging.error('Change listener could not connect: %s', e)
+            self._reconnecting = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def stop(self):
+        self._stopped = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        if self._conn is not None and not self._conn.is_closed():
+            await self._conn.close()
+
+
+class AsyncSubscription(Subscription):
+    """Same as Subscription, for a coroutine of the event loop where the events
+    are published.
+    """
+
+    def __init__(self, size, categories=None):
+        super(AsyncSubscription, self).__init__(size, categories)
+        self.events = asyncio.Queue(size)
+
+    def __call__(self, event, pid):
+        if self.overflowed or not self.wants(event):
+            return
+
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -0,0 +1,358 @@
+import asyncpg
+import time
+
+from src.basics import BATCH_FAILURE_POLICY, STREAM_CHUNK_SIZE
+from src.comparison import ComparisonMatrix
+from src.metrics import record_query
+from src.services import TituloTesouroCRUD
+
+
+class AsyncTituloTesouroCRUD(TituloTesouroCRUD):
+    """Same operations as TituloTesouroCRUD, as coroutines over an asyncpg
+    pool, for the ASGI app of "src/asgi.py".
+
+    The validation and the formatting are inherited; only the round trips
+    change. The templates of the QueryCatalog are sent as they are, asyncpg
+    takes the $n parameters and prepares and caches each statement on every
+    connection by itself. The series engine is not used.
+    """
+
+    # asyncpg retries a statement whose cached plan went stale, e.g. after
+    # "system_loader.py" recreated the schema, only outside transactions.
+    STALE_STATEMENT_ERRORS = (asyncpg.exceptions.InvalidCachedStatementError,
+                              asyncpg.exceptions.OutdatedSchemaCacheError)
+
+    def __init__(self, pool, queries, slow_query_log=None, response_cache=None):
+        super(AsyncTituloTesouroCRUD, self).__init__(pool, queries, slow_query_log=slow_query_log,
+                                                     response_cache=response_cache)
+
+    def pool_stats(self):
+        # The asyncpg pool is only created on startup.
+        if self.pool is None:
+            return dict()
+
+        (size, idle) = (self.pool.get_size(), self.pool.get_idle_size())
+        return {
+            'min_size': self.pool.get_min_size(),
+            'max_size': self.pool.get_max_size(),
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle
+        }
+
+    async def _timed(self, conn, method, name, *args):
+        """Runs the query "name" of the catalog with "method" of "conn" (fetch,
+        fetchval...), timed by name. Slow queries are recorded in the
+        SlowQueryLog, if any.
+        """
+        start = time.perf_counter()
+        try:
+            result = await getattr(conn, method)(self.queries[name], *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            record_query(name, elapsed)
+
+        if self.slow_query_log is not None and self.slow_query_log.is_slow(elapsed):
+            await self._log_slow_query(conn, name, args, elapsed)
+
+        return result
+
+    async def _log_slow_query(self, conn, name, params, elapsed):
+        """Same as TituloTesouroCRUD._log_slow_query. The EXPLAIN runs in a
+        transaction, or a savepoint, rolled back afterwards.
+        """
+        plan = None
+        if self.slow_query_log.should_explain():
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                rows = await conn.fetch('EXPLAIN (ANALYZE, BUFFERS) {}'.format(self.queries[name]), *params)
+                plan = [row[0] for row in rows]
+            except asyncpg.PostgresError as e:
+                plan = ['EXPLAIN failed: {}'.format(e).strip()]
+            finally:
+                await transaction.rollback()
+
+        self.slow_query_log.record(name, params, elapsed, plan)
+
+    async def _begin(self, conn, statement):
+        """Starts a transaction on "conn" with "statement", a function returning
+        the awaitable of its first statement. Returns the transaction and the
+        result of the statement. A stale cached statement is retried once, in
+        a new transaction.
+        """
+        for retry in (False, True):
+            transaction = conn.transaction()
+            await transaction.start()
+
+            try:
+                return (transaction, await statement())
+            except self.STALE_STATEMENT_ERRORS:
+                await transaction.rollback()
+                if retry:
+                    raise
+            except BaseException:
+                await transaction.rollback()
+                raise
+
+    async def create(self, category, month, year, action, amount):
+        (category, action, expire_at, amount) = self._prepare_record(category, month, year, action, amount)
+
+        async with self.pool.acquire() as conn:
+            _id = await self._timed(conn, 'fetchval', 'load-input-data', category, action, expire_at, amount)
+
+        return self._created(_id, category, action, expire_at, amount)
+
+    async def create_many(self, records, on_error=BATCH_FAILURE_POLICY):
+        (prepared, errors) = self._prepare_batch(records, on_error)
+        ids = dict()
+
+        if prepared and not (errors and on_error == 'abort'):
+            async with self.pool.acquire() as conn:
+                columns = self._batch_columns(prepared)
+                (transaction, rows) = await self._begin(
+                    conn, lambda: self._timed(conn, 'fetch', 'load-input-data-batch', *columns))
+                ids = {(category, action, expire_at): _id for (_id, category, action, expire_at) in rows}
+
+                if self._batch_conflicts(prepared, ids, errors) and on_error == 'abort':
+                    ids = dict()
+
+                if ids:
+                    await transaction.commit()
+                else:
+                    await transaction.rollback()
+
+        return self._created_batch(prepared, ids, errors)
+
+    async def delete(self, titulo_id):
+        self._validate_titulo_id(titulo_id)
+
+        async with self.pool.acquire() as conn:
+            deleted = await self._timed(conn, 'fetch', 'delete-tesouro-direto-by-id', [int(titulo_id)])
+
+        self._invalidate([row[1] for row in deleted])
+        return bool(deleted)
+
+    async def update(self, titulo_id, data):
+        self._validate_titulo_id(titulo_id)
+
+        async with self.pool.acquire() as conn:
+            (transaction, result) = await self._begin(
+                conn, lambda: self._timed(conn, 'fetch', 'get-expire_at', int(titulo_id)))
+
+            try:
+                if result:
+                    (action, amount, expire_at) = self._prepare_update(data, result[0][0], result[0][1])
+
+                    await self._timed(conn, 'execute', 'update-tesouro-direto', int(titulo_id), action, amount,
+                                      expire_at)
+            except BaseException:
+                await transaction.rollback()
+                raise
+
+            await transaction.commit()
+
+        if result:
+            self._invalidate([result[0][2]])
+        return bool(result)
+
+    async def delete_many(self, body):
+        (ids, selection) = self._read_selection(body)
+
+        async with self.pool.acquire() as conn:
+            if ids is not None:
+                deleted = await self._timed(conn, 'fetch', 'delete-tesouro-direto-by-id', ids)
+            else:
+                deleted = await self._timed(conn, 'fetch', 'delete-tesouro-direto-by-filter', *selection)
+
+        self._invalidate([row[1] for row in deleted])
+        return self._affected(ids, {row[0] for row in deleted})
+
+    async def update_many(self, body):
+        (ids, selection, action, amount) = self._prepare_bulk_update(body)
+
+        async with self.pool.acquire() as conn:
+            if ids is not None:
+                updated = await self._timed(conn, 'fetch', 'update-tesouro-direto-by-id', ids, action, amount)
+            else:
+                updated = await self._timed(conn, 'fetch', 'update-tesouro-direto-by-filter', *selection, action,
+                                            amount)
+
+        self._invalidate([row[4] for row in updated])
+        return self._affected(ids, {row[0] for row in updated})
+
+    async def data_version(self, titulo_ids):
+        try:
+            for titulo_id in titulo_ids:
+                self._validate_titulo_id(titulo_id)
+        except AssertionError:
+            return None
+
+        async with self.pool.acquire() as conn:
+            (version, updated_at) = await self._timed(conn, 'fetchrow', 'get-version',
+                                                      [int(_id) for _id in titulo_ids])
+
+        if version is None:
+            return None
+        return (version, updated_at)
+
+    async def read_changes(self, params):
+        (since, limit) = self._read_changes_params(params)
+
+        async with self.pool.acquire() as conn:
+            (transaction, locked) = await self._begin(conn, lambda: self._timed(conn, 'fetchval', 'lock-changes'))
+
+            try:
+                if locked:
+                    await self._timed(conn, 'execute', 'sequence-changes')
+                rows = await self._timed(conn, 'fetch', 'read-changes', since, limit + 1)
+            except BaseException:
+                await transaction.rollback()
+                raise
+
+            await transaction.commit()
+
+        return self._format_changes(since, limit, rows)
+
+    async def _category(self, titulo_id):
+        async with self.pool.acquire() as conn:
+            return await self._timed(conn, 'fetchval', 'get-category', int(titulo_id))
+
+    async def _iter_rows(self, name, params):
+        """Rows of the query "name" in lists of up to STREAM_CHUNK_SIZE, fetched
+        through a server-side cursor as they are consumed. As in the sync CRUD,
+        the cursor is declared and the first list fetched before returning.
+        """
+        chunks = self._cursor_rows(name, params)
+        try:
+            rows = await chunks.__anext__()
+        except StopAsyncIteration:
+            rows = None
+
+        return self._resume_rows(rows, chunks)
+
+    async def _resume_rows(self, rows, chunks):
+        if rows is not None:
+            yield rows
+        async for rows in chunks:
+            yield rows
+
+    async def _cursor_rows(self, name, params):
+        async with self.pool.acquire() as conn:
+            start = time.perf_counter()
+            (transaction, cursor) = await self._begin(conn, lambda: conn.cursor(self.queries[name], *params))
+            elapsed = time.perf_counter() - start
+
+            try:
+                while True:
+                    start = time.perf_counter()
+                    rows = await cursor.fetch(STREAM_CHUNK_SIZE)
+                    elapsed += time.perf_counter() - start
+
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                await transaction.rollback()
+                record_query(name, elapsed)
+
+                if self.slow_query_log is not None and self.slow_query_log.is_slow(elapsed):
+                    await self._log_slow_query(conn, name, params, elapsed)
+
+    async def _fetch(self, name, params):
+        async with self.pool.acquire() as conn:
+            return await self._timed(conn, 'fetch', name, *params)
+
+    async def read_history(self, titulo_id, params):
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+        (limit, start_date) = self._read_page(params, start_date, group_by_year)
+
+        category = await self._category(titulo_id)
+        if category is None:
+            return False
+
+        rows = await self._fetch('read-history-grouped' if group_by_year else 'read-history',
+                                 (category, start_date, end_date, None if limit is None else limit + 1))
+
+        return self._paginate({
+            'id': int(titulo_id),
+            'categoria_titulo': category,
+            'historico': self._format_history(rows, group_by_year)
+        }, 'historico', limit, group_by_year)
+
+    async def read_by_action(self, titulo_id, action, params):
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+        (limit, start_date) = self._read_page(params, start_date, group_by_year)
+
+        category = await self._category(titulo_id)
+        if category is None:
+            return False
+
+        rows = await self._fetch('read-by-action-grouped' if group_by_year else 'read-by-action',
+                                 (action.upper(), category, start_date, end_date, None if limit is None else limit + 1))
+
+        return self._paginate({
+            'id': int(titulo_id),
+            'categoria_titulo': category,
+            'valores_{}'.format(action): self._format_by_action(rows, group_by_year)
+        }, 'valores_{}'.format(action), limit, group_by_year)
+
+    async def _format_chunks(self, chunks, format_rows, group_by_year):
+        async for rows in chunks:
+            yield format_rows(rows, group_by_year)
+
+    async def stream_history(self, titulo_id, params):
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+
+        category = await self._category(titulo_id)
+        if category is None:
+            return False
+
+        if group_by_year:
+            chunks = await self._iter_rows('read-history-grouped', (category, start_date, end_date, None))
+        else:
+            chunks = await self._iter_rows('read-history', (category, start_date, end_date, None))
+
+        return {
+            'id': int(titulo_id),
+            'categoria_titulo': category,
+            'historico': self._format_chunks(chunks, self._format_history, group_by_year)
+        }
+
+    async def stream_by_action(self, titulo_id, action, params):
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+
+        category = await self._category(titulo_id)
+        if category is None:
+            return False
+
+        if group_by_year:
+            chunks = await self._iter_rows('read-by-action-grouped', (action.upper(), category, start_date, end_date,
+                                                                      None))
+        else:
+            chunks = await self._iter_rows('read-by-action', (action.upper(), category, start_date, end_date, None))
+
+        return {
+            'id': int(titulo_id),
+            'categoria_titulo': category,
+            'valores_{}'.format(action): self._format_chunks(chunks, self._format_by_action, group_by_year)
+        }
+
+    async def compare(self, params):
+        (ids, start_date, end_date, group_by_year) = self._read_compare(params)
+
+        async with self.pool.acquire() as conn:
+            (transaction, rows) = await self._begin(conn, lambda: self._timed(conn, 'fetch', 'get-series-by-id', ids))
+
+            try:
+                series = {_id: (category, action) for (_id, category, action) in rows}
+                if len(series) < len(ids):
+                    return False
+
+                cells = await self._timed(conn, 'fetch', 'compare', start_date, end_date, ids)
+            finally:
+                await transaction.rollback()
+
+        matrix = ComparisonMatrix.from_cells([row[0] for row in cells], [row[1] for row in cells],
+                                             [row[2] for row in cells], len(ids))
+        return self._format_comparison(ids, series, matrix, group_by_year)
@@ -17,9 +17,52 @@ DATABASE_PARAMS = {
     'password': DATABASE_PASSWORD
 }
 
+DATABASE_POOL_MIN_SIZE = int(os.environ.get('DATABASE_POOL_MIN_SIZE', '1'))
+DATABASE_POOL_MAX_SIZE = int(os.environ.get('DATABASE_POOL_MAX_SIZE', '10'))
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', '30'))
+DATABASE_POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('DATABASE_POOL_HEALTH_CHECK_INTERVAL', '5'))
+
+COPY_CHUNK_SIZE = int(os.environ.get('COPY_CHUNK_SIZE', '5000'))
+LOADER_WORKERS = int(os.environ.get('LOADER_WORKERS', str(os.cpu_count() or 1)))
+
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '1000'))
+BATCH_FAILURE_POLICIES = ['abort', 'skip']
+BATCH_FAILURE_POLICY = os.environ.get('BATCH_FAILURE_POLICY', 'abort')
+
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', '1000'))
+PAGE_MAX_SIZE = int(os.environ.get('PAGE_MAX_SIZE', '1000'))
+CHANGES_PAGE_MAX_SIZE = int(os.environ.get('CHANGES_PAGE_MAX_SIZE', '10000'))
+CHANGE_LOG_RETENTION_HOURS = float(os.environ.get('CHANGE_LOG_RETENTION_HOURS', '24'))
+
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '100'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', '0'))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', '100'))
+SLOW_QUERY_ENDPOINT_ENABLED = os.environ.get('SLOW_QUERY_ENDPOINT_ENABLED', 'false') == 'true'
+
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+ACCESS_LOG_ENABLED = os.environ.get('ACCESS_LOG_ENABLED', 'true') == 'true'
+PAYLOAD_LOG_RATE = float(os.environ.get('PAYLOAD_LOG_RATE', '0'))
+PAYLOAD_LOG_MAX_SIZE = int(os.environ.get('PAYLOAD_LOG_MAX_SIZE', '1000'))
+
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+CHANGE_LISTENER_ENABLED = os.environ.get('CHANGE_LISTENER_ENABLED', 'true') == 'true'
+CHANGE_LISTENER_RECONNECT_INTERVAL = float(os.environ.get('CHANGE_LISTENER_RECONNECT_INTERVAL', '5'))
+EVENT_STREAM_QUEUE_SIZE = int(os.environ.get('EVENT_STREAM_QUEUE_SIZE', '1000'))
+EVENT_STREAM_HEARTBEAT_INTERVAL = float(os.environ.get('EVENT_STREAM_HEARTBEAT_INTERVAL', '15'))
+# Under the gthread workers of "gunicorn.conf.py" a stream holds one thread of
+# its worker. The worker keeps signalling the arbiter, so "timeout" does not
+# apply, but on a restart or reload it only waits "graceful_timeout" (30s by
+# default) for open connections, so streams end before that.
+EVENT_STREAM_MAX_DURATION = float(os.environ.get('EVENT_STREAM_MAX_DURATION', '25'))
+
+SERIES_ENGINE_ENABLED = os.environ.get('SERIES_ENGINE_ENABLED', 'false') == 'true'
+
 RESOURCES_PATH = '{}/resources'.format(PROJECT_ROOT_PATH)
 SCHEMAS_PATH = '{}/schemas'.format(RESOURCES_PATH)
 TRANSACTIONS_PATH = '{}/transactions'.format(RESOURCES_PATH)
+MAINTENANCE_PATH = '{}/maintenance'.format(RESOURCES_PATH)
 
 TITULO_TESOURO_CATEGORIES = ['LTN', 'LFT', 'NTN-B', 'NTN-B Principal', 'NTN-C', 'NTN-F']
 TITULO_TESOURO_ACTIONS = ['VENDA', 'RESGATE']
@@ -0,0 +1,48 @@
+"""Compares babel's "format_currency(value, 'BRL')", as the services called it
+for every amount, against the precompiled CurrencyFormatter of
+"src/formatting.py", over the amounts of a long history. Does not need a
+database.
+
+    python3 src/bench_formatting.py [--values N] [--repeat N]
+"""
+
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+from babel.numbers import format_currency
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+from src.formatting import BRL
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--values', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    generator = random.Random(2018)
+    values = [round(generator.uniform(0, 1e6), 2) for _ in range(args.values)]
+
+    assert BRL.format_many(values) == [format_currency(value, 'BRL') for value in values]
+
+    babel = min(timeit.repeat(lambda: [format_currency(value, 'BRL') for value in values],
+                              number=1, repeat=args.repeat))
+    precompiled = min(timeit.repeat(lambda: BRL.format_many(values), number=1, repeat=args.repeat))
+
+    print(json.dumps({
+        'values': args.values,
+        'babel_us_per_value': round(babel / args.values * 1e6, 3),
+        'precompiled_us_per_value': round(precompiled / args.values * 1e6, 3),
+        'speedup': round(babel / precompiled, 2)
+    }, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""End-to-end load test of the WSGI app ("src/main.py" under gunicorn).
+
+Reloads the database from "resources/input-data.xlsx", starts gunicorn with
+the chosen worker configuration, then, for each of the "--concurrency"
+levels, keeps that many clients busy for "--duration" seconds, each with its
+own connection, sending a weighted mix of the six endpoints:
+
+    historico   GET /titulo_tesouro/{id}
+    venda       GET /titulo_tesouro/venda/{id}
+    resgate     GET /titulo_tesouro/resgate/{id}
+    comparar    GET /titulo_tesouro/comparar?ids=...
+    atualizar   PUT /titulo_tesouro/{id}
+    criar       POST /titulo_tesouro
+
+Reports, as JSON, the requests per second, the latency percentiles and the
+error rate of each level, overall and by endpoint. With "--baseline" the
+report is compared level by level against a stored one, and the exit status
+is 1 when the requests per second drop, or the p99 latency rises, by more
+than "--tolerance", or when the error rate rises. "--save-baseline" stores the
+report as the new baseline.
+
+    python3 src/bench_load.py [--workers N] [--concurrency 8,64,256] [--duration S]
+                              [--mix historico=30,...] [--baseline FILE] [--save-baseline FILE]
+"""
+
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+from src.bench_serving import HTTPClient, wait_until_up
+from src.basics import TITULO_TESOURO_CATEGORIES, TITULO_TESOURO_ACTIONS
+from src.system_loader import drop_database, create_database, load_xlsx
+
+
+MIX = {
+    'historico': 30,
+    'venda': 20,
+    'resgate': 20,
+    'comparar': 15,
+    'atualizar': 10,
+    'criar': 5
+}
+
+# Records created during a run go to consecutive months from a random year far
+# past the dataset, so that they do not collide with the existing ones, with
+# each other or, with "--no-reload", with those of previous runs.
+CREATED_YEARS = (3000, 9000)
+
+
+class Workload(object):
+    """Builds the requests of the mix over the ids 1..ids.
+    """
+
+    def __init__(self, mix, ids):
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.ids = ids
+        self.created = itertools.count(12 * random.randrange(*CREATED_YEARS))
+
+    def _id(self):
+        return random.randint(1, self.ids)
+
+    def historico(self):
+        return ('GET', '/titulo_tesouro/{}'.format(self._id()), None)
+
+    def venda(self):
+        return ('GET', '/titulo_tesouro/venda/{}'.format(self._id()), None)
+
+    def resgate(self):
+        return ('GET', '/titulo_tesouro/resgate/{}'.format(self._id()), None)
+
+    def comparar(self):
+        ids = random.sample(range(1, self.ids + 1), 3)
+        return ('GET', '/titulo_tesouro/comparar?{}'.format('&'.join('ids={}'.format(_id) for _id in ids)), None)
+
+    def atualizar(self):
+        body = {'valor': round(random.uniform(1000, 1000000), 2)}
+        return ('PUT', '/titulo_tesouro/{}'.format(self._id()), json.dumps(body).encode('utf8'))
+
+    def criar(self):
+        n = next(self.created)
+        body = {
+            'categoria_titulo': random.choice(TITULO_TESOURO_CATEGORIES),
+            'mês': n % 12 + 1,
+            'ano': n // 12,
+            'ação': random.choice(TITULO_TESOURO_ACTIONS),
+            'valor': round(random.uniform(1000, 1000000), 2)
+        }
+        return ('POST', '/titulo_tesouro', json.dumps(body).encode('utf8'))
+
+    def next(self):
+        name = random.choices(self.names, self.weights)[0]
+        return (name,) + getattr(self, name)()
+
+
+def summarize(latencies, errors, elapsed):
+    """RPS counts only the successful requests; the error rate is over all.
+    """
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    percentile = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 2)
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'error_rate': round(errors / total, 4) if total else None,
+        'rps': round(len(latencies) / elapsed, 1),
+        'latency_ms_p50': percentile(0.50) if latencies else None,
+        'latency_ms_p95': percentile(0.95) if latencies else None,
+        'latency_ms_p99': percentile(0.99) if latencies else None
+    }
+
+
+async def client(port, workload, deadline, latencies, errors):
+    http = HTTPClient('127.0.0.1', port)
+
+    while time.monotonic() < deadline:
+        (name, method, path, body) = workload.next()
+        start = time.perf_counter()
+        try:
+            (status, _) = await http.request(method, path, body)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            http.close()
+            errors[name] += 1
+            continue
+
+        if status < 400:
+            latencies[name].append((time.perf_counter() - start) * 1000)
+        else:
+            errors[name] += 1
+
+    http.close()
+
+
+async def load(port, workload, concurrency, duration):
+    latencies = {name: list() for name in workload.names}
+    errors = {name: 0 for name in workload.names}
+    deadline = time.monotonic() + duration
+
+    start = time.monotonic()
+    await asyncio.gather(*[client(port, workload, deadline, latencies, errors) for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+
+    report = summarize(list(itertools.chain(*latencies.values())), sum(errors.values()), elapsed)
+    report['endpoints'] = {name: summarize(latencies[name], errors[name], elapsed) for name in workload.names}
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Changes of each level also present in "baseline", as ratios to it, and
+    the list of regressions beyond "tolerance".
+    """
+    changes = dict()
+    regressions = list()
+
+    for (level, current) in report['levels'].items():
+        previous = baseline['levels'].get(level)
+        if previous is None:
+            continue
+
+        rps = round(current['rps'] / previous['rps'], 3) if previous['rps'] else None
+        p99 = (round(current['latency_ms_p99'] / previous['latency_ms_p99'], 3)
+               if current['latency_ms_p99'] and previous['latency_ms_p99'] else None)
+        changes[level] = {
+            'rps_ratio': rps,
+            'latency_ms_p99_ratio': p99,
+            'error_rate_delta': round((current['error_rate'] or 0) - (previous['error_rate'] or 0), 4)
+        }
+
+        if rps is not None and rps < 1 - tolerance:
+            regressions.append('concurrency {}: rps down to {} of the baseline'.format(level, rps))
+        if p99 is not None and p99 > 1 + tolerance:
+            regressions.append('concurrency {}: p99 latency up to {} of the baseline'.format(level, p99))
+        if changes[level]['error_rate_delta'] > 0:
+            regressions.append('concurrency {}: error rate up by {}'.format(level, changes[level]['error_rate_delta']))
+
+    return (changes, regressions)
+
+
+def parse_mix(text):
+    mix = dict()
+    for item in text.split(','):
+        (name, _, weight) = item.partition('=')
+        assert name in MIX, 'Unknown endpoint "{}", must be one of {}.'.format(name, list(MIX))
+        mix[name] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--concurrency', default='8,64,256', help='Comma separated levels.')
+    parser.add_argument('--duration', type=float, default=15, help='Seconds per level.')
+    parser.add_argument('--warmup', type=float, default=2, help='Seconds of load before the first level.')
+    parser.add_argument('--mix', type=parse_mix, default=MIX, help='Weights, e.g. "historico=3,criar=1".')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--ids', type=int, default=300, help='Requests go to ids 1..N.')
+    parser.add_argument('--no-reload', action='store_true', help='Keep the database as it is.')
+    parser.add_argument('--baseline', help='Report to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--save-baseline', help='Where to store this report.')
+    args = parser.parse_args()
+
+    if not args.no_reload:
+        drop_database(verbose=False)
+        create_database(verbose=False)
+        load_xlsx('input-data.xlsx', verbose=False)
+
+    command = ['gunicorn', 'src.main', '--bind', '127.0.0.1:{}'.format(args.port), '--workers', str(args.workers),
+               '--worker-class', args.worker_class, '--threads', str(args.threads)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    workload = Workload(args.mix, args.ids)
+    report = {
+        'config': {
+            'workers': args.workers,
+            'worker_class': args.worker_class,
+            'threads': args.threads,
+            'duration': args.duration,
+            'mix': args.mix,
+            'cpus': os.cpu_count()
+        },
+        'levels': dict()
+    }
+
+    try:
+        wait_until_up(args.port)
+        if args.warmup:
+            asyncio.run(load(args.port, workload, levels[0], args.warmup))
+
+        for level in levels:
+            report['levels'][str(level)] = asyncio.run(load(args.port, workload, level, args.duration))
+    finally:
+        server.terminate()
+        server.wait()
+
+    regressions = list()
+    if args.baseline:
+        with open(args.baseline) as f:
+            (report['baseline'], regressions) = compare(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    print(json.dumps(report, indent=4))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'config': report['config'], 'levels': report['levels']}, f, indent=4)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
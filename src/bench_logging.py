@@ -0,0 +1,142 @@
+"""Latency of the request handlers under three ways of logging, all writing
+to a file:
+
+    sync_payloads     records written on the request thread, every response
+                      body logged in full, as before the access log
+    queued_payloads   records written by the BackgroundLogging thread, every
+                      response body logged in full
+    queued_sampled    records written by the BackgroundLogging thread, bodies
+                      sampled and truncated as set by PAYLOAD_LOG_RATE and
+                      PAYLOAD_LOG_MAX_SIZE
+
+The handlers run through falcon.testing over the fake database of
+"bench_services.py", so the latency is all Python and logging. A file in the
+page cache takes writes faster than the pipe to a busy log collector would;
+"--write-delay" adds that many microseconds to each write, with the GIL
+released as in a blocking write. Reports, as JSON, the mean and percentiles
+in microseconds of each case under each mode, the time the writer thread took
+to drain its queue afterwards and the size of the log.
+
+    python3 src/bench_logging.py [--requests N] [--write-delay US]
+"""
+
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+import falcon.util.deprecation
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+from src.basics import PAYLOAD_LOG_RATE, PAYLOAD_LOG_MAX_SIZE
+from src.bench_services import build
+from src.endpoints import RequestHandler
+from src.logs import FORMAT, DATE_FORMAT, BackgroundLogging, PayloadLog
+
+
+MODES = {
+    'sync_payloads': (False, PayloadLog(1, sys.maxsize)),
+    'queued_payloads': (True, PayloadLog(1, sys.maxsize)),
+    'queued_sampled': (True, PayloadLog(PAYLOAD_LOG_RATE, PAYLOAD_LOG_MAX_SIZE))
+}
+
+
+def cases(client):
+    interval = {'data_inicio': '2006-01', 'data_fim': '2016-04'}
+    record = {'categoria_titulo': 'NTN-B', 'mês': 5, 'ano': 2030, 'ação': 'venda', 'valor': 1234.5}
+
+    return {
+        'get_history.page': lambda: client.simulate_get('/titulo_tesouro/1', params=dict(interval, limit='1000')),
+        'get_compare': lambda: client.simulate_get('/titulo_tesouro/comparar',
+                                                   params=dict(interval, ids=['1', '2', '3'])),
+        'post': lambda: client.simulate_post('/titulo_tesouro', json=record)
+    }
+
+
+class SlowStream(object):
+
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def log_synchronously(stream):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+def measure(call, requests):
+    latencies = list()
+    for _ in range(requests):
+        start = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - start) * 1000000)
+
+    latencies.sort()
+    percentile = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 1)
+
+    return {
+        'us_mean': round(statistics.mean(latencies), 1),
+        'us_p50': percentile(0.50),
+        'us_p99': percentile(0.99)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per case and mode.')
+    parser.add_argument('--write-delay', type=float, default=200, help='Microseconds added to each write.')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore', falcon.util.deprecation.DeprecatedWarning)
+
+    (_, client) = build()
+    report = dict()
+
+    for (mode, (queued, payload_log)) in MODES.items():
+        RequestHandler.payload_log = payload_log
+        report[mode] = dict()
+
+        with tempfile.TemporaryFile('w') as log_file:
+            stream = SlowStream(log_file, args.write_delay / 1000000) if args.write_delay else log_file
+
+            background = BackgroundLogging(stream=stream)
+            if queued:
+                background.start()
+            else:
+                log_synchronously(stream)
+
+            for (name, call) in cases(client).items():
+                call()
+                report[mode][name] = measure(call, args.requests)
+
+            start = time.perf_counter()
+            background.stop()
+            report[mode]['drain_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            report[mode]['log_bytes'] = log_file.tell()
+
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Compares the cost of the "read-history" and "read-by-action" queries sent as
+plain SQL text, the way the old str.format templates were, against the server
+side prepared statements of the QueryCatalog.
+
+For each mode it reports the client wall time per call, which includes parsing
+on the server, and the "Planning Time" reported by EXPLAIN ANALYZE. Needs a
+loaded database (see "main-db.sh").
+
+    python3 src/bench_queries.py [--iterations N]
+"""
+
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+from src.basics import DATABASE_PARAMS
+from src.queries import QueryCatalog
+
+
+BENCHMARKS = {
+    'read-history': ('NTN-B', datetime.datetime(2002, 1, 1), datetime.datetime(2018, 1, 1), None),
+    'read-history-grouped': ('NTN-B', datetime.datetime(2002, 1, 1), datetime.datetime(2018, 1, 1), None),
+    'read-by-action': ('VENDA', 'NTN-B', datetime.datetime(2002, 1, 1), datetime.datetime(2018, 1, 1), None),
+    'read-by-action-grouped': ('VENDA', 'NTN-B', datetime.datetime(2002, 1, 1), datetime.datetime(2018, 1, 1), None)
+}
+
+
+def inline_sql(cur, catalog, name, params):
+    """Renders the template with its values inlined, as the server received
+    them before the catalog existed.
+    """
+    sql = QueryCatalog.PARAMETER_PATTERN.sub(r'%(p\1)s', catalog[name].replace('%', '%%'))
+    return cur.mogrify(sql, {'p{}'.format(i + 1): value for (i, value) in enumerate(params)}).decode('utf8')
+
+
+def prepared_sql(cur, catalog, name, params):
+    placeholders = ', '.join(['%s'] * len(params))
+    return cur.mogrify('EXECUTE {} ({})'.format(catalog.statements[name]['statement'], placeholders),
+                       params).decode('utf8')
+
+
+def measure(cur, sql, iterations):
+    timings = list()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        cur.execute(sql)
+        cur.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    planning = list()
+    for _ in range(iterations):
+        cur.execute('EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) {}'.format(sql))
+        planning.append(cur.fetchall()[0][0][0]['Planning Time'])
+
+    return {
+        'wall_ms_mean': round(statistics.mean(timings), 4),
+        'wall_ms_p50': round(statistics.median(timings), 4),
+        'planning_ms_mean': round(statistics.mean(planning), 4)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    catalog = QueryCatalog()
+    conn = psycopg2.connect(**DATABASE_PARAMS)
+    conn.autocommit = True
+    catalog.prepare(conn)
+    cur = conn.cursor()
+
+    report = dict()
+    for (name, params) in BENCHMARKS.items():
+        before = measure(cur, inline_sql(cur, catalog, name, params), args.iterations)
+        after = measure(cur, prepared_sql(cur, catalog, name, params), args.iterations)
+
+        report[name] = {
+            'text': before,
+            'prepared': after,
+            'wall_speedup': round(before['wall_ms_mean'] / after['wall_ms_mean'], 2)
+        }
+
+    cur.close()
+    conn.close()
+
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""Microbenchmarks of the Python side of the hot path, without Postgres or an
+HTTP server.
+
+TituloTesouroCRUD gets a FakePool whose cursors answer the queries of the
+QueryCatalog with canned rows of the shapes and types psycopg2 returns (e.g.
+int years and months and Decimal amounts), as many as a category has in the
+dataset. Each CRUD method is then timed by itself, and the request handlers
+through falcon.testing, so what is measured is the validation, the parsing of
+the parameters, the building of the rows and the formatting of the amounts.
+
+Reports, as JSON, the microseconds per call of each case, the best of
+"--repeat" rounds of "--number" calls. With "--baseline" the report is
+compared against a stored one, and the exit status is 1 when a case got
+slower by more than "--tolerance". "--save-baseline" stores the report as
+the new baseline.
+
+    python3 src/bench_services.py [--number N] [--repeat N] [--only NAME] [--baseline FILE]
+                                  [--save-baseline FILE]
+"""
+
+
+import argparse
+import contextlib
+import datetime
+import decimal
+import json
+import logging
+import os
+import random
+import sys
+import time
+import warnings
+
+import falcon
+import falcon.testing
+import falcon.util.deprecation
+import psycopg2.extensions
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+from src.endpoints import EndpointExpositor
+from src.logs import AccessLogMiddleware
+from src.metrics import MetricsMiddleware
+from src.queries import QueryCatalog
+from src.services import TituloTesouroCRUD
+
+
+# A category of the dataset has about ten years of monthly sales and
+# redemptions.
+MONTHS = [(year, month) for year in range(2006, 2017) for month in range(1, 13)][:124]
+
+rng = random.Random(0)
+AMOUNTS = {(year, month, action): decimal.Decimal(rng.randrange(1000000, 500000000)) / 100
+           for (year, month) in MONTHS for action in ('VENDA', 'RESGATE')}
+
+
+def _yearly(action):
+    totals = dict()
+    for (year, month) in MONTHS:
+        totals[year] = totals.get(year, 0) + AMOUNTS[(year, month, action)]
+    return totals
+
+
+YEARLY = {action: _yearly(action) for action in ('VENDA', 'RESGATE')}
+SERIES = [('NTN-B', 'VENDA'), ('LTN', 'RESGATE'), ('LFT', 'VENDA'), ('NTN-F', 'RESGATE')]
+
+
+def _limited(rows, limit):
+    return rows if limit is None else rows[:limit]
+
+
+# Rows of each query of the catalog, from its parameters.
+ANSWERS = {
+    'get-category': lambda params: [('NTN-B',)],
+    'get-version': lambda params: [(17, datetime.datetime(2018, 3, 1, 12, 0, 0))],
+    'get-expire_at': lambda params: [(2010, 5, 'NTN-B')],
+    'count-tesouro-direto': lambda params: [(1,)],
+    'delete-tesouro-direto': lambda params: [('NTN-B',)],
+    'update-tesouro-direto': lambda params: list(),
+    'load-input-data': lambda params: [(1489,)],
+    'load-input-data-batch': lambda params: [(1489 + i, category, action, expire_at)
+                                             for (i, (category, action, expire_at))
+                                             in enumerate(zip(params[0], params[1], params[2]))],
+    'delete-tesouro-direto-by-id': lambda params: [(_id, 'NTN-B') for _id in params[0]],
+    'update-tesouro-direto-by-id': lambda params: [(_id, params[1] or 'VENDA', params[2],
+                                                    datetime.datetime(2010, 5, 1), 'NTN-B') for _id in params[0]],
+    'read-history': lambda params: _limited(
+        [(month, year, AMOUNTS[(year, month, 'VENDA')], AMOUNTS[(year, month, 'RESGATE')])
+         for (year, month) in MONTHS], params[3]),
+    'read-history-grouped': lambda params: _limited(
+        [(year, YEARLY['VENDA'][year], YEARLY['RESGATE'][year]) for year in sorted(YEARLY['VENDA'])], params[3]),
+    'read-by-action': lambda params: _limited(
+        [(year, month, AMOUNTS[(year, month, params[0])]) for (year, month) in MONTHS],
+        params[4]),
+    'read-by-action-grouped': lambda params: _limited(
+        [(year, YEARLY[params[0]][year]) for year in sorted(YEARLY[params[0]])], params[4]),
+    'get-series-by-id': lambda params: [(_id, ) + SERIES[_id % len(SERIES)] for _id in params[0]],
+    'compare': lambda params: [(column, year * 12 + month - 1,
+                                float(AMOUNTS[(year, month, SERIES[_id % len(SERIES)][1])]))
+                               for (column, _id) in enumerate(params[2]) for (year, month) in MONTHS]
+}
+
+
+class FakeCursor(object):
+    """Answers the EXECUTE of the prepared statements, and the DECLARE of the
+    named cursors, of the QueryCatalog with the ANSWERS.
+    """
+
+    def __init__(self, connection, queries, name=None):
+        self.connection = connection
+        self.queries = queries
+        self.name = name
+        self.rows = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, sql, params=None):
+        if self.name is not None:
+            statement = self.name[:-len('_cursor')]
+            params = [params['p{}'.format(i + 1)] for i in range(len(params))]
+        else:
+            statement = sql.split()[1]
+
+        self.rows = ANSWERS[self.queries[statement]](params or ())
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, list())
+        return rows
+
+    def fetchmany(self, size):
+        (rows, self.rows) = (self.rows[:size], self.rows[size:])
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def cursor(self, name=None):
+        return FakeCursor(self, self.queries, name)
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool(object):
+    """Same interface as database.ConnectionPool, with a single FakeConnection.
+    """
+
+    def __init__(self, catalog):
+        # Statement names, as in "EXECUTE read_history", back to catalog names.
+        queries = {query['statement']: name for (name, query) in catalog.statements.items()}
+        self.conn = FakeConnection(queries)
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self.conn
+
+    def stats(self):
+        return {'size': 1, 'idle': 1, 'in_use': 0, 'waiting': 0}
+
+
+def build():
+    """The CRUD and a falcon.testing client of the app of "src/main.py", both
+    over a FakePool.
+    """
+    catalog = QueryCatalog()
+    crud = TituloTesouroCRUD(FakePool(catalog), catalog)
+
+    app = falcon.API()
+    app.req_options.strip_url_path_trailing_slash = True
+    app.add_middleware(MetricsMiddleware(crud))
+    app.add_middleware(AccessLogMiddleware())
+    EndpointExpositor(app, crud).expose()
+
+    return (crud, falcon.testing.TestClient(app))
+
+
+def cases(crud, client):
+    interval = {'data_inicio': '2006-01', 'data_fim': '2016-04'}
+    grouped = dict(interval, group_by='true')
+    record = {'categoria_titulo': 'NTN-B', 'mês': 5, 'ano': 2030, 'ação': 'venda', 'valor': 1234.5}
+    batch = [dict(record, ano=2030 + i // 12, **{'mês': i % 12 + 1}) for i in range(100)]
+
+    return {
+        'crud.read_history': lambda: crud.read_history('1', interval),
+        'crud.read_history.grouped': lambda: crud.read_history('1', grouped),
+        'crud.read_history.page': lambda: crud.read_history('1', dict(interval, limit='12')),
+        'crud.stream_history': lambda: [rows for rows in crud.stream_history('1', interval)['historico']],
+        'crud.read_by_action': lambda: crud.read_by_action('1', 'venda', interval),
+        'crud.read_by_action.grouped': lambda: crud.read_by_action('1', 'venda', grouped),
+        'crud.compare': lambda: crud.compare(dict(interval, ids=['1', '2', '3'])),
+        'crud.compare.grouped': lambda: crud.compare(dict(grouped, ids=['1', '2', '3'])),
+        'crud.data_version': lambda: crud.data_version(['1']),
+        'crud.create': lambda: crud.create('NTN-B', 5, 2030, 'venda', 1234.5),
+        'crud.create_many': lambda: crud.create_many(batch),
+        'crud.update': lambda: crud.update('1', {'valor': 1234.5}),
+        'crud.update_many': lambda: crud.update_many({'ids': list(range(1, 101)), 'valor': 1234.5}),
+        'crud.delete': lambda: crud.delete('1'),
+        'crud.delete_many': lambda: crud.delete_many({'ids': list(range(1, 101))}),
+        'http.get_history': lambda: client.simulate_get('/titulo_tesouro/1', params=interval),
+        'http.get_history.grouped': lambda: client.simulate_get('/titulo_tesouro/1', params=grouped),
+        'http.get_history.page': lambda: client.simulate_get('/titulo_tesouro/1', params=dict(interval, limit='12')),
+        'http.get_venda': lambda: client.simulate_get('/titulo_tesouro/venda/1', params=interval),
+        'http.get_compare': lambda: client.simulate_get('/titulo_tesouro/comparar',
+                                                        params=dict(interval, ids=['1', '2', '3'])),
+        'http.post': lambda: client.simulate_post('/titulo_tesouro', json=record),
+        'http.put': lambda: client.simulate_put('/titulo_tesouro/1', json={'valor': 1234.5}),
+        'http.delete': lambda: client.simulate_delete('/titulo_tesouro/1')
+    }
+
+
+def measure(call, number, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return round(best / number * 1000000, 1)
+
+
+def check(call):
+    """The cases must succeed, or the error paths would be timed instead.
+    """
+    result = call()
+    if isinstance(result, falcon.testing.Result):
+        assert result.status_code < 400, '{} {}'.format(result.status, result.text)
+    else:
+        assert result, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=200, help='Calls per round.')
+    parser.add_argument('--repeat', type=int, default=5, help='Rounds, the best is kept.')
+    parser.add_argument('--only', help='Only the cases whose name starts with this.')
+    parser.add_argument('--baseline', help='Report to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--save-baseline', help='Where to store this report.')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    warnings.simplefilter('ignore', falcon.util.deprecation.DeprecatedWarning)
+
+    (crud, client) = build()
+    report = {'us_per_call': dict()}
+
+    for (name, call) in cases(crud, client).items():
+        if args.only and not name.startswith(args.only):
+            continue
+
+        check(call)
+        report['us_per_call'][name] = measure(call, args.number, args.repeat)
+
+    regressions = list()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['us_per_call']
+
+        report['ratio_to_baseline'] = {name: round(us / baseline[name], 3)
+                                       for (name, us) in report['us_per_call'].items() if baseline.get(name)}
+        regressions = ['{}: {} of the baseline'.format(name, ratio)
+                       for (name, ratio) in report['ratio_to_baseline'].items() if ratio > 1 + args.tolerance]
+        report['regressions'] = regressions
+
+    print(json.dumps(report, indent=4))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'us_per_call': report['us_per_call']}, f, indent=4)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""Compares the WSGI app ("src/main.py" under sync gunicorn workers) with the
+ASGI app ("src/asgi.py" under uvicorn) at high concurrency.
+
+Each server is started with the same number of workers, then "--concurrency"
+clients, each with its own keep-alive connection, request the history of
+random ids for "--duration" seconds. Reports, for each server, the requests
+per second, the latency percentiles and the errors. Needs a loaded database
+(see "main-db.sh").
+
+    python3 src/bench_serving.py [--workers N] [--concurrency N] [--duration S]
+"""
+
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+
+SERVERS = {
+    'wsgi': ['gunicorn', 'src.main', '--bind', '127.0.0.1:{port}', '--workers', '{workers}'],
+    'asgi': ['python3', 'src/asgi.py', '--port', '{port}', '--workers', '{workers}']
+}
+
+
+class HTTPClient(object):
+    """Minimal HTTP/1.1 client over asyncio streams, enough to keep thousands
+    of connections busy from a single process. Reconnects when the server
+    closes the connection, as gunicorn's sync workers do after each response.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def _connect(self):
+        (self.reader, self.writer) = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def get(self, path):
+        return await self.request('GET', path)
+
+    async def request(self, method, path, body=None):
+        """Sends "body", bytes, if any. Returns the status and the length of
+        the response body.
+        """
+        if self.writer is None:
+            await self._connect()
+
+        head = '{} {} HTTP/1.1\r\nHost: {}\r\n'.format(method, path, self.host)
+        if body is not None:
+            head += 'Content-Type: application/json\r\nContent-Length: {}\r\n'.format(len(body))
+        self.writer.write((head + '\r\n').encode('latin1') + (body or b''))
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = dict()
+        while True:
+            line = (await self.reader.readline()).decode('latin1').strip()
+            if not line:
+                break
+            (name, _, value) = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding') == 'chunked':
+            length = 0
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                length += size
+                if size == 0:
+                    break
+        else:
+            length = int(headers.get('content-length', 0))
+            await self.reader.readexactly(length)
+
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+
+        return (status, length)
+
+
+async def client(port, ids, deadline, latencies, errors):
+    http = HTTPClient('127.0.0.1', port)
+
+    while time.monotonic() < deadline:
+        path = '/titulo_tesouro/{}'.format(random.choice(ids))
+        start = time.perf_counter()
+        try:
+            (status, _) = await http.get(path)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            http.close()
+            errors.append('connection')
+            continue
+
+        if status == 200:
+            latencies.append((time.perf_counter() - start) * 1000)
+        else:
+            errors.append(status)
+
+    http.close()
+
+
+async def load(port, ids, concurrency, duration):
+    latencies = list()
+    errors = list()
+    deadline = time.monotonic() + duration
+
+    start = time.monotonic()
+    await asyncio.gather(*[client(port, ids, deadline, latencies, errors) for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    percentile = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 2)
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'latency_ms_mean': round(statistics.mean(latencies), 2) if latencies else None,
+        'latency_ms_p50': percentile(0.50) if latencies else None,
+        'latency_ms_p95': percentile(0.95) if latencies else None,
+        'latency_ms_p99': percentile(0.99) if latencies else None
+    }
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen('http://127.0.0.1:{}/'.format(port), timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Server on port {} did not start.'.format(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--ids', type=int, default=300, help='Requests go to ids 1..N.')
+    args = parser.parse_args()
+
+    ids = list(range(1, args.ids + 1))
+    report = dict()
+
+    for (name, command) in SERVERS.items():
+        command = [part.format(port=args.port, workers=args.workers) for part in command]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        try:
+            wait_until_up(args.port)
+            report[name] = asyncio.run(load(args.port, ids, args.concurrency, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+    report['rps_ratio_asgi_wsgi'] = round(report['asgi']['rps'] / report['wsgi']['rps'], 2)
+
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
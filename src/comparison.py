@@ -0,0 +1,79 @@
+import numpy
+
+
+def month_key(year, month):
+    """Months since year 0, so that consecutive months have consecutive keys.
+    """
+    return year * 12 + month - 1
+
+
+class ComparisonMatrix(object):
+    """Several series aligned by month: one column per series and one row per
+    month, from the first to the last month that has a value in any of them.
+    "present" masks the cells that have a value; the others hold 0.
+
+    Built either from (column, month key, amount) cells, as returned by
+    "compare.sql", or from the dense slices of the SeriesEngine. Yearly sums,
+    totals and differences are computed on the whole matrix at once.
+    """
+
+    def __init__(self, first, amounts, present):
+        rows = numpy.flatnonzero(present.any(axis=1))
+        (start, end) = (rows[0], rows[-1] + 1) if rows.size else (0, 0)
+
+        self.first = int(first + start)
+        self.present = present[start:end]
+        self.amounts = numpy.where(self.present, amounts[start:end], 0.0)
+
+    @classmethod
+    def from_cells(cls, columns, months, amounts, width):
+        columns = numpy.asarray(columns, dtype=numpy.int64)
+        months = numpy.asarray(months, dtype=numpy.int64)
+
+        first = int(months.min()) if months.size else 0
+        size = int(months.max()) - first + 1 if months.size else 0
+
+        matrix = numpy.zeros((size, width), dtype=numpy.float64)
+        present = numpy.zeros((size, width), dtype=numpy.bool_)
+        matrix[months - first, columns] = numpy.asarray(amounts, dtype=numpy.float64)
+        present[months - first, columns] = True
+
+        return cls(first, matrix, present)
+
+    def _keys(self):
+        return numpy.arange(self.first, self.first + len(self.amounts))
+
+    def monthly(self):
+        """Returns the (year, month) of each row, the amounts and the mask.
+        """
+        keys = self._keys()
+        return (list(zip((keys // 12).tolist(), (keys % 12 + 1).tolist())), self.amounts, self.present)
+
+    def yearly(self):
+        """Returns the years, the sums of each column by year and the mask of
+        the sums that have at least one month.
+        """
+        if not len(self.amounts):
+            return (list(), self.amounts, self.present)
+
+        keys = self._keys()
+        starts = numpy.flatnonzero(keys % 12 == 0)
+        if starts.size == 0 or starts[0] != 0:
+            starts = numpy.concatenate(([0], starts))
+
+        sums = numpy.add.reduceat(self.amounts, starts, axis=0)
+        counts = numpy.add.reduceat(self.present.astype(numpy.int64), starts, axis=0)
+
+        return ((keys[starts] // 12).tolist(), sums, counts > 0)
+
+    def totals(self):
+        """Returns the sum of each column and the mask of the non-empty ones,
+        as matrices of a single row.
+        """
+        return (self.amounts.sum(axis=0, keepdims=True), self.present.any(axis=0, keepdims=True))
+
+    @staticmethod
+    def differences(amounts, present):
+        """Each column minus the first one, where both have a value.
+        """
+        return (amounts - amounts[:, :1], present & present[:, :1])
@@ -0,0 +1,234 @@
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection could be checked out of the pool in time.
+    """
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of PostgreSQL connections.
+
+    The pool is meant to live for the life of a gunicorn worker: connections
+    are opened lazily on first use and, if the process forks (e.g. gunicorn
+    with "--preload"), the child discards the inherited ones and opens its own.
+    Idle connections are health checked on checkout and replaced when the
+    server went away, so the service recovers by itself after a Postgres
+    restart.
+    """
+
+    def __init__(self, database_params, min_size=1, max_size=10, timeout=30.0,
+                 health_check_interval=5.0, on_connect=None):
+        assert 0 <= min_size <= max_size, '"min_size" must be in interval [0, max_size].'
+        assert max_size > 0, '"max_size" must be greater than zero.'
+
+        self.database_params = database_params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.on_connect = on_connect
+
+        self._condition = threading.Condition()
+        self._idle = collections.deque()
+        self._in_use = set()
+        self._pid = None
+
+        self._waiting = 0
+        self._counters = collections.Counter()
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.database_params)
+        self._counters['connections_opened'] += 1
+
+        if self.on_connect is not None:
+            self.on_connect(conn)
+            conn.commit()
+
+        return conn
+
+    def _close(self, conn):
+        self._counters['connections_closed'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _check_process(self):
+        """Drops connections inherited from a parent process. They share the
+        socket with the parent, so they are forgotten rather than closed.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        if self._pid is not None:
+            logging.info('Connection pool forked, discarding {} inherited connections.'.format(
+                len(self._idle) + len(self._in_use)))
+
+        self._pid = pid
+        self._idle.clear()
+        self._in_use.clear()
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        self._counters['health_checks'] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use)
+
+    def _fill(self):
+        while self._size() < self.min_size:
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def getconn(self):
+        """Checks out a healthy connection, waiting up to "timeout" seconds
+        for one to be returned when the pool is saturated.
+        """
+        deadline = time.monotonic() + self.timeout
+
+        with self._condition:
+            self._check_process()
+            self._fill()
+            self._counters['checkouts'] += 1
+
+            waited = False
+            while True:
+                while self._idle:
+                    (conn, idle_since) = self._idle.pop()
+
+                    if self._is_healthy(conn, idle_since):
+                        self._in_use.add(conn)
+                        return conn
+
+                    logging.warning('Discarding broken database connection.')
+                    self._counters['reconnects'] += 1
+                    self._close(conn)
+
+                if self._size() < self.max_size:
+                    conn = self._connect()
+                    self._in_use.add(conn)
+                    return conn
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeoutError('No database connection available after {} seconds.'.format(
+                        self.timeout))
+
+                if not waited:
+                    self._counters['waits'] += 1
+                    waited = True
+
+                self._waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+    def putconn(self, conn, discard=False):
+        """Returns a connection to the pool. Broken connections, or those
+        explicitly discarded, are closed instead of reused.
+        """
+        with self._condition:
+            if conn not in self._in_use:
+                # Checked out before a fork, or already returned.
+                return
+            self._in_use.remove(conn)
+
+            if not discard and not conn.closed:
+                try:
+                    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            else:
+                discard = True
+
+            if discard:
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrows a connection for the duration of the block. The transaction
+        is committed when the block succeeds and rolled back otherwise.
+        """
+        conn = self.getconn()
+        discard = False
+
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def backend_pids(self):
+        """Process ids, on the server, of the open connections of the pool.
+        """
+        with self._condition:
+            self._check_process()
+            conns = [conn for (conn, _) in self._idle] + list(self._in_use)
+            return {conn.info.backend_pid for conn in conns if not conn.closed}
+
+    def stats(self):
+        """Returns a snapshot of the pool occupation and its lifetime counters.
+        """
+        with self._condition:
+            in_use = len(self._in_use)
+
+            stats = {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size(),
+                'idle': len(self._idle),
+                'in_use': in_use,
+                'waiting': self._waiting,
+                'saturation': round(in_use / self.max_size, 4)
+            }
+
+            for name in ('checkouts', 'waits', 'timeouts', 'health_checks', 'reconnects',
+                         'connections_opened', 'connections_closed'):
+                stats[name] = self._counters[name]
+
+        return stats
+
+    def close(self):
+        with self._condition:
+            self._check_process()
+            while self._idle:
+                (conn, _) = self._idle.pop()
+                self._close(conn)
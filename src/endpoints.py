@@ -1,6 +1,16 @@
+import datetime
 import falcon
+import falcon.util
 import json
 import logging
+import os
+import time
+
+from src import metrics
+from src.basics import PAYLOAD_LOG_RATE, PAYLOAD_LOG_MAX_SIZE, TITULO_TESOURO_CATEGORIES, SLOW_QUERY_ENDPOINT_ENABLED
+from src.basics import EVENT_STREAM_QUEUE_SIZE, EVENT_STREAM_HEARTBEAT_INTERVAL, EVENT_STREAM_MAX_DURATION
+from src.logs import PayloadLog
+from src.notifications import Subscription
 
 
 class EndpointExpositor(object):
@@ -9,24 +19,41 @@ class EndpointExpositor(object):
     for metadata are all others.
     """
 
-    def __init__(self, falcon_api, titulo_tesouro_crud):
+    def __init__(self, falcon_api, titulo_tesouro_crud, change_feed=None):
         self.falcon_api = falcon_api
 
-        titulo_tesouro_request_handler = TituloTesouroRequestHandler(titulo_tesouro_crud)
-        titulo_tesouro_compare_request_handler = TituloTesouroCompareRequestHandler(titulo_tesouro_crud)
-        titulo_tesouro_by_action_request_handler = TituloTesouroByActionRequestHandler(titulo_tesouro_crud)
+        (help_class, metrics_class, slow_query_class, titulo_tesouro_class, compare_class, by_action_class,
+         events_class, changes_class) = self.request_handler_classes()
+
+        titulo_tesouro_request_handler = titulo_tesouro_class(titulo_tesouro_crud)
+        titulo_tesouro_compare_request_handler = compare_class(titulo_tesouro_crud)
+        titulo_tesouro_by_action_request_handler = by_action_class(titulo_tesouro_crud)
 
         self.endpoint_mapping = {
             '/': None,
+            '/metrics': metrics_class(),
             '/titulo_tesouro': titulo_tesouro_request_handler,
             '/titulo_tesouro/{titulo_id}': titulo_tesouro_request_handler,
-            '/titulo_tesouro/comparar/': titulo_tesouro_compare_request_handler,
+            '/titulo_tesouro/comparar': titulo_tesouro_compare_request_handler,
+            '/titulo_tesouro/changes': changes_class(titulo_tesouro_crud),
             '/titulo_tesouro/venda/{titulo_id}': titulo_tesouro_by_action_request_handler,
             '/titulo_tesouro/resgate/{titulo_id}': titulo_tesouro_by_action_request_handler
         }
 
+        # The slow queries carry their parameters, i.e. data of the requests,
+        # so they are only exposed when asked for.
+        if SLOW_QUERY_ENDPOINT_ENABLED:
+            self.endpoint_mapping['/admin/consultas_lentas'] = slow_query_class(titulo_tesouro_crud)
+        if change_feed is not None:
+            self.endpoint_mapping['/titulo_tesouro/eventos'] = events_class(change_feed)
+
         endpoints = list(self.endpoint_mapping.keys())
-        self.endpoint_mapping['/'] = HelpRequestHandler(endpoints)
+        self.endpoint_mapping['/'] = help_class(endpoints, titulo_tesouro_crud)
+
+    def request_handler_classes(self):
+        return (HelpRequestHandler, MetricsRequestHandler, SlowQueryRequestHandler, TituloTesouroRequestHandler,
+                TituloTesouroCompareRequestHandler, TituloTesouroByActionRequestHandler,
+                TituloTesouroEventsRequestHandler, TituloTesouroChangesRequestHandler)
 
     def expose(self):
         for (endpoint, handler) in self.endpoint_mapping.items():
@@ -38,23 +65,63 @@ class EndpointExpositor(object):
 
 class RequestHandler(object):
     """Superclass for all request handlers.
+
+    Each request gets one line in the access log (see AccessLogMiddleware);
+    the bodies of a sample of the responses go to "payload_log".
     """
 
+    payload_log = PayloadLog(PAYLOAD_LOG_RATE, PAYLOAD_LOG_MAX_SIZE)
+
     def on_post(self, req, resp):
-        logging.info('POST request received at endpoint "{}"'.format(req.path))
+        logging.debug('POST request received at endpoint "%s"', req.path)
 
     def on_delete(self, req, resp):
-        logging.info('DELETE request received at endpoint "{}"'.format(req.path))
+        logging.debug('DELETE request received at endpoint "%s"', req.path)
 
     def on_put(self, req, resp):
-        logging.info('PUT request received at endpoint "{}"'.format(req.path))
+        logging.debug('PUT request received at endpoint "%s"', req.path)
+
+    def on_patch(self, req, resp):
+        logging.debug('PATCH request received at endpoint "%s"', req.path)
 
     def on_get(self, req, resp):
-        logging.info('GET request received at endpoint "{}"'.format(req.path))
+        logging.debug('GET request received at endpoint "%s"', req.path)
 
     def set_response_status_code(self, resp, code):
         resp.status = getattr(falcon, 'HTTP_{}'.format(code))
-        logging.info('Response status code: {}\n'.format(resp.status))
+        logging.debug('Response status code: %s', resp.status)
+
+    def not_modified(self, req, resp, version):
+        """Sets "ETag" and "Last-Modified" from the data "version", a pair
+        (version, updated_at). Answers 304 and returns True when the client
+        already has this version, so the caller can skip the queries.
+        """
+        if version is None:
+            return False
+
+        etag = '"{}"'.format(version[0])
+        last_modified = version[1].astimezone(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+
+        resp.set_header('ETag', etag)
+        resp.last_modified = last_modified
+
+        if_none_match = req.get_header('If-None-Match')
+        if_modified_since = req.get_header('If-Modified-Since')
+
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            matches = '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        elif if_modified_since is not None:
+            try:
+                matches = last_modified <= falcon.util.http_date_to_dt(if_modified_since).replace(tzinfo=None)
+            except ValueError:
+                matches = False
+        else:
+            matches = False
+
+        if matches:
+            self.set_response_status_code(resp, 304)
+        return matches
 
     def err_bad_request(self, resp, message):
         logging.error(message)
@@ -72,42 +139,211 @@ class RequestHandler(object):
         })
         self.set_response_status_code(resp, 404)
 
-    def ok(self, resp, message):
-        logging.info(message)
-
+    def ok(self, resp, message, store=None):
+        """"store", if any, receives the encoded body (see "cache_store").
+        """
         resp.body = json.dumps({
             'success': message
         })
         self.set_response_status_code(resp, 200)
+        self.payload_log.log(resp.status, resp.text)
 
-    def created(self, resp, message):
-        logging.info(message)
+        if store is not None:
+            store(resp.text.encode('utf8'))
+
+    def paginated(self, req):
+        return 'limit' in req.params or 'cursor' in req.params
+
+    def ok_page(self, req, resp, message, store=None):
+        """Same as "ok", with the cursor in "message['next']" replaced by the
+        path and query string of the next page.
+        """
+        if message['next'] is not None:
+            message['next'] = req.path + falcon.to_query_str(dict(req.params, cursor=message['next']))
+
+        self.ok(resp, message, store)
+
+    def ok_stream(self, resp, message, key, store=None):
+        """Same body as "ok", but "message[key]", an iterator over lists of
+        rows, is encoded and sent one list at a time through "resp.stream".
+        "store", if any, receives the whole body once it was all sent.
+        """
+        (head, chunks, tail) = self._stream_frame(message, key)
+
+        def body():
+            parts = [head]
+            yield head
+
+            separator = b''
+            for rows in chunks:
+                if rows:
+                    parts.append(separator + self._encode_rows(rows))
+                    yield parts[-1]
+                    separator = b', '
+
+            yield tail
+
+            if store is not None:
+                parts.append(tail)
+                store(b''.join(parts))
 
+        resp.stream = body()
+        self.set_response_status_code(resp, 200)
+
+    def from_cache(self, resp, cache_key, version):
+        """Answers with the body the ResponseCache of the CRUD has for
+        "cache_key" at the data "version", if any.
+        """
+        cache = self.titulo_tesouro_crud.response_cache
+        if cache is None or cache_key is None or version is None:
+            return False
+
+        body = cache.get(cache_key, version)
+        if body is None:
+            return False
+
+        resp.data = body
+        self.set_response_status_code(resp, 200)
+        return True
+
+    def cache_store(self, cache_key, version, categories, generation=None):
+        """Function storing a body for "cache_key" at "version" in the
+        ResponseCache of the CRUD, None if there is nothing to store. The body
+        is not stored if the series engine left "generation" meanwhile (see
+        "rendered_version").
+        """
+        cache = self.titulo_tesouro_crud.response_cache
+        if cache is None or cache_key is None or version is None:
+            return None
+
+        crud = self.titulo_tesouro_crud
+        return lambda body: cache.put(cache_key, version, categories, body,
+                                      lambda: crud.engine_generation() == generation)
+
+    def rendered_version(self, resp, version, generation):
+        """The data "version" of a body just rendered, with "generation" the
+        one of the series engine of the CRUD read before "version". None when
+        the engine was invalidated since: it may have answered with data older
+        than "version", so the "ETag" and "Last-Modified" set by
+        "not_modified" are dropped and the body must not be cached.
+        """
+        if self.titulo_tesouro_crud.engine_generation() == generation:
+            return version
+
+        resp.delete_header('ETag')
+        resp.delete_header('Last-Modified')
+        return None
+
+    def _stream_frame(self, message, key):
+        """Splits the body of "ok" around the list "message[key]". Returns the
+        encoded text before and after the list, and the list's chunks.
+        """
+        logging.debug('Streaming "%s" of %s', key, {k: v for (k, v) in message.items() if k != key})
+
+        chunks = message[key]
+        message = dict(message)
+        message[key] = list()
+
+        # "key" is the last one of "message", so the body ends with "[]}}".
+        text = json.dumps({
+            'success': message
+        })
+
+        return (text[:-3].encode('utf8'), chunks, text[-3:].encode('utf8'))
+
+    def _encode_rows(self, rows):
+        return ', '.join(json.dumps(row) for row in rows).encode('utf8')
+
+    def created(self, resp, message):
         resp.body = json.dumps({
             'success': message
         })
         self.set_response_status_code(resp, 201)
+        self.payload_log.log(resp.status, resp.text)
+
+    def batch(self, resp, successes, errors, success_code=200):
+        """Per-item outcome of a batch request: "success_code" if every item
+        succeeded, 207 if only some did and 400 if none did.
+        """
+        if errors:
+            logging.error('%d items of the batch failed.', len(errors))
+
+        resp.body = json.dumps({
+            'success': successes,
+            'err': errors
+        })
+
+        if not errors:
+            self.set_response_status_code(resp, success_code)
+        elif successes:
+            self.set_response_status_code(resp, 207)
+        else:
+            self.set_response_status_code(resp, 400)
+
+        self.payload_log.log(resp.status, resp.text)
 
 
 class HelpRequestHandler(RequestHandler):
     """Checks system health and provides instructions.
     """
 
-    def __init__(self, endpoints):
+    def __init__(self, endpoints, titulo_tesouro_crud):
         super(HelpRequestHandler, self).__init__()
 
         self.endpoints = endpoints
+        self.titulo_tesouro_crud = titulo_tesouro_crud
 
     def on_get(self, req, resp):
         super(HelpRequestHandler, self).on_get(req, resp)
 
-        resp.body = 'System healthy. \nEndpoints: {}'.format(self.endpoints)
+        cache = self.titulo_tesouro_crud.response_cache
+        resp.body = 'System healthy. \nEndpoints: {}\nConnection pool: {}\nResponse cache: {}'.format(
+            self.endpoints, self.titulo_tesouro_crud.pool_stats(), cache.stats() if cache is not None else None)
+
+        self.set_response_status_code(resp, 200)
+
+
+class MetricsRequestHandler(RequestHandler):
+    """Latencies, responses and pool occupation of all workers, in the
+    Prometheus text format.
+    """
+
+    def on_get(self, req, resp):
+        resp.content_type = metrics.prometheus_client.CONTENT_TYPE_LATEST
+        resp.data = metrics.render()
 
         self.set_response_status_code(resp, 200)
 
 
+class SlowQueryRequestHandler(RequestHandler):
+    """Queries this worker found slow, most recent first, with the plans
+    sampled by the SlowQueryLog.
+    """
+
+    def __init__(self, titulo_tesouro_crud):
+        super(SlowQueryRequestHandler, self).__init__()
+
+        self.slow_query_log = titulo_tesouro_crud.slow_query_log
+
+    def report(self):
+        return {
+            'pid': os.getpid(),
+            'limite_ms': self.slow_query_log.threshold_ms,
+            'taxa_explain': self.slow_query_log.explain_rate,
+            'consultas': self.slow_query_log.entries()
+        }
+
+    def on_get(self, req, resp):
+        super(SlowQueryRequestHandler, self).on_get(req, resp)
+
+        self.ok(resp, self.report())
+
+
 class TituloTesouroRequestHandler(RequestHandler):
-    """Handler for POST in endpoint "titulo_tesouro".
+    """Handler for POST in endpoint "titulo_tesouro". The body of a POST may
+    also be a list of records, created in a single batch. PATCH and DELETE on
+    "titulo_tesouro" update and delete, in bulk, the records selected by a list
+    of "ids" or by a "filtro".
     """
 
     def __init__(self, titulo_tesouro_crud):
@@ -135,6 +371,10 @@ class TituloTesouroRequestHandler(RequestHandler):
         stream = req.bounded_stream.read().decode('utf8')
         body = json.loads(stream)
 
+        if isinstance(body, list):
+            self._post_batch(req, resp, body)
+            return
+
         missing_fields = self._check_missing_fields(body)
         if missing_fields:
             self.err_bad_request(resp, 'Mandatory fields {} missing.'.format(missing_fields))
@@ -148,9 +388,68 @@ class TituloTesouroRequestHandler(RequestHandler):
         except Exception as e:
             self.err_bad_request(resp, str(e))
 
-    def on_delete(self, req, resp, titulo_id):
+    def _post_batch(self, req, resp, body):
+        kwargs = dict()
+        if 'on_error' in req.params:
+            kwargs['on_error'] = req.params['on_error']
+
+        try:
+            (created, errors) = self.titulo_tesouro_crud.create_many(body, **kwargs)
+
+            self.batch(resp, created, errors, success_code=201)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    def _read_bulk_body(self, req, resp):
+        if not req.content_length:
+            self.err_bad_request(resp, 'No request body.')
+            return None
+
+        stream = req.bounded_stream.read().decode('utf8')
+        body = json.loads(stream)
+
+        if not body:
+            self.err_bad_request(resp, 'Empty request body.')
+            return None
+
+        return body
+
+    def on_patch(self, req, resp, titulo_id=None):
+        super(TituloTesouroRequestHandler, self).on_patch(req, resp)
+
+        if titulo_id is not None:
+            raise falcon.HTTPMethodNotAllowed(['DELETE', 'GET', 'PUT'])
+
+        body = self._read_bulk_body(req, resp)
+        if body is None:
+            return
+
+        try:
+            ret = self.titulo_tesouro_crud.update_many(body)
+
+            self.ok(resp, ret)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    def _delete_many(self, req, resp):
+        body = self._read_bulk_body(req, resp)
+        if body is None:
+            return
+
+        try:
+            ret = self.titulo_tesouro_crud.delete_many(body)
+
+            self.ok(resp, ret)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+    def on_delete(self, req, resp, titulo_id=None):
         super(TituloTesouroRequestHandler, self).on_delete(req, resp)
 
+        if titulo_id is None:
+            self._delete_many(req, resp)
+            return
+
         try:
             ret = self.titulo_tesouro_crud.delete(titulo_id)
 
@@ -192,10 +491,26 @@ class TituloTesouroRequestHandler(RequestHandler):
         params = req.params
 
         try:
-            ret = self.titulo_tesouro_crud.read_history(titulo_id, params)
+            generation = self.titulo_tesouro_crud.engine_generation()
+            version = self.titulo_tesouro_crud.data_version([titulo_id])
+            if self.not_modified(req, resp, version):
+                return
 
-            if ret:
-                self.ok(resp, ret)
+            cache_key = self.titulo_tesouro_crud.response_key('historico', titulo_id, params)
+            if self.from_cache(resp, cache_key, version):
+                return
+
+            if self.paginated(req):
+                ret = self.titulo_tesouro_crud.read_history(titulo_id, params)
+            else:
+                ret = self.titulo_tesouro_crud.stream_history(titulo_id, params)
+
+            version = self.rendered_version(resp, version, generation)
+            store = self.cache_store(cache_key, version, [ret['categoria_titulo']], generation) if ret else None
+            if ret and self.paginated(req):
+                self.ok_page(req, resp, ret, store)
+            elif ret:
+                self.ok_stream(resp, ret, 'historico', store)
             else:
                 self.err_not_found(resp, '"titulo_id" has no register.')
         except Exception as e:
@@ -203,7 +518,7 @@ class TituloTesouroRequestHandler(RequestHandler):
 
 
 class TituloTesouroCompareRequestHandler(RequestHandler):
-    """Handler for POST in endpoint "titulo_tesouro/comparar".
+    """Handler for GET in endpoint "titulo_tesouro/comparar".
     """
 
     def __init__(self, titulo_tesouro_crud):
@@ -217,16 +532,49 @@ class TituloTesouroCompareRequestHandler(RequestHandler):
         params = req.params
 
         try:
+            ids = params.get('ids', list())
+            generation = self.titulo_tesouro_crud.engine_generation()
+            version = self.titulo_tesouro_crud.data_version(ids) if isinstance(ids, list) else None
+            if self.not_modified(req, resp, version):
+                return
+
+            cache_key = self.titulo_tesouro_crud.response_key('comparar', None, params)
+            if self.from_cache(resp, cache_key, version):
+                return
+
             ret = self.titulo_tesouro_crud.compare(params)
+            version = self.rendered_version(resp, version, generation)
 
             if ret:
-                self.ok(resp, ret)
+                self.ok(resp, ret, self.cache_store(cache_key, version,
+                                                    [series['categoria_titulo'] for series in ret['series']],
+                                                    generation))
             else:
                 self.err_not_found(resp, 'One of the ids was not found.')
         except Exception as e:
             self.err_bad_request(resp, str(e))
 
 
+class TituloTesouroChangesRequestHandler(RequestHandler):
+    """Handler for GET in endpoint "titulo_tesouro/changes": the changes logged
+    after the watermark "since", in batches of up to "limit", for clients that
+    keep a copy of the records in sync.
+    """
+
+    def __init__(self, titulo_tesouro_crud):
+        super(TituloTesouroChangesRequestHandler, self).__init__()
+
+        self.titulo_tesouro_crud = titulo_tesouro_crud
+
+    def on_get(self, req, resp):
+        super(TituloTesouroChangesRequestHandler, self).on_get(req, resp)
+
+        try:
+            self.ok(resp, self.titulo_tesouro_crud.read_changes(req.params))
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+
+
 class TituloTesouroByActionRequestHandler(RequestHandler):
     """Handler for POST in endpoints "titulo_tesouro/venda" and "titulo_tesouro/resgate".
     """
@@ -243,11 +591,95 @@ class TituloTesouroByActionRequestHandler(RequestHandler):
         params = req.params
 
         try:
-            ret = self.titulo_tesouro_crud.read_by_action(titulo_id, action, params)
+            generation = self.titulo_tesouro_crud.engine_generation()
+            version = self.titulo_tesouro_crud.data_version([titulo_id])
+            if self.not_modified(req, resp, version):
+                return
 
-            if ret:
-                self.ok(resp, ret)
+            cache_key = self.titulo_tesouro_crud.response_key(action, titulo_id, params)
+            if self.from_cache(resp, cache_key, version):
+                return
+
+            if self.paginated(req):
+                ret = self.titulo_tesouro_crud.read_by_action(titulo_id, action, params)
+            else:
+                ret = self.titulo_tesouro_crud.stream_by_action(titulo_id, action, params)
+
+            version = self.rendered_version(resp, version, generation)
+            store = self.cache_store(cache_key, version, [ret['categoria_titulo']], generation) if ret else None
+            if ret and self.paginated(req):
+                self.ok_page(req, resp, ret, store)
+            elif ret:
+                self.ok_stream(resp, ret, 'valores_{}'.format(action), store)
             else:
                 self.err_not_found(resp, '"titulo_id" has no register for action "{}".'.format(action))
         except Exception as e:
             self.err_bad_request(resp, str(e))
+
+
+class TituloTesouroEventsRequestHandler(RequestHandler):
+    """Handler for GET in endpoint "titulo_tesouro/eventos": the changes to the
+    records, as notified by the database, in the Server-Sent Events format.
+    One event per notification, i.e. per statement and category and action it
+    changed, named after its "op", with the event as data. The
+    query parameter "categoria_titulo" keeps only the changes of the given
+    categories.
+
+    A comment is sent every EVENT_STREAM_HEARTBEAT_INTERVAL seconds without
+    changes. The stream ends after EVENT_STREAM_MAX_DURATION seconds, or as
+    soon as the client falls EVENT_STREAM_QUEUE_SIZE events behind, and the
+    client connects again after "retry_ms".
+    """
+
+    retry_ms = 1000
+
+    def __init__(self, change_feed):
+        super(TituloTesouroEventsRequestHandler, self).__init__()
+
+        self.change_feed = change_feed
+
+    def _subscription(self, req, subscription_class):
+        categories = req.get_param_as_list('categoria_titulo') or list()
+        for category in categories:
+            assert category in TITULO_TESOURO_CATEGORIES, \
+                '"categoria_titulo" must be one of {}.'.format(TITULO_TESOURO_CATEGORIES)
+
+        return subscription_class(EVENT_STREAM_QUEUE_SIZE, categories)
+
+    def _encode(self, event):
+        return 'event: {}\ndata: {}\n\n'.format(event['op'], json.dumps(event)).encode('utf8')
+
+    def _start_stream(self, resp):
+        resp.content_type = 'text/event-stream'
+        resp.cache_control = ['no-cache']
+        self.set_response_status_code(resp, 200)
+
+    def on_get(self, req, resp):
+        super(TituloTesouroEventsRequestHandler, self).on_get(req, resp)
+
+        try:
+            subscription = self._subscription(req, Subscription)
+        except Exception as e:
+            self.err_bad_request(resp, str(e))
+            return
+
+        def events():
+            # Subscribed once the server asks for the body, so that a response
+            # that is never sent leaves no subscriber behind.
+            self.change_feed.subscribe(subscription)
+            try:
+                yield 'retry: {}\n\n'.format(self.retry_ms).encode('utf8')
+
+                deadline = time.monotonic() + EVENT_STREAM_MAX_DURATION
+                while not subscription.overflowed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    event = subscription.get(min(remaining, EVENT_STREAM_HEARTBEAT_INTERVAL))
+                    yield self._encode(event) if event is not None else b': keep-alive\n\n'
+            finally:
+                self.change_feed.unsubscribe(subscription)
+
+        resp.stream = events()
+        self._start_stream(resp)
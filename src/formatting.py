@@ -0,0 +1,66 @@
+import decimal
+import re
+
+from babel.core import Locale
+from babel.numbers import LC_MONETARY, format_currency, get_currency_precision, get_currency_symbol
+from babel.numbers import get_decimal_symbol, get_group_symbol
+
+
+class CurrencyFormatter(object):
+    """Formats amounts exactly as babel's "format_currency(value, currency)",
+    with the same default locale, but resolves the locale, the pattern and the
+    symbols once instead of on every call.
+
+    Values are converted to Decimal through "str", rounded half to even to the
+    precision of the currency and formatted with the "," and "." of the Decimal
+    format spec, then translated to the symbols of the locale. Patterns this
+    shortcut does not cover (scientific, significant digits, scaled, grouped
+    other than by three or with quotes in the symbols) and non-finite values
+    are left to babel.
+    """
+
+    def __init__(self, currency, locale=None):
+        self.currency = currency
+        self.locale = Locale.parse(locale or LC_MONETARY)
+
+        pattern = self.locale.currency_formats['standard']
+        precision = get_currency_precision(currency)
+        symbol = get_currency_symbol(currency, self.locale)
+        group = get_group_symbol(self.locale)
+        decimal_point = get_decimal_symbol(self.locale)
+
+        # Babel uses groups of 1000 digits for patterns without grouping.
+        self._supported = (not pattern.exp_prec and '@' not in pattern.pattern and pattern.scale == 0
+                           and pattern.grouping in ((3, 3), (1000, 1000)) and pattern.int_prec[0] == 1
+                           and "'" not in group + decimal_point)
+
+        self._spec = '{}.{}f'.format(',' if pattern.grouping == (3, 3) else '', precision)
+        self._symbols = str.maketrans({',': group, '.': decimal_point})
+        (self._positive, self._negative) = [
+            (self._affix(pattern.prefix[i], symbol), self._affix(pattern.suffix[i], symbol)) for i in (0, 1)]
+
+    def _affix(self, affix, symbol):
+        """Same substitutions NumberPattern.apply makes on the whole string.
+        """
+        affix = affix.replace('¤¤¤', '\0').replace('¤¤', self.currency.upper()).replace('¤', symbol)
+        assert '\0' not in affix, 'Currency names are not supported.'
+        return re.sub(r"'([^']*)'", lambda m: m.group(1) or "'", affix)
+
+    def format(self, value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value))
+        else:
+            value = value.normalize()
+
+        if not self._supported or not value.is_finite():
+            return format_currency(value, self.currency, locale=self.locale)
+
+        (prefix, suffix) = self._negative if value.is_signed() else self._positive
+        return prefix + format(abs(value), self._spec).translate(self._symbols) + suffix
+
+    def format_many(self, values):
+        _format = self.format
+        return [_format(value) for value in values]
+
+
+BRL = CurrencyFormatter('BRL')
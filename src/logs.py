@@ -0,0 +1,142 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+
+FORMAT = '[%(asctime)s] [%(levelname)s] %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
+
+access_logger = logging.getLogger('titulo_tesouro.access')
+payload_logger = logging.getLogger('titulo_tesouro.payload')
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler over a bounded queue that drops, and counts, the records
+    that do not fit instead of blocking the request or growing without limit
+    when the writer falls behind.
+    """
+
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundLogging(object):
+    """Sends the records of the root logger through a DroppingQueueHandler to a
+    thread that formats and writes them to "stream". The request thread only
+    merges the message with its arguments and enqueues it.
+
+    A forked worker does not inherit the writer thread, so a new queue and
+    thread are started in the child.
+    """
+
+    def __init__(self, stream=None, queue_size=10000, level=logging.INFO):
+        self.stream = stream if stream is not None else sys.stderr
+        self.queue_size = queue_size
+        self.level = level
+
+        self.handler = None
+        self.listener = None
+
+    def start(self):
+        writer = logging.StreamHandler(self.stream)
+        writer.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+
+        self.handler = DroppingQueueHandler(queue.Queue(self.queue_size))
+        self.listener = logging.handlers.QueueListener(self.handler.queue, writer)
+        self.listener.start()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+
+    def stop(self):
+        """Writes the records still queued, then stops the thread.
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _restart(self):
+        # The thread of the parent does not exist in the child, and its queue
+        # may hold records the parent will write itself.
+        self.listener = None
+        self.start()
+
+    def install(self):
+        self.start()
+        atexit.register(self.stop)
+        os.register_at_fork(after_in_child=self._restart)
+        return self
+
+
+class PayloadLog(object):
+    """Logs the bodies of a fraction "rate" of the responses, truncated to
+    "max_size" characters. The bodies are already encoded, so only the
+    sampled ones cost anything beyond a random number.
+    """
+
+    def __init__(self, rate, max_size):
+        assert 0 <= rate <= 1, '"rate" must be in interval [0, 1].'
+
+        self.rate = rate
+        self.max_size = max_size
+
+    def log(self, status, body):
+        if not self.rate or random.random() >= self.rate:
+            return
+
+        if len(body) > self.max_size:
+            body = '{}... ({} characters)'.format(body[:self.max_size], len(body))
+        payload_logger.info('%s %s', status, body)
+
+
+class AccessLogMiddleware(object):
+    """Logs one line of JSON per request: method, path, route template, query
+    string, status code, duration in milliseconds and body size, when known
+    (streamed bodies have none). As in MetricsMiddleware, the duration of
+    streamed responses is up to the first byte of the body.
+
+    Works with both falcon.API and falcon.asgi.App.
+    """
+
+    def process_request(self, req, resp):
+        req.context.access_log_start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not access_logger.isEnabledFor(logging.INFO):
+            return
+
+        start = getattr(req.context, 'access_log_start', None)
+        body = resp.text if resp.text is not None else resp.data
+
+        access_logger.info('%s', json.dumps({
+            'method': req.method,
+            'path': req.path,
+            'route': req.uri_template,
+            'query': req.query_string or None,
+            'status': int(str(resp.status)[:3]),
+            'duration_ms': round((time.perf_counter() - start) * 1000, 3) if start is not None else None,
+            'bytes': len(body) if body is not None else None,
+            'remote': req.remote_addr
+        }))
+
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
@@ -5,19 +5,64 @@
 import falcon
 import logging
 
+from src.basics import DATABASE_PARAMS, DATABASE_POOL_MIN_SIZE, DATABASE_POOL_MAX_SIZE
+from src.basics import DATABASE_POOL_TIMEOUT, DATABASE_POOL_HEALTH_CHECK_INTERVAL, SERIES_ENGINE_ENABLED
+from src.basics import SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_EXPLAIN_RATE, SLOW_QUERY_LOG_SIZE
+from src.basics import LOG_QUEUE_SIZE, ACCESS_LOG_ENABLED, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES
+from src.basics import CHANGE_LISTENER_ENABLED, CHANGE_LISTENER_RECONNECT_INTERVAL
+from src.database import ConnectionPool
 from src.endpoints import EndpointExpositor
+from src.logs import BackgroundLogging, AccessLogMiddleware, access_logger
+from src.metrics import MetricsMiddleware, SlowQueryLog
+from src.notifications import ChangeListener
+from src.queries import QueryCatalog
+from src.response_cache import ResponseCache
 from src.services import TituloTesouroCRUD
 
 
-logging.basicConfig(format='[%(asctime)s] [%(levelname)s] %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S %Z',
-                    level=getattr(logging, 'INFO', 'DEBUG'))
+BackgroundLogging(queue_size=LOG_QUEUE_SIZE).install()
+if not ACCESS_LOG_ENABLED:
+    access_logger.disabled = True
 
 logging.info('Starting web service.')
 
 falcon_api = application = falcon.API()
+# Default of Falcon 1: "/titulo_tesouro/comparar/" and "/titulo_tesouro/comparar" are the same route.
+falcon_api.req_options.strip_url_path_trailing_slash = True
 
-endpoint_expositor = EndpointExpositor(falcon_api, TituloTesouroCRUD())
+query_catalog = QueryCatalog()
+
+connection_pool = ConnectionPool(DATABASE_PARAMS,
+                                 min_size=DATABASE_POOL_MIN_SIZE,
+                                 max_size=DATABASE_POOL_MAX_SIZE,
+                                 timeout=DATABASE_POOL_TIMEOUT,
+                                 health_check_interval=DATABASE_POOL_HEALTH_CHECK_INTERVAL,
+                                 on_connect=query_catalog.prepare)
+
+series_engine = None
+if SERIES_ENGINE_ENABLED:
+    from src.series_engine import SeriesEngine
+    series_engine = SeriesEngine(connection_pool, query_catalog)
+    logging.info('In-memory series engine enabled.')
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_THRESHOLD_MS, explain_rate=SLOW_QUERY_EXPLAIN_RATE, size=SLOW_QUERY_LOG_SIZE)
+
+response_cache = None
+if RESPONSE_CACHE_MAX_ENTRIES > 0:
+    response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+
+titulo_tesouro_crud = TituloTesouroCRUD(connection_pool, query_catalog, series_engine, slow_query_log,
+                                        response_cache)
+
+falcon_api.add_middleware(MetricsMiddleware(titulo_tesouro_crud))
+falcon_api.add_middleware(AccessLogMiddleware())
+
+change_listener = None
+if CHANGE_LISTENER_ENABLED:
+    change_listener = ChangeListener(titulo_tesouro_crud, DATABASE_PARAMS,
+                                     reconnect_interval=CHANGE_LISTENER_RECONNECT_INTERVAL).install()
+
+endpoint_expositor = EndpointExpositor(falcon_api, titulo_tesouro_crud, change_listener)
 endpoint_expositor.expose()
 
 logging.info('Web service listening.\n')
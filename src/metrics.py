@@ -0,0 +1,166 @@
+import collections
+import contextlib
+import datetime
+import logging
+import os
+import random
+import threading
+import time
+
+import prometheus_client
+import prometheus_client.multiprocess
+
+
+# Queries are much faster than whole requests, so their buckets start lower.
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REQUEST_DURATION = prometheus_client.Histogram(
+    'titulo_tesouro_request_duration_seconds', 'Time spent handling a request, by route.', ['method', 'route'])
+REQUESTS = prometheus_client.Counter(
+    'titulo_tesouro_requests', 'Responses, by route and status code.', ['method', 'route', 'status'])
+QUERY_DURATION = prometheus_client.Histogram(
+    'titulo_tesouro_query_duration_seconds', 'Time spent running a query of the catalog, by name.', ['query'],
+    buckets=QUERY_BUCKETS)
+
+# The connections of the live workers add up, their lifetime counters add up
+# even after a worker exits.
+POOL_CONNECTIONS = prometheus_client.Gauge(
+    'titulo_tesouro_pool_connections', 'Connections of the database pools, by state.', ['state'],
+    multiprocess_mode='livesum')
+POOL_EVENTS = prometheus_client.Gauge(
+    'titulo_tesouro_pool_events', 'Lifetime counters of the database pools.', ['event'],
+    multiprocess_mode='sum')
+
+RESPONSE_CACHE_EVENTS = prometheus_client.Counter(
+    'titulo_tesouro_response_cache_events', 'Hits, misses, evictions and invalidations of the response caches.',
+    ['event'])
+RESPONSE_CACHE_SIZE = prometheus_client.Gauge(
+    'titulo_tesouro_response_cache_size', 'Entries and bytes held by the response caches.', ['unit'],
+    multiprocess_mode='livesum')
+
+POOL_STATES = ('size', 'idle', 'in_use', 'waiting')
+POOL_COUNTERS = ('checkouts', 'waits', 'timeouts', 'health_checks', 'reconnects', 'connections_opened',
+                 'connections_closed')
+
+
+def record_query(name, seconds):
+    QUERY_DURATION.labels(name).observe(seconds)
+
+
+@contextlib.contextmanager
+def observe_query(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_query(name, time.perf_counter() - start)
+
+
+def record_pool(stats):
+    """Sets the pool gauges from "stats", as returned by ConnectionPool.stats.
+    Missing keys are left alone.
+    """
+    for state in POOL_STATES:
+        if state in stats:
+            POOL_CONNECTIONS.labels(state).set(stats[state])
+
+    for event in POOL_COUNTERS:
+        if event in stats:
+            POOL_EVENTS.labels(event).set(stats[event])
+
+
+def render():
+    """Metrics in the Prometheus text format. With PROMETHEUS_MULTIPROC_DIR
+    set, as done by "gunicorn.conf.py", those of all workers are merged;
+    otherwise only those of this process are returned.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+
+    return prometheus_client.generate_latest(registry)
+
+
+class MetricsMiddleware(object):
+    """Times every request and counts the responses by route template and
+    status code, then refreshes the pool gauges of the worker. For streamed
+    responses the time is up to the first byte of the body.
+
+    Works with both falcon.API and falcon.asgi.App.
+    """
+
+    def __init__(self, titulo_tesouro_crud):
+        self.titulo_tesouro_crud = titulo_tesouro_crud
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, 'metrics_start', None)
+        route = req.uri_template or 'unmatched'
+
+        if start is not None:
+            REQUEST_DURATION.labels(req.method, route).observe(time.perf_counter() - start)
+        REQUESTS.labels(req.method, route, str(resp.status)[:3]).inc()
+
+        record_pool(self.titulo_tesouro_crud.pool_stats())
+
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class SlowQueryLog(object):
+    """Logs the queries slower than "threshold_ms", with their parameters, and
+    keeps the last "size" of them in a ring buffer. For a fraction
+    "explain_rate" of them, the EXPLAIN (ANALYZE, BUFFERS) of the query, run
+    again with the same parameters, is kept too.
+
+    The buffer belongs to the worker process.
+    """
+
+    def __init__(self, threshold_ms, explain_rate=0.0, size=100):
+        assert 0 <= explain_rate <= 1, '"explain_rate" must be in interval [0, 1].'
+
+        self.threshold_ms = threshold_ms
+        self.explain_rate = explain_rate
+
+        self._lock = threading.Lock()
+        self._entries = collections.deque(maxlen=size)
+
+    def is_slow(self, seconds):
+        return seconds * 1000 >= self.threshold_ms
+
+    def should_explain(self):
+        return random.random() < self.explain_rate
+
+    def _jsonable(self, value):
+        if isinstance(value, (list, tuple)):
+            return [self._jsonable(element) for element in value]
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        return str(value)
+
+    def record(self, name, params, seconds, plan=None):
+        duration_ms = round(seconds * 1000, 3)
+        logging.warning('Slow query "{}" took {} ms with parameters {}.'.format(name, duration_ms, params))
+
+        with self._lock:
+            self._entries.append({
+                'consulta': name,
+                'parametros': self._jsonable(params),
+                'duracao_ms': duration_ms,
+                'executada_em': datetime.datetime.now().isoformat(),
+                'pid': os.getpid(),
+                'plano': plan
+            })
+
+    def entries(self):
+        """The recorded queries, most recent first.
+        """
+        with self._lock:
+            return list(reversed(self._entries))
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import queue
+import select
+import threading
+
+import psycopg2
+
+
+# Channel of the NOTIFY of the trigger "tesouro_direto_notify".
+CHANNEL = 'tesouro_direto_changes'
+
+
+def change_event(payload):
+    """Event of the API from the payload of a notification: "op" (insert,
+    update, delete or truncate) and, except for truncate, the
+    "categoria_titulo" and "ação" of the rows and how many, in "registros",
+    the statement changed.
+    """
+    change = json.loads(payload)
+
+    event = {'op': change['op'].lower()}
+    if 'category' in change:
+        event['categoria_titulo'] = change['category']
+        event['ação'] = change['action'].lower()
+        event['registros'] = change['count']
+
+    return event
+
+
+# Published when the listener reconnects: changes may have been missed, so
+# anything may have changed.
+RESYNC = {'op': 'resync'}
+
+
+class ChangeFeed(object):
+    """Hands the changes notified by the database to the CRUD, so that it
+    drops what it keeps in memory, and to the subscribers (the event streams).
+
+    Subscribers are functions of the event and the process id of the database
+    connection that made the change.
+    """
+
+    def __init__(self, titulo_tesouro_crud):
+        self.titulo_tesouro_crud = titulo_tesouro_crud
+
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event, pid=None):
+        self.titulo_tesouro_crud.changed(event, pid)
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber(event, pid)
+
+    def notified(self, payload, pid):
+        try:
+            event = change_event(payload)
+        except (ValueError, KeyError, AttributeError):
+            logging.warning('Ignoring malformed change notification: %s', payload)
+            return
+
+        self.publish(event, pid)
+
+
+class ChangeListener(ChangeFeed):
+    """ChangeFeed fed by a thread of the worker that LISTENs on its own
+    connection. When the connection is lost, the thread connects again every
+    "reconnect_interval" seconds and then publishes RESYNC.
+
+    As in BackgroundLogging, a forked worker does not inherit the thread, so
+    a new one, with a new connection, is started in the child.
+    """
+
+    def __init__(self, titulo_tesouro_crud, database_params, reconnect_interval=5.0, poll_interval=5.0):
+        super(ChangeListener, self).__init__(titulo_tesouro_crud)
+
+        self.database_params = database_params
+        self.reconnect_interval = reconnect_interval
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _listen(self, conn):
+        with conn.cursor() as cur:
+            cur.execute('LISTEN {}'.format(CHANNEL))
+
+        while not self._stop.is_set():
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.notified(notify.payload, notify.pid)
+
+    def _run(self):
+        connected_before = False
+
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.database_params)
+                conn.autocommit = True
+
+                if connected_before:
+                    self.publish(RESYNC)
+                connected_before = True
+                logging.info('Listening to changes on channel "%s".', CHANNEL)
+
+                self._listen(conn)
+            except psycopg2.Error as e:
+                logging.error('Change listener disconnected: %s', str(e).strip())
+                self._stop.wait(self.reconnect_interval)
+            except Exception:
+                logging.exception('Change listener failed.')
+                self._stop.wait(self.reconnect_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='change-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _restart(self):
+        # The connection of the parent is left alone, it is still the parent's,
+        # and so are its subscribers.
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._stop = threading.Event()
+        self.start()
+
+    def install(self):
+        self.start()
+        os.register_at_fork(after_in_child=self._restart)
+        return self
+
+
+class Subscription(object):
+    """Subscriber queueing the events, up to "size" of them, for a thread to
+    consume. A subscriber that falls behind is marked "overflowed" and gets no
+    more events.
+    """
+
+    def __init__(self, size, categories=None):
+        self.events = queue.Queue(size)
+        self.categories = categories
+        self.overflowed = False
+
+    def wants(self, event):
+        return (not self.categories or 'categoria_titulo' not in event
+                or event['categoria_titulo'] in self.categories)
+
+    def __call__(self, event, pid):
+        if self.overflowed or not self.wants(event):
+            return
+
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Next event, None if there was none for "timeout" seconds.
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
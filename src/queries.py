@@ -0,0 +1,128 @@
+import os
+import re
+
+import psycopg2
+import psycopg2.extensions
+
+from src.basics import TRANSACTIONS_PATH
+
+
+class QueryCatalog(object):
+    """Catalog of the SQL templates in "resources/transactions".
+
+    The templates are read once, at startup, and use PostgreSQL positional
+    parameters ($1, $2, ...). Each one is turned into a server-side prepared
+    statement named after its file (e.g. "read-history.sql" becomes
+    "read_history") on every pooled connection, so Postgres parses and plans
+    them once per connection and values are always sent as bound parameters.
+    """
+
+    PARAMETER_PATTERN = re.compile(r'\$(\d+)')
+
+    # Raised when a prepared statement no longer matches the schema, e.g. after
+    # "system_loader.py" dropped and recreated the tables and types. Parameters
+    # compared with the enum columns are declared as text and cast in the
+    # templates, so only the result types can go stale, and those are caught by
+    # the first statement of the transaction.
+    STALE_STATEMENT_ERRORS = ('26000', '0A000', 'XX000')
+
+    def __init__(self, path=TRANSACTIONS_PATH):
+        self.path = path
+        self.statements = dict()
+
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith('.sql'):
+                continue
+
+            name = filename[:-len('.sql')]
+            with open('{}/{}'.format(path, filename)) as f:
+                sql = f.read().strip().rstrip(';')
+
+            parameters = [int(n) for n in self.PARAMETER_PATTERN.findall(sql)]
+            self.statements[name] = {
+                'statement': name.replace('-', '_'),
+                'sql': sql,
+                'pyformat': self.PARAMETER_PATTERN.sub(r'%(p\1)s', sql.replace('%', '%%')),
+                'arity': max(parameters) if parameters else 0
+            }
+
+    def __contains__(self, name):
+        return name in self.statements
+
+    def __getitem__(self, name):
+        return self.statements[name]['sql']
+
+    def prepare(self, conn):
+        """Prepares every statement of the catalog on a new connection. Used as
+        the "on_connect" hook of the connection pool.
+        """
+        with conn.cursor() as cur:
+            for query in self.statements.values():
+                cur.execute('PREPARE {} AS {}'.format(query['statement'], query['sql']))
+
+    def _reprepare(self, conn):
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute('DEALLOCATE ALL')
+        self.prepare(conn)
+
+    def execute(self, cur, name, params=()):
+        """Runs the prepared statement "name" with the bound "params". If the
+        statement went stale and it is the first one of the transaction, the
+        catalog is prepared again and the statement retried.
+        """
+        query = self.statements[name]
+        assert len(params) == query['arity'], \
+            'Query "{}" expects {} parameters, got {}.'.format(name, query['arity'], len(params))
+
+        conn = cur.connection
+        fresh = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        try:
+            self._execute(cur, query, params)
+        except psycopg2.Error as e:
+            if not fresh or e.pgcode not in self.STALE_STATEMENT_ERRORS:
+                raise
+
+            self._reprepare(conn)
+            self._execute(cur, query, params)
+
+    def explain(self, cur, name, params=()):
+        """Lines of the EXPLAIN (ANALYZE, BUFFERS) of "name" with "params".
+        ANALYZE runs the statement, so it is run in a savepoint that is rolled
+        back afterwards, writes included.
+        """
+        query = self.statements[name]
+
+        cur.execute('SAVEPOINT explain_query')
+        try:
+            if query['arity'] == 0:
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS) EXECUTE {}'.format(query['statement']))
+            else:
+                placeholders = ', '.join(['%s'] * query['arity'])
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS) EXECUTE {} ({})'.format(query['statement'], placeholders),
+                            params)
+            return [row[0] for row in cur.fetchall()]
+        finally:
+            cur.execute('ROLLBACK TO SAVEPOINT explain_query')
+
+    def declare(self, conn, name, params=()):
+        """Runs "name" through a server-side (named) cursor, so its rows are
+        fetched as they are consumed instead of all at once. DECLARE does not
+        take prepared statements, so the template is sent as text with
+        "params" bound by psycopg2.
+        """
+        query = self.statements[name]
+        assert len(params) == query['arity'], \
+            'Query "{}" expects {} parameters, got {}.'.format(name, query['arity'], len(params))
+
+        cur = conn.cursor(name='{}_cursor'.format(query['statement']))
+        cur.execute(query['pyformat'], {'p{}'.format(i + 1): value for (i, value) in enumerate(params)})
+        return cur
+
+    def _execute(self, cur, query, params):
+        if query['arity'] == 0:
+            cur.execute('EXECUTE {}'.format(query['statement']))
+        else:
+            placeholders = ', '.join(['%s'] * query['arity'])
+            cur.execute('EXECUTE {} ({})'.format(query['statement'], placeholders), params)
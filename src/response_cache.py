@@ -0,0 +1,115 @@
+import collections
+import threading
+
+from src import metrics
+
+
+class ResponseCache(object):
+    """LRU cache of the encoded bodies of the read responses, bounded by
+    "max_entries" and "max_bytes".
+
+    Each entry keeps the data version (see TituloTesouroCRUD.data_version) it
+    was rendered at, and is only served for that same version, so writes made
+    by other workers or processes are never hidden. Writes made through this
+    worker also drop, right away, the entries of the categories they touch.
+
+    The cache belongs to the worker process.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key: (version, categories, body), least recently used first.
+        self._entries = collections.OrderedDict()
+        self._keys_by_category = collections.defaultdict(set)
+        self._bytes = 0
+
+        self.counters = collections.Counter()
+
+    def _count(self, event, n=1):
+        self.counters[event] += n
+        metrics.RESPONSE_CACHE_EVENTS.labels(event).inc(n)
+
+    def _remove(self, key):
+        (_, categories, body) = self._entries.pop(key)
+        self._bytes -= len(body)
+
+        for category in categories:
+            self._keys_by_category[category].discard(key)
+            if not self._keys_by_category[category]:
+                del self._keys_by_category[category]
+
+    def _record_size(self):
+        metrics.RESPONSE_CACHE_SIZE.labels('entries').set(len(self._entries))
+        metrics.RESPONSE_CACHE_SIZE.labels('bytes').set(self._bytes)
+
+    def get(self, key, version):
+        """Body stored for "key" at "version", None if there is none.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self._count('hits')
+                return entry[2]
+
+            if entry is not None:
+                self._remove(key)
+                self._record_size()
+            self._count('misses')
+            return None
+
+    def put(self, key, version, categories, body, current=None):
+        """Stores "body", bytes, for "key" at "version". "categories" are those
+        whose writes invalidate it. Bodies larger than "max_bytes" are not
+        stored, nor those for which "current", if any, called under the lock
+        of the cache, returns False.
+        """
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            if current is not None and not current():
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (version, tuple(categories), body)
+            self._bytes += len(body)
+            for category in categories:
+                self._keys_by_category[category].add(key)
+
+            evicted = 0
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+
+            if evicted:
+                self._count('evictions', evicted)
+            self._record_size()
+
+    def invalidate(self, categories=None):
+        """Drops the entries of "categories", or all of them if None.
+        """
+        with self._lock:
+            if categories is None:
+                keys = list(self._entries)
+            else:
+                keys = set()
+                for category in categories:
+                    keys.update(self._keys_by_category.get(category, ()))
+
+            for key in keys:
+                self._remove(key)
+
+            if keys:
+                self._count('invalidations', len(keys))
+            self._record_size()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), bytes=self._bytes)
@@ -0,0 +1,258 @@
+import threading
+
+import numpy
+
+from src.basics import TITULO_TESOURO_CATEGORIES, TITULO_TESOURO_ACTIONS, INITIAL_DATE
+from src.comparison import month_key
+
+
+class SeriesEngine(object):
+    """In-memory, columnar copy of "tesouro_direto_series".
+
+    Every (category, action) pair is kept as NumPy arrays indexed by the month
+    offset from INITIAL_DATE: the amounts, a mask of the months that have a
+    row and the ids of those rows. Reads are answered by slicing the arrays,
+    and yearly sums use np.add.reduceat over the year boundaries of the slice.
+
+    The engine is loaded lazily, on first use, and kept consistent with the
+    writes made through TituloTesouroCRUD in the same process. Writes made by
+    other processes are not seen until the engine is loaded again, which the
+    ChangeListener of the worker asks for through "invalidate".
+    """
+
+    def __init__(self, pool, queries):
+        self.pool = pool
+        self.queries = queries
+
+        self._lock = threading.RLock()
+        self._loaded = False
+        # Bumped by "invalidate", so that a reader can tell whether the engine
+        # was found behind the database while it was reading.
+        self.generation = 0
+        self._size = 0
+        self._series = dict()
+        self._rows = dict()
+
+    def _offset(self, date):
+        return (date.year - INITIAL_DATE.year) * 12 + (date.month - INITIAL_DATE.month)
+
+    def _grow(self, size):
+        if size <= self._size:
+            return
+
+        # Doubles the capacity so that appending months one by one is cheap.
+        size = max(size, 2 * self._size, 12)
+        for series in self._series.values():
+            for (name, array) in series.items():
+                grown = numpy.zeros(size, dtype=array.dtype)
+                grown[:self._size] = array
+                series[name] = grown
+        self._size = size
+
+    def _set(self, titulo_id, category, action, offset, amount):
+        self._grow(offset + 1)
+
+        series = self._series[(category, action)]
+        series['amounts'][offset] = amount
+        series['present'][offset] = True
+        series['ids'][offset] = titulo_id
+
+        self._rows[titulo_id] = (category, action, offset)
+
+    def _unset(self, titulo_id):
+        (category, action, offset) = self._rows.pop(titulo_id)
+
+        series = self._series[(category, action)]
+        series['amounts'][offset] = 0
+        series['present'][offset] = False
+        series['ids'][offset] = 0
+
+    def load(self):
+        """(Re)loads the whole table into memory. The lock is held from the
+        query on, so that the writes mirrored meanwhile wait for the load and
+        are applied over it, instead of being skipped as if it had not begun.
+        """
+        with self._lock:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                self.queries.execute(cur, 'read-series')
+                rows = cur.fetchall()
+
+            self._size = 0
+            self._rows = dict()
+            self._series = {
+                (category, action): {
+                    'amounts': numpy.zeros(0, dtype=numpy.float64),
+                    'present': numpy.zeros(0, dtype=numpy.bool_),
+                    'ids': numpy.zeros(0, dtype=numpy.int64)
+                }
+                for category in TITULO_TESOURO_CATEGORIES
+                for action in TITULO_TESOURO_ACTIONS
+            }
+
+            if rows:
+                self._grow(max(self._offset(row[3]) for row in rows) + 1)
+            for (titulo_id, category, action, expire_at, amount) in rows:
+                self._set(titulo_id, category, action, self._offset(expire_at), float(amount))
+
+            self._loaded = True
+
+    def invalidate(self):
+        """Loads the table again on next use.
+        """
+        with self._lock:
+            self._loaded = False
+            self.generation += 1
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+
+    def _bounds(self, start_date, end_date):
+        start = max(self._offset(start_date), 0)
+        end = min(self._offset(end_date) + 1, self._size)
+        return (start, max(start, end))
+
+    def _year_starts(self, start, end):
+        """Indices, relative to the slice [start, end), where a new year begins.
+        """
+        offsets = numpy.arange(start, end)
+        starts = numpy.flatnonzero((offsets + INITIAL_DATE.month - 1) % 12 == 0)
+        if starts.size == 0 or starts[0] != 0:
+            starts = numpy.concatenate(([0], starts))
+        return starts
+
+    def _year_of(self, offset):
+        return INITIAL_DATE.year + (offset + INITIAL_DATE.month - 1) // 12
+
+    def _month_of(self, offset):
+        return (offset + INITIAL_DATE.month - 1) % 12 + 1
+
+    def _yearly(self, start, end, series):
+        """Sums each series of the slice by year. Returns the year of each
+        group, and for each series its sums and how many rows each sum has.
+        """
+        starts = self._year_starts(start, end)
+        years = [self._year_of(start + i) for i in starts.tolist()]
+
+        sums = list()
+        for (amounts, present) in series:
+            sums.append((numpy.add.reduceat(numpy.where(present, amounts, 0.0), starts),
+                         numpy.add.reduceat(present.astype(numpy.int64), starts)))
+
+        return (years, sums)
+
+    def category(self, titulo_id):
+        self._ensure_loaded()
+
+        row = self._rows.get(titulo_id)
+        return row[0] if row else None
+
+    def series(self, titulo_id):
+        """The (category, action) of the row "titulo_id", or None.
+        """
+        self._ensure_loaded()
+
+        row = self._rows.get(titulo_id)
+        return row[:2] if row else None
+
+    def read_matrix(self, series, start_date, end_date):
+        """Amounts and presence of each (category, action) of "series", as the
+        columns of month-aligned matrices. Returns the month key of their first
+        row too.
+        """
+        self._ensure_loaded()
+
+        with self._lock:
+            (start, end) = self._bounds(start_date, end_date)
+
+            amounts = numpy.column_stack([self._series[key]['amounts'][start:end] for key in series])
+            present = numpy.column_stack([self._series[key]['present'][start:end] for key in series])
+
+        return (month_key(INITIAL_DATE.year, INITIAL_DATE.month) + start, amounts, present)
+
+    def read_history(self, category, start_date, end_date, group_by_year):
+        """Same rows as "read-history.sql" and "read-history-grouped.sql": the
+        months, or years, that have either action, with None for the amount of
+        an action they do not have.
+        """
+        self._ensure_loaded()
+
+        with self._lock:
+            (start, end) = self._bounds(start_date, end_date)
+            if start == end:
+                return list()
+
+            venda = self._series[(category, 'VENDA')]
+            resgate = self._series[(category, 'RESGATE')]
+            venda_amounts = venda['amounts'][start:end].copy()
+            venda_present = venda['present'][start:end].copy()
+            resgate_amounts = resgate['amounts'][start:end].copy()
+            resgate_present = resgate['present'][start:end].copy()
+
+        if group_by_year:
+            (years, sums) = self._yearly(start, end, [(venda_amounts, venda_present),
+                                                      (resgate_amounts, resgate_present)])
+            ((venda_sums, venda_counts), (resgate_sums, resgate_counts)) = sums
+
+            return [(years[i],
+                     venda_sums[i] if venda_counts[i] else None,
+                     resgate_sums[i] if resgate_counts[i] else None)
+                    for i in numpy.flatnonzero((venda_counts > 0) | (resgate_counts > 0)).tolist()]
+
+        return [(self._month_of(start + i), self._year_of(start + i),
+                 venda_amounts[i] if venda_present[i] else None,
+                 resgate_amounts[i] if resgate_present[i] else None)
+                for i in numpy.flatnonzero(venda_present | resgate_present).tolist()]
+
+    def read_by_action(self, category, action, start_date, end_date, group_by_year):
+        """Same rows as "read-by-action.sql" and "read-by-action-grouped.sql".
+        """
+        self._ensure_loaded()
+
+        with self._lock:
+            (start, end) = self._bounds(start_date, end_date)
+            if start == end:
+                return list()
+
+            series = self._series[(category, action.upper())]
+            amounts = series['amounts'][start:end].copy()
+            present = series['present'][start:end].copy()
+
+        if group_by_year:
+            (years, [(sums, counts)]) = self._yearly(start, end, [(amounts, present)])
+            return [(years[i], sums[i]) for i in numpy.flatnonzero(counts > 0).tolist()]
+
+        return [(self._year_of(start + i), self._month_of(start + i), amounts[i])
+                for i in numpy.flatnonzero(present).tolist()]
+
+    def created(self, titulo_id, category, action, expire_at, amount):
+        with self._lock:
+            if self._loaded:
+                self._set(titulo_id, category, action, self._offset(expire_at), float(amount))
+
+    def updated(self, titulo_id, action, amount, expire_at):
+        """Mirrors "update-tesouro-direto.sql": "action" and "amount" are only
+        changed when given.
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+
+            if titulo_id not in self._rows:
+                # Row written by another process, load everything again.
+                self.invalidate()
+                return
+
+            (category, old_action, offset) = self._rows[titulo_id]
+            if amount is None:
+                amount = self._series[(category, old_action)]['amounts'][offset]
+
+            self._unset(titulo_id)
+            self._set(titulo_id, category, action or old_action, self._offset(expire_at), float(amount))
+
+    def deleted(self, titulo_id):
+        with self._lock:
+            if self._loaded and titulo_id in self._rows:
+                self._unset(titulo_id)
@@ -1,29 +1,112 @@
-from babel.numbers import format_currency
 from src.basics import TITULO_TESOURO_CATEGORIES, TITULO_TESOURO_ACTIONS
-from src.basics import TRANSACTIONS_PATH, DATABASE_PARAMS, INITIAL_DATE
+from src.basics import INITIAL_DATE, BATCH_MAX_SIZE, BATCH_FAILURE_POLICIES, BATCH_FAILURE_POLICY
+from src.basics import STREAM_CHUNK_SIZE, PAGE_MAX_SIZE, CHANGES_PAGE_MAX_SIZE
+from src.comparison import ComparisonMatrix
+from src.formatting import BRL
+from src.metrics import record_query
+import base64
+import binascii
 import datetime
+import itertools
+import numpy
 import psycopg2
+import time
 
 
 
 class TituloTesouroCRUD(object):
 
-    def __init__(self):
-        self.queries = {
-            'load-input-data': open('{}/load-input-data.sql'.format(TRANSACTIONS_PATH)).read(),
-            'get-id': open('{}/get-id.sql'.format(TRANSACTIONS_PATH)).read(),
-            'count-tesouro-direto': open('{}/count-tesouro-direto.sql'.format(TRANSACTIONS_PATH)).read(),
-            'delete-tesouro-direto': open('{}/delete-tesouro-direto.sql'.format(TRANSACTIONS_PATH)).read(),
-            'get-expire_at': open('{}/get-expire_at.sql'.format(TRANSACTIONS_PATH)).read(),
-            'update-tesouro-direto': open('{}/update-tesouro-direto.sql'.format(TRANSACTIONS_PATH)).read(),
-            'read-history': open('{}/read-history.sql'.format(TRANSACTIONS_PATH)).read(),
-            'read-history-grouped': open('{}/read-history-grouped.sql'.format(TRANSACTIONS_PATH)).read(),
-            'get-category': open('{}/get-category.sql'.format(TRANSACTIONS_PATH)).read(),
-            'read-by-action': open('{}/read-by-action.sql'.format(TRANSACTIONS_PATH)).read(),
-            'read-by-action-grouped': open('{}/read-by-action-grouped.sql'.format(TRANSACTIONS_PATH)).read(),
-            'get-category-by-id': open('{}/get-category-by-id.sql'.format(TRANSACTIONS_PATH)).read(),
-            'compare': open('{}/compare.sql'.format(TRANSACTIONS_PATH)).read()
-        }
+    # Ids are bound as bigint, larger ones would fail in the database.
+    TITULO_ID_MAX = 2 ** 63 - 1
+
+    def __init__(self, pool, queries, series_engine=None, slow_query_log=None, response_cache=None):
+        self.pool = pool
+        self.queries = queries
+        self.series_engine = series_engine
+        self.slow_query_log = slow_query_log
+        self.response_cache = response_cache
+
+    def _execute(self, cur, name, params=()):
+        """Runs the query "name" of the catalog, timed by name. Slow queries
+        are recorded in the SlowQueryLog, if any.
+        """
+        start = time.perf_counter()
+        try:
+            self.queries.execute(cur, name, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            record_query(name, elapsed)
+
+        if self.slow_query_log is not None and self.slow_query_log.is_slow(elapsed):
+            self._log_slow_query(cur.connection, name, params, elapsed)
+
+    def _log_slow_query(self, conn, name, params, elapsed):
+        plan = None
+        if self.slow_query_log.should_explain():
+            try:
+                with conn.cursor() as cur:
+                    plan = self.queries.explain(cur, name, params)
+            except psycopg2.Error as e:
+                plan = ['EXPLAIN failed: {}'.format(e).strip()]
+
+        self.slow_query_log.record(name, params, elapsed, plan)
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def _invalidate(self, categories):
+        if self.response_cache is not None and categories:
+            self.response_cache.invalidate(set(categories))
+
+    def changed(self, event, pid=None):
+        """Drops what is kept in memory about the rows of a change "event"
+        notified by the database (see notifications.py) through the connection
+        of process "pid". Events with no category may have changed anything.
+
+        The series engine already mirrors the writes of this worker, so it is
+        only reloaded for those made through other connections.
+        """
+        # The engine first: a body rendered from it before is then either
+        # refused by the cache (see "engine_generation") or dropped here.
+        if self.series_engine is not None and (pid is None or pid not in self.pool.backend_pids()):
+            self.series_engine.invalidate()
+
+        if self.response_cache is not None:
+            self.response_cache.invalidate([event['categoria_titulo']] if 'categoria_titulo' in event else None)
+
+    def engine_generation(self):
+        """Generation of the series engine, None without one. A read that
+        started at a generation and ends at another may have been answered by
+        the engine with data older than the version read for it.
+        """
+        return self.series_engine.generation if self.series_engine is not None else None
+
+    def response_key(self, kind, titulo_id, params):
+        """Key of the ResponseCache for the read "kind" ("historico", "venda",
+        "resgate" or "comparar", with "titulo_id" None) with "params". The
+        parameters are normalized, so requests that read the same rows share
+        it. None when they are invalid, so that the read itself reports why.
+        """
+        try:
+            if kind == 'comparar':
+                (ids, start_date, end_date, group_by_year) = self._read_compare(params)
+            else:
+                ids = [int(titulo_id)]
+                (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+        except Exception:
+            return None
+
+        # Records expire at the start of a month, so the default end, now,
+        # reads the same ones as the start of the current month.
+        end_date = end_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+        try:
+            (limit, start_date) = self._read_page(params, start_date, group_by_year)
+        except Exception:
+            return None
+
+        paginated = 'limit' in params or 'cursor' in params
+        return (kind, tuple(ids), start_date, end_date, group_by_year, paginated, limit)
 
     def _validate_category(self, category):
         assert isinstance(category, str), '"category" must be a string.'
@@ -51,6 +134,7 @@ class TituloTesouroCRUD(object):
         assert titulo_id.isdigit(), '"titulo_id" must be an int.'
         titulo_id = int(titulo_id)
         assert titulo_id > 0, '"titulo_id" must be greater than zero.'
+        assert titulo_id <= self.TITULO_ID_MAX, '"titulo_id" must be at most {}.'.format(self.TITULO_ID_MAX)
 
     def _validade_date(self, date):
         unpacked = date.split('-')
@@ -61,7 +145,7 @@ class TituloTesouroCRUD(object):
         assert month.isdigit(), 'month must be a positive int.'
         self._validate_month(int(month))
 
-    def create(self, category, month, year, action, amount):
+    def _prepare_record(self, category, month, year, action, amount):
         self._validate_category(category)
         self._validate_month(month)
         self._validate_year(year)
@@ -72,92 +156,355 @@ class TituloTesouroCRUD(object):
             amount = float(amount)
 
         action = action.upper()
-        expire_at = datetime.datetime(year, month, 1, 0, 0, 0).strftime('%Y-%m-%d %H:%M:%S')
+        expire_at = datetime.datetime(year, month, 1, 0, 0, 0)
         amount = round(amount, 2)
 
-        conn = psycopg2.connect(**DATABASE_PARAMS)
-        cur = conn.cursor()
-
-        value = "('{}', '{}', '{}', {})".format(category, action, expire_at, amount)
-        cur.execute(self.queries['load-input-data'].format(value))
+        return (category, action, expire_at, amount)
 
-        cur.execute(self.queries['get-id'].format(category, action, expire_at))
-        _id = cur.fetchall()[0][0]
-	conn.commit()
-        cur.close()
-        conn.close()
+    def _created(self, _id, category, action, expire_at, amount):
+        if self.series_engine is not None:
+            self.series_engine.created(_id, category, action, expire_at, amount)
+        self._invalidate([category])
 
         return {
             'id': _id,
             'categoria_titulo': category,
-            'mês': month,
-            'ano': year,
+            'mês': expire_at.month,
+            'ano': expire_at.year,
             'ação': action,
             'valor': amount
         }
 
+    def create(self, category, month, year, action, amount):
+        (category, action, expire_at, amount) = self._prepare_record(category, month, year, action, amount)
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'load-input-data', (category, action, expire_at, amount))
+            _id = cur.fetchall()[0][0]
+
+        return self._created(_id, category, action, expire_at, amount)
+
+    def create_many(self, records, on_error=BATCH_FAILURE_POLICY):
+        """Creates a batch of records with a single INSERT. Every record is
+        validated first; with "on_error" set to "abort" nothing is created if
+        any record is invalid or already exists, with "skip" the valid ones are
+        created anyway. Returns the created records and the errors, both with
+        the "index" of the record in the batch.
+        """
+        (prepared, errors) = self._prepare_batch(records, on_error)
+        ids = dict()
+
+        if prepared and not (errors and on_error == 'abort'):
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                self._execute(cur, 'load-input-data-batch', self._batch_columns(prepared))
+                ids = {(category, action, expire_at): _id for (_id, category, action, expire_at) in cur.fetchall()}
+
+                if self._batch_conflicts(prepared, ids, errors) and on_error == 'abort':
+                    conn.rollback()
+                    ids = dict()
+
+        return self._created_batch(prepared, ids, errors)
+
+    def _prepare_batch(self, records, on_error):
+        """Validates a batch. Returns the valid records, by key, with their
+        index and amount, and the errors by index.
+        """
+        assert isinstance(records, list), 'Request body must be an object or a list.'
+        assert records, 'Empty request body.'
+        assert len(records) <= BATCH_MAX_SIZE, 'At most {} records per request.'.format(BATCH_MAX_SIZE)
+        assert on_error in BATCH_FAILURE_POLICIES, '"on_error" must be one of {}.'.format(BATCH_FAILURE_POLICIES)
+
+        fields = ['categoria_titulo', 'mês', 'ano', 'ação', 'valor']
+        errors = dict()
+        prepared = dict()
+
+        for (index, record) in enumerate(records):
+            try:
+                assert isinstance(record, dict), 'Record must be an object.'
+                missing_fields = [field for field in fields if field not in record]
+                assert not missing_fields, 'Mandatory fields {} missing.'.format(missing_fields)
+
+                (category, action, expire_at, amount) = self._prepare_record(*[record[field] for field in fields])
+            except AssertionError as e:
+                errors[index] = str(e)
+                continue
+
+            key = (category, action, expire_at)
+            if key in prepared:
+                errors[index] = 'Same record as index {}.'.format(prepared[key][0])
+                continue
+
+            prepared[key] = (index, amount)
+
+        return (prepared, errors)
+
+    def _batch_columns(self, prepared):
+        return [list(column) for column in zip(*[key + (amount,) for (key, (_, amount)) in prepared.items()])]
+
+    def _batch_conflicts(self, prepared, ids, errors):
+        """Records the prepared records the INSERT skipped as already existing.
+        Returns whether there is any error in the batch.
+        """
+        for (key, (index, _)) in prepared.items():
+            if key not in ids:
+                errors[index] = 'Record already exists.'
+
+        return bool(errors)
+
+    def _created_batch(self, prepared, ids, errors):
+        created = list()
+
+        for (key, (index, amount)) in prepared.items():
+            if key in ids:
+                record = self._created(ids[key], *key, amount)
+                record['index'] = index
+                created.append(record)
+
+        created.sort(key=lambda record: record['index'])
+
+        return (created, [{'index': index, 'err': errors[index]} for index in sorted(errors)])
+
     def delete(self, titulo_id):
         self._validate_titulo_id(titulo_id)
 
-        conn = psycopg2.connect(**DATABASE_PARAMS)
-        cur = conn.cursor()
-
-        cur.execute(self.queries['count-tesouro-direto'].format(titulo_id))
-        count = cur.fetchall()[0][0]
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'delete-tesouro-direto', (int(titulo_id),))
+            categories = [row[0] for row in cur.fetchall()]
 
-        if count > 0:
-            cur.execute(self.queries['delete-tesouro-direto'].format(titulo_id))
-	conn.commit()
-        cur.close()
-        conn.close()
-
-        if count == 0:
+        if not categories:
             return False
+
+        if self.series_engine is not None:
+            self.series_engine.deleted(int(titulo_id))
+        self._invalidate(categories)
         return True
 
     def update(self, titulo_id, data):
         self._validate_titulo_id(titulo_id)
 
-        conn = psycopg2.connect(**DATABASE_PARAMS)
-        cur = conn.cursor()
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'get-expire_at', (int(titulo_id),))
+            result = cur.fetchall()
 
-        cur.execute(self.queries['get-expire_at'].format(titulo_id))
-        result = cur.fetchall()
+            if result:
+                (action, amount, expire_at) = self._prepare_update(data, result[0][0], result[0][1])
 
-        if result:
-            year = int(result[0][0])
-            month = int(result[0][1])
+                self._execute(cur, 'update-tesouro-direto', (int(titulo_id), action, amount, expire_at))
 
-            assert 'categoria_titulo' not in data, 'Field "categoria_titulo" cannot be updated'
+        if result and self.series_engine is not None:
+            self.series_engine.updated(int(titulo_id), action, amount, expire_at)
+        if result:
+            self._invalidate([result[0][2]])
 
-            fields = list()
+        if result:
+            return True
+        return False
 
-            if 'mês' in data:
-                self._validate_month(data['mês'])
-                month = data['mês']
-            if 'ano' in data:
-                self._validate_year(data['ano'])
-                year = data['ano']
-            if 'ação' in data:
-                self._validate_action(data['ação'].upper())
-                fields.append("action = '{}'".format(data['ação'].upper()))
-            if 'valor' in data:
-                self._validate_amount(data['valor'])
-                fields.append("amount = {}".format(data['valor']))
+    def _prepare_update(self, data, year, month):
+        """Validates the fields of an update of the record expiring at "year"
+        and "month". Returns the new action and amount, None if unchanged, and
+        the new expire_at.
+        """
+        assert 'categoria_titulo' not in data, 'Field "categoria_titulo" cannot be updated'
+
+        action = None
+        amount = None
+
+        if 'mês' in data:
+            self._validate_month(data['mês'])
+            month = data['mês']
+        if 'ano' in data:
+            self._validate_year(data['ano'])
+            year = data['ano']
+        if 'ação' in data:
+            self._validate_action(data['ação'].upper())
+            action = data['ação'].upper()
+        if 'valor' in data:
+            self._validate_amount(data['valor'])
+            amount = data['valor']
+
+        expire_at = datetime.datetime(year, month, 1, 0, 0, 0)
+
+        return (action, amount, expire_at)
+
+    def _read_selection(self, body):
+        """Reads which records a bulk request targets: either a list of "ids"
+        or a "filtro" with "categoria_titulo", "ação", "data_inicio" and
+        "data_fim", all optional but at least one of them.
+        """
+        assert isinstance(body, dict), 'Request body must be an object.'
+        assert ('ids' in body) != ('filtro' in body), 'Request body must have either "ids" or "filtro".'
+
+        if 'ids' in body:
+            ids = body['ids']
+            assert isinstance(ids, list) and ids, '"ids" must be a non-empty list.'
+            assert len(ids) <= BATCH_MAX_SIZE, 'At most {} ids per request.'.format(BATCH_MAX_SIZE)
+            for _id in ids:
+                assert isinstance(_id, int) and not isinstance(_id, bool), '"ids" must be a list of ints.'
+                assert _id > 0, '"ids" must be greater than zero.'
+                assert _id <= self.TITULO_ID_MAX, '"ids" must be at most {}.'.format(self.TITULO_ID_MAX)
+
+            return (list(dict.fromkeys(ids)), None)
+
+        selection = body['filtro']
+        assert isinstance(selection, dict), '"filtro" must be an object.'
+        fields = ['categoria_titulo', 'ação', 'data_inicio', 'data_fim']
+        unknown_fields = [field for field in selection if field not in fields]
+        assert not unknown_fields, 'Unknown fields {} in "filtro".'.format(unknown_fields)
+        assert selection, '"filtro" must have at least one of {}.'.format(fields)
 
-            expire_at = datetime.datetime(year, month, 1, 0, 0, 0).strftime('%Y-%m-%d %H:%M:%S')
-            fields.append("expire_at = '{}'".format(expire_at))
+        category = None
+        action = None
+        if 'categoria_titulo' in selection:
+            self._validate_category(selection['categoria_titulo'])
+            category = selection['categoria_titulo']
+        if 'ação' in selection:
+            self._validate_action(selection['ação'])
+            action = selection['ação'].upper()
+        for field in ('data_inicio', 'data_fim'):
+            assert isinstance(selection.get(field, ''), str), '"{}" must be a string.'.format(field)
+
+        # A bound left out selects every date on that side, not the defaults of
+        # the reads, so that rows dated after today are also reached.
+        (start_date, end_date, _) = self._read_aux([], selection)
+        if 'data_inicio' not in selection:
+            start_date = None
+        if 'data_fim' not in selection:
+            end_date = None
+
+        return (None, (category, action, start_date, end_date))
+
+    def _affected(self, ids, affected):
+        return {
+            'afetados': len(affected),
+            'ids_nao_encontrados': [_id for _id in ids if _id not in affected] if ids is not None else list()
+        }
 
-            fields = ', '.join(fields)
+    def delete_many(self, body):
+        """Deletes the records selected by "body" (see "_read_selection") with
+        a single DELETE. Returns how many were deleted and, when selected by
+        id, the ids that were not found.
+        """
+        (ids, selection) = self._read_selection(body)
 
-            cur.execute(self.queries['update-tesouro-direto'].format(fields, titulo_id))
-	conn.commit()
-        cur.close()
-        conn.close()
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            if ids is not None:
+                self._execute(cur, 'delete-tesouro-direto-by-id', (ids,))
+            else:
+                self._execute(cur, 'delete-tesouro-direto-by-filter', selection)
+            rows = cur.fetchall()
+            deleted = {row[0] for row in rows}
+
+        if self.series_engine is not None:
+            for _id in deleted:
+                self.series_engine.deleted(_id)
+        self._invalidate([row[1] for row in rows])
+
+        return self._affected(ids, deleted)
+
+    def update_many(self, body):
+        """Sets "ação" and/or "valor" of every record selected by "body" (see
+        "_read_selection") with a single UPDATE. Returns how many were updated
+        and, when selected by id, the ids that were not found.
+        """
+        (ids, selection, action, amount) = self._prepare_bulk_update(body)
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            if ids is not None:
+                self._execute(cur, 'update-tesouro-direto-by-id', (ids, action, amount))
+            else:
+                self._execute(cur, 'update-tesouro-direto-by-filter', selection + (action, amount))
+            updated = cur.fetchall()
+
+        if self.series_engine is not None:
+            for (_id, action, amount, expire_at, _) in updated:
+                self.series_engine.updated(_id, action, amount, expire_at)
+        self._invalidate([row[4] for row in updated])
+
+        return self._affected(ids, {row[0] for row in updated})
+
+    def data_version(self, titulo_ids):
+        """Data version of the categories of "titulo_ids", as a pair (version,
+        updated_at), kept by the triggers of "tesouro_direto_versions". It is
+        None when the ids are invalid or none of them exists.
+        """
+        try:
+            for titulo_id in titulo_ids:
+                self._validate_titulo_id(titulo_id)
+        except AssertionError:
+            return None
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'get-version', ([int(_id) for _id in titulo_ids],))
+            (version, updated_at) = cur.fetchall()[0]
+
+        if version is None:
+            return None
+        return (version, updated_at)
+
+    CHANGE_COLUMNS = ['seq', 'op', 'id', 'categoria_titulo', 'acao', 'mes', 'ano', 'valor']
+
+    def _read_changes_params(self, params):
+        since = params.get('since', '0')
+        assert isinstance(since, str) and since.isdigit(), '"since" must be a non-negative int.'
+
+        limit = params.get('limit', str(CHANGES_PAGE_MAX_SIZE))
+        assert isinstance(limit, str) and limit.isdigit() and int(limit) > 0, '"limit" must be a positive int.'
+        assert int(limit) <= CHANGES_PAGE_MAX_SIZE, '"limit" must be at most {}.'.format(CHANGES_PAGE_MAX_SIZE)
+
+        return (int(since), int(limit))
+
+    def _format_changes(self, since, limit, rows):
+        """One row per change, in the order of "CHANGE_COLUMNS", and the
+        "watermark" to send as "since" for the next ones.
+        """
+        return {
+            'since': since,
+            'watermark': rows[:limit][-1][0] if rows else since,
+            'mais': len(rows) > limit,
+            'colunas': self.CHANGE_COLUMNS,
+            'mudancas': [list(row) for row in rows[:limit]]
+        }
 
-        if result:
-            return True
-        return False
+    def read_changes(self, params):
+        """Changes logged after the watermark "since", up to "limit". Entries
+        written since the previous read are sequenced first, unless another
+        reader is already doing it.
+        """
+        (since, limit) = self._read_changes_params(params)
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'lock-changes')
+            if cur.fetchall()[0][0]:
+                self._execute(cur, 'sequence-changes')
+
+            self._execute(cur, 'read-changes', (since, limit + 1))
+            rows = cur.fetchall()
+
+        return self._format_changes(since, limit, rows)
+
+    def _prepare_bulk_update(self, body):
+        """Validates a bulk update. Returns the selection (see
+        "_read_selection") and the new action and amount, None if unchanged.
+        """
+        (ids, selection) = self._read_selection(body)
+
+        data = {field: value for (field, value) in body.items() if field not in ('ids', 'filtro')}
+        assert data, 'Nothing to update, expected "ação" and/or "valor".'
+        assert 'categoria_titulo' not in data, 'Field "categoria_titulo" cannot be updated'
+        unknown_fields = [field for field in data if field not in ('ação', 'valor')]
+        assert not unknown_fields, 'Fields {} cannot be updated in bulk.'.format(unknown_fields)
+
+        action = None
+        amount = None
+        if 'ação' in data:
+            self._validate_action(data['ação'])
+            action = data['ação'].upper()
+        if 'valor' in data:
+            self._validate_amount(data['valor'])
+            amount = round(float(data['valor']), 2)
+
+        return (ids, selection, action, amount)
 
     def _read_aux(self, titulo_id, params):
         if isinstance(titulo_id, list):
@@ -172,121 +519,345 @@ class TituloTesouroCRUD(object):
 
         if 'data_inicio' in params:
             self._validade_date(params['data_inicio'])
-            start_date = date.strptime('{}-01'.format(params['data_inicio']), '%Y-%m-%d')
+            start_date = datetime.datetime.strptime('{}-01'.format(params['data_inicio']), '%Y-%m-%d')
         if 'data_fim' in params:
             self._validade_date(params['data_fim'])
-            end_date = date.strptime('{}-01'.format(params['data_fim']), '%Y-%m-%d')
+            end_date = datetime.datetime.strptime('{}-01'.format(params['data_fim']), '%Y-%m-%d')
         if 'group_by' in params:
             assert params['group_by'] in ('true', 'false'), '"group_by" must be "true" or "false".'
             group_by_year = True if params['group_by'] == 'true' else False
 
-        start_date = start_date.strftime('%Y-%m-%d %H:%M:%S')
-        end_date = end_date.strftime('%Y-%m-%d %H:%M:%S')
-
         return (start_date, end_date, group_by_year)
 
-    def read_history(self, titulo_id, params):
-        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+    def _read_page(self, params, start_date, group_by_year):
+        """Reads "limit" and "cursor", the opaque key of the last month (or
+        year, with "group_by") of the previous page. Returns the size of the
+        page, None when not paginated, and "start_date" moved past the cursor.
+        """
+        if 'limit' not in params and 'cursor' not in params:
+            return (None, start_date)
+
+        limit = PAGE_MAX_SIZE
+        if 'limit' in params:
+            assert params['limit'].isdigit() and int(params['limit']) > 0, '"limit" must be a positive int.'
+            limit = int(params['limit'])
+            assert limit <= PAGE_MAX_SIZE, '"limit" must be at most {}.'.format(PAGE_MAX_SIZE)
+
+        if 'cursor' in params:
+            start_date = max(start_date, self._decode_cursor(params['cursor'], group_by_year))
+
+        return (limit, start_date)
+
+    def _encode_cursor(self, row, group_by_year):
+        key = str(row['ano']) if group_by_year else '{}-{:02d}'.format(row['ano'], row['mes'])
+        return base64.urlsafe_b64encode(key.encode('ascii')).decode('ascii').rstrip('=')
+
+    def _decode_cursor(self, cursor, group_by_year):
+        """First date after the key of "cursor".
+        """
+        try:
+            key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        except (binascii.Error, UnicodeDecodeError):
+            key = ''
+
+        parts = key.split('-')
+        assert len(parts) == (1 if group_by_year else 2) and all(part.isdigit() for part in parts), \
+            'Invalid "cursor".'
+        assert 1 <= int(parts[0]) < 9999, 'Invalid "cursor".'
+
+        if group_by_year:
+            return datetime.datetime(int(parts[0]) + 1, 1, 1)
+
+        (year, month) = (int(parts[0]), int(parts[1]))
+        assert 1 <= month <= 12, 'Invalid "cursor".'
+        return datetime.datetime(year + month // 12, month % 12 + 1, 1)
+
+    def _paginate(self, message, key, limit, group_by_year):
+        """Cuts "message[key]", read with one row more than "limit", to a page
+        and adds the cursor of the next one, None on the last page.
+        """
+        if limit is None:
+            return message
+
+        rows = message[key]
+        message[key] = rows[:limit]
+        message['next'] = self._encode_cursor(rows[limit - 1], group_by_year) if len(rows) > limit else None
+
+        return message
+
+    def _category(self, titulo_id):
+        if self.series_engine is not None:
+            return self.series_engine.category(int(titulo_id))
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'get-category', (int(titulo_id),))
+            result_get_category = cur.fetchall()
+
+        return result_get_category[0][0] if result_get_category else None
+
+    def _chunks(self, rows):
+        for i in range(0, len(rows), STREAM_CHUNK_SIZE):
+            yield rows[i:i + STREAM_CHUNK_SIZE]
+
+    def _iter_rows(self, name, params):
+        """Rows of the query "name" in lists of up to STREAM_CHUNK_SIZE, fetched
+        through a server-side cursor as they are consumed. The cursor is
+        declared and the first list fetched before returning, so that a query
+        that fails to start raises here, before the response is sent. The
+        connection is held until the iterator is exhausted or closed.
+        """
+        chunks = self._cursor_rows(name, params)
+        rows = next(chunks, None)
+        return itertools.chain([rows] if rows is not None else [], chunks)
+
+    def _cursor_rows(self, name, params):
+        with self.pool.connection() as conn:
+            start = time.perf_counter()
+            cur = self.queries.declare(conn, name, params)
+            elapsed = time.perf_counter() - start
+
+            try:
+                while True:
+                    start = time.perf_counter()
+                    rows = cur.fetchmany(STREAM_CHUNK_SIZE)
+                    elapsed += time.perf_counter() - start
+
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                cur.close()
+                record_query(name, elapsed)
+
+                if self.slow_query_log is not None and self.slow_query_log.is_slow(elapsed):
+                    self._log_slow_query(conn, name, params, elapsed)
+
+    def _format_amounts(self, amounts):
+        # None, null in the response, where the month or year has no register
+        # for the action.
+        formatted = iter(BRL.format_many([float(amount) for amount in amounts if amount is not None]))
+        return [next(formatted) if amount is not None else None for amount in amounts]
+
+    def _format_history(self, rows, group_by_year):
+        venda = self._format_amounts([res[-2] for res in rows])
+        resgate = self._format_amounts([res[-1] for res in rows])
+
+        if group_by_year:
+            return [{'ano': res[0], 'valor_venda': venda[i], 'valor_resgate': resgate[i]}
+                    for (i, res) in enumerate(rows)]
+
+        return [{'mes': res[0], 'ano': res[1], 'valor_venda': venda[i], 'valor_resgate': resgate[i]}
+                for (i, res) in enumerate(rows)]
+
+    def _format_by_action(self, rows, group_by_year):
+        amounts = BRL.format_many([float(res[-1]) for res in rows])
+
+        if group_by_year:
+            return [{'ano': res[0], 'valor': amounts[i]}
+                    for (i, res) in enumerate(rows)]
+
+        return [{'ano': res[0], 'mes': res[1], 'valor': amounts[i]}
+                for (i, res) in enumerate(rows)]
+
+    def _query_history(self, titulo_id, start_date, end_date, group_by_year, limit=None):
+        if self.series_engine is not None:
+            category = self.series_engine.category(int(titulo_id))
+            if category is None:
+                return (None, list())
+            return (category, self.series_engine.read_history(category, start_date, end_date, group_by_year)[:limit])
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'get-category', (int(titulo_id),))
+            result_get_category = cur.fetchall()
+
+            if not result_get_category:
+                return (None, list())
+            category = result_get_category[0][0]
 
-        conn = psycopg2.connect(**DATABASE_PARAMS)
-        cur = conn.cursor()
+            if group_by_year:
+                self._execute(cur, 'read-history-grouped', (category, start_date, end_date, limit))
+            else:
+                self._execute(cur, 'read-history', (category, start_date, end_date, limit))
 
-        cur.execute(self.queries['get-category'].format(titulo_id))
-        result_get_category = cur.fetchall()
-        category = None
-        result_history = list()
+            return (category, cur.fetchall())
 
-        if result_get_category:
-            category = result_get_category[0][0]
+    def read_history(self, titulo_id, params):
+        """With "limit" or "cursor" only a page of the history is returned,
+        with the cursor of the next one in "next".
+        """
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+        (limit, start_date) = self._read_page(params, start_date, group_by_year)
 
-            if group_by_year:
-                cur.execute(self.queries['read-history-grouped'].format(category, start_date, end_date))
-                result_history = cur.fetchall()
+        (category, result_history) = self._query_history(titulo_id, start_date, end_date, group_by_year,
+                                                         None if limit is None else limit + 1)
 
-                result_history = [{'ano': int(res[0]), 'valor_venda': format_currency(float(res[1]), 'BRL'),
-                                   'valor_resgate': format_currency(float(res[2]), 'BRL')}
-                                   for res in result_history]
-            else:
-                cur.execute(self.queries['read-history'].format(category, start_date, end_date))
-                result_history = cur.fetchall()
+        result_history = self._format_history(result_history, group_by_year)
 
-                result_history = [{'mes': int(res[0]), 'ano': int(res[1]), 'valor_venda': format_currency(float(res[2]), 'BRL'),
-                                   'valor_resgate': format_currency(float(res[3]), 'BRL')}
-                                   for res in result_history]
+        if category is None:
+            return False
+
+        return self._paginate({
+            'id': int(titulo_id),
+            'categoria_titulo': category,
+            'historico' : result_history
+        }, 'historico', limit, group_by_year)
 
-        cur.close()
-        conn.close()
+    def stream_history(self, titulo_id, params):
+        """Same as "read_history", but "historico" is an iterator over lists of
+        up to STREAM_CHUNK_SIZE rows, read as it is consumed.
+        """
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
 
-        if not result_get_category:
+        category = self._category(titulo_id)
+        if category is None:
             return False
 
+        if self.series_engine is not None:
+            chunks = self._chunks(self.series_engine.read_history(category, start_date, end_date, group_by_year))
+        elif group_by_year:
+            chunks = self._iter_rows('read-history-grouped', (category, start_date, end_date, None))
+        else:
+            chunks = self._iter_rows('read-history', (category, start_date, end_date, None))
+
         return {
             'id': int(titulo_id),
             'categoria_titulo': category,
-            'historico' : result_history
+            'historico': (self._format_history(rows, group_by_year) for rows in chunks)
         }
 
-    def compare(self, params):
+    def _read_compare(self, params):
         assert 'ids' in params, 'Missing mandatory parameter "ids".'
         assert isinstance(params['ids'], list), 'Parameter "ids" must be a list.'
         ids = params['ids']
         assert len(ids) >= 2, 'Must have at least 2 ids.'
         (start_date, end_date, group_by_year) = self._read_aux(ids, params)
 
-        conn = psycopg2.connect(**DATABASE_PARAMS)
-        cur = conn.cursor()
+        return ([int(_id) for _id in ids], start_date, end_date, group_by_year)
 
-        cur.execute(self.queries['get-category-by-id'].format(", ".join(ids)))
-        result_get_category_by_id = cur.fetchall()
-        result = list()
+    def _cells(self, values, present):
+        return [[value if has_value else None for (value, has_value) in zip(row, mask)]
+                for (row, mask) in zip(numpy.round(values, 2).tolist(), present.tolist())]
 
-        if result_get_category_by_id and len(result_get_category_by_id) == len(ids):
-            cur.execute(self.queries['compare'].format(start_date, end_date, ", ".join(ids)))
-            result = cur.fetchall()
+    def _format_comparison(self, ids, series, matrix, group_by_year):
+        """Rows of the matrix, by month or by year, with the values of each id
+        and their differences to the first one, then the totals.
+        """
+        if group_by_year:
+            (years, amounts, present) = matrix.yearly()
+            periods = [{'ano': year} for year in years]
+        else:
+            (months, amounts, present) = matrix.monthly()
+            periods = [{'mes': month, 'ano': year} for (year, month) in months]
 
-        cur.close()
-        conn.close()
+        values = self._cells(amounts, present)
+        differences = self._cells(*matrix.differences(amounts, present))
 
-        if (not result_get_category_by_id) or len(result_get_category_by_id) < len(ids):
-            return False
+        (totals, has_totals) = matrix.totals()
 
-        return result
+        return {
+            'series': [{'id': _id, 'categoria_titulo': series[_id][0], 'acao': series[_id][1]} for _id in ids],
+            'comparacao': [dict(period, valores=values[i], diferencas=differences[i])
+                           for (i, period) in enumerate(periods)],
+            'totais': {
+                'valores': self._cells(totals, has_totals)[0],
+                'diferencas': self._cells(*matrix.differences(totals, has_totals))[0]
+            }
+        }
 
-    def read_by_action(self, titulo_id, action, params):
-        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+    def compare(self, params):
+        """Compares the series, (category, action), of each id: one column per
+        id, aligned by month (or year, with "group_by").
+        """
+        (ids, start_date, end_date, group_by_year) = self._read_compare(params)
+
+        if self.series_engine is not None:
+            series = {_id: self.series_engine.series(_id) for _id in ids}
+            series = {_id: row for (_id, row) in series.items() if row is not None}
+            if len(series) < len(ids):
+                return False
+
+            matrix = ComparisonMatrix(*self.series_engine.read_matrix([series[_id] for _id in ids],
+                                                                      start_date, end_date))
+            return self._format_comparison(ids, series, matrix, group_by_year)
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'get-series-by-id', (ids,))
+            series = {_id: (category, action) for (_id, category, action) in cur.fetchall()}
+            if len(series) < len(ids):
+                return False
+
+            self._execute(cur, 'compare', (start_date, end_date, ids))
+            cells = cur.fetchall()
+
+        matrix = ComparisonMatrix.from_cells([row[0] for row in cells], [row[1] for row in cells],
+                                             [row[2] for row in cells], len(ids))
+        return self._format_comparison(ids, series, matrix, group_by_year)
+
+    def _query_by_action(self, titulo_id, action, start_date, end_date, group_by_year, limit=None):
+        if self.series_engine is not None:
+            category = self.series_engine.category(int(titulo_id))
+            if category is None:
+                return (None, list())
+            return (category, self.series_engine.read_by_action(category, action, start_date, end_date,
+                                                                group_by_year)[:limit])
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._execute(cur, 'get-category', (int(titulo_id),))
+            result_get_category = cur.fetchall()
+
+            if not result_get_category:
+                return (None, list())
+            category = result_get_category[0][0]
 
-        conn = psycopg2.connect(**DATABASE_PARAMS)
-        cur = conn.cursor()
+            if group_by_year:
+                self._execute(cur, 'read-by-action-grouped', (action.upper(), category, start_date, end_date,
+                                                                     limit))
+            else:
+                self._execute(cur, 'read-by-action', (action.upper(), category, start_date, end_date, limit))
 
-        cur.execute(self.queries['get-category'].format(titulo_id))
-        result_get_category = cur.fetchall()
-        category = None
-        result = list()
+            return (category, cur.fetchall())
 
-        if result_get_category:
-            category = result_get_category[0][0]
+    def read_by_action(self, titulo_id, action, params):
+        """Paginated as "read_history".
+        """
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+        (limit, start_date) = self._read_page(params, start_date, group_by_year)
 
-            if group_by_year:
-                cur.execute(self.queries['read-by-action-grouped'].format(action.upper(), category, start_date, end_date))
-                result = cur.fetchall()
+        (category, result) = self._query_by_action(titulo_id, action, start_date, end_date, group_by_year,
+                                                   None if limit is None else limit + 1)
 
-                result = [{'ano': int(res[0]), 'valor': format_currency(float(res[1]), 'BRL')}
-                          for res in result]
-            else:
-                cur.execute(self.queries['read-by-action'].format(action.upper(), category, start_date, end_date))
-                result = cur.fetchall()
+        result = self._format_by_action(result, group_by_year)
 
-                result = [{'ano': int(res[0]), 'mes': int(res[1]), 'valor': format_currency(float(res[2]), 'BRL')}
-                          for res in result]
+        if category is None:
+            return False
 
-        cur.close()
-        conn.close()
+        return self._paginate({
+            'id': int(titulo_id),
+            'categoria_titulo': category,
+            'valores_{}'.format(action) : result
+        }, 'valores_{}'.format(action), limit, group_by_year)
 
-        if not result_get_category:
+    def stream_by_action(self, titulo_id, action, params):
+        """Same as "read_by_action", but the values are an iterator over lists
+        of up to STREAM_CHUNK_SIZE rows, read as it is consumed.
+        """
+        (start_date, end_date, group_by_year) = self._read_aux(titulo_id, params)
+
+        category = self._category(titulo_id)
+        if category is None:
             return False
 
+        if self.series_engine is not None:
+            chunks = self._chunks(self.series_engine.read_by_action(category, action, start_date, end_date,
+                                                                    group_by_year))
+        elif group_by_year:
+            chunks = self._iter_rows('read-by-action-grouped', (action.upper(), category, start_date, end_date,
+                                                                None))
+        else:
+            chunks = self._iter_rows('read-by-action', (action.upper(), category, start_date, end_date, None))
+
         return {
             'id': int(titulo_id),
             'categoria_titulo': category,
-            'valores_{}'.format(action) : result
+            'valores_{}'.format(action): (self._format_by_action(rows, group_by_year) for rows in chunks)
         }
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
+import argparse
+import collections
+import csv
+import glob
+import hashlib
+import io
+import itertools
 import logging
+import multiprocessing
 import openpyxl
+import os
 import psycopg2
+import time
 
 try:
-    from basics import SCHEMAS_PATH, DATABASE_PARAMS, RESOURCES_PATH, TRANSACTIONS_PATH
+    from basics import SCHEMAS_PATH, DATABASE_PARAMS, RESOURCES_PATH, MAINTENANCE_PATH, COPY_CHUNK_SIZE
+    from basics import LOADER_WORKERS, CHANGE_LOG_RETENTION_HOURS
 except ImportError:
-    from src.basics import SCHEMAS_PATH, DATABASE_PARAMS, RESOURCES_PATH, TRANSACTIONS_PATH
+    from src.basics import SCHEMAS_PATH, DATABASE_PARAMS, RESOURCES_PATH, MAINTENANCE_PATH, COPY_CHUNK_SIZE
+    from src.basics import LOADER_WORKERS, CHANGE_LOG_RETENTION_HOURS
 
 
 logging.basicConfig(format='[%(asctime)s] [%(levelname)s] %(message)s',
@@ -62,59 +74,431 @@ def get_multiplier(raw):
         return 1000*1000
     return 1
 
+DATE_COLUMN = 2
+LAST_COLUMN = 14
+HEADER_ROW = 7
+UNIT_ROW = 10
+FIRST_DATA_ROW = 12
+
+
+def iter_xlsx(xlsx_filepath):
+    """Streams the values of the "Planilha1" sheet as (category, action, date,
+    amount) tuples, one spreadsheet row at a time. The workbook is opened in
+    read-only mode, so memory does not grow with the number of rows.
+    """
+    workbook = openpyxl.load_workbook(xlsx_filepath, read_only=True, data_only=True)
+    worksheet = workbook['Planilha1']
+
+    categories = list()
+    actions = list()
+    multipliers = list()
+
+    try:
+        for (i, row) in enumerate(worksheet.iter_rows(min_row=HEADER_ROW, min_col=DATE_COLUMN,
+                                                      max_col=LAST_COLUMN, values_only=True), HEADER_ROW):
+            date = row[0]
+            cells = row[1:]
+
+            if i == HEADER_ROW:
+                for cell in cells:
+                    value_splitted = cell.split('- Tesouro Direto - ')
+                    categories.append(value_splitted[1])
+                    actions.append(get_action(value_splitted[0][15 : ].strip()))
+            elif i == UNIT_ROW:
+                for cell in cells:
+                    multipliers.append(get_multiplier(cell.split('\xa0')[1]))
+            elif i >= FIRST_DATA_ROW:
+                if date is None:
+                    break
+
+                for (category, action, multiplier, amount) in zip(categories, actions, multipliers, cells):
+                    yield (category, action, date, float(amount) * multiplier)
+    finally:
+        workbook.close()
+
+
 def read_xlsx(filename, verbose=True):
     xlsx_filepath = '{}/{}'.format(RESOURCES_PATH, filename)
     if verbose:
         logging.info('Reading data from file "{}".'.format(xlsx_filepath))
-    workbook = openpyxl.load_workbook(xlsx_filepath)
-    worksheet = workbook['Planilha1']
 
-    values = list()
+    values = list(iter_xlsx(xlsx_filepath))
 
     if verbose:
-        logging.info('Reading values.')
-    for j in range(ord('C'), ord('O')):
-        column = chr(j)
+        logging.info('All values read.\n')
+
+    return values
+
 
-        value_splitted = worksheet['{}7'.format(column)].value.split('- Tesouro Direto - ')
-        category = value_splitted[1]
-        action = get_action(value_splitted[0][15 : ].strip())
+def copy_values(cur, values, chunk_size=COPY_CHUNK_SIZE, table='tesouro_direto_series'):
+    """Feeds the (category, action, date, amount) tuples through "COPY ... FROM
+    STDIN" in chunks of at most "chunk_size" rows. Returns how many rows were
+    copied.
+    """
+    sql = 'COPY {} (category, action, expire_at, amount) FROM STDIN WITH (FORMAT csv)'.format(table)
+    count = 0
 
-        value_splitted = worksheet['{}10'.format(column)].value.split('\xa0')
-        multiplier = get_multiplier(value_splitted[1])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for chunk in iter(lambda: list(itertools.islice(values, chunk_size)), []):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        buffer.seek(0)
 
-        for i in range(12, 136):
-            date = worksheet['B{}'.format(i)].value
-            amount = worksheet['{}{}'.format(column, i)].value
-            amount = float(amount) * multiplier
+        cur.copy_expert(sql, buffer)
+        count += len(chunk)
 
-            value = "('{}', '{}', '{}', {})".format(category, action, date, amount)
-            values.append(value)
+    return count
+
+
+def populate_database(values, verbose=True, chunk_size=COPY_CHUNK_SIZE):
+    """Bulk loads the values, a list or any iterable of (category, action,
+    date, amount) tuples, in a single transaction.
+    """
+    conn = psycopg2.connect(**DATABASE_PARAMS)
+    cur = conn.cursor()
+
+    start = time.perf_counter()
+    count = copy_values(cur, iter(values), chunk_size)
+    conn.commit()
+    elapsed = time.perf_counter() - start
 
     if verbose:
-        logging.info('All values read.\n')
+        logging.info('{} rows loaded in {:.2f}s ({:.0f} rows/s).\n'.format(
+            count, elapsed, count / elapsed if elapsed else 0))
 
-    return values
+    cur.close()
+    conn.close()
 
+    return count
 
-def populate_database(values, verbose=True):
-    with open('{}/load-input-data.sql'.format(TRANSACTIONS_PATH)) as f:
-        sql = f.read()
-    sql = sql.format(',\n    '.join(values))
+
+def resolve_workbooks(source):
+    """Expands "source", relative to the resources folder unless absolute, into
+    the sorted list of workbooks it names: a single file, every ".xlsx" in a
+    directory, or the files matching a glob.
+    """
+    path = os.path.join(RESOURCES_PATH, source)
+
+    if any(c in path for c in '*?['):
+        xlsx_filepaths = sorted(glob.glob(path))
+    elif os.path.isdir(path):
+        xlsx_filepaths = sorted(glob.glob(os.path.join(path, '*.xlsx')))
+    else:
+        xlsx_filepaths = [path]
+
+    assert xlsx_filepaths, 'No workbook found for "{}".'.format(source)
+    return xlsx_filepaths
+
+
+def stream_workbook(xlsx_filepath, chunks, chunk_size):
+    """Puts the values of the workbook on the "chunks" queue in lists of up to
+    "chunk_size", then None, or the exception that stopped the parsing. The
+    queue is bounded, so the process waits for the writer instead of holding
+    the whole workbook.
+    """
+    try:
+        values = iter_xlsx(xlsx_filepath)
+        for chunk in iter(lambda: list(itertools.islice(values, chunk_size)), []):
+            chunks.put(chunk)
+    except Exception as e:
+        chunks.put(e)
+    else:
+        chunks.put(None)
+
+
+def iter_parsed_workbooks(xlsx_filepaths, workers, chunk_size, verbose=True):
+    """Values of the workbooks, in order, each parsed by a process of its own,
+    openpyxl being CPU bound, up to "workers" of them at a time. Each process
+    hands its values over a queue of at most two chunks, so the next workbooks
+    are parsed while one is consumed but no process holds more than a few
+    chunks.
+    """
+    pending = iter(xlsx_filepaths)
+    running = collections.deque()
+
+    def start_next():
+        xlsx_filepath = next(pending, None)
+        if xlsx_filepath is not None:
+            chunks = multiprocessing.Queue(2)
+            process = multiprocessing.Process(target=stream_workbook, args=(xlsx_filepath, chunks, chunk_size),
+                                              daemon=True)
+            process.start()
+            running.append((xlsx_filepath, chunks, process))
+
+    try:
+        for _ in range(max(1, workers)):
+            start_next()
+
+        while running:
+            (xlsx_filepath, chunks, process) = running[0]
+
+            count = 0
+            for chunk in iter(chunks.get, None):
+                if isinstance(chunk, Exception):
+                    raise chunk
+
+                count += len(chunk)
+                yield from chunk
+
+            process.join()
+            running.popleft()
+            start_next()
+
+            if verbose:
+                logging.info('{} values read from "{}".'.format(count, xlsx_filepath))
+    finally:
+        # Values no longer consumed, on a failure or when the writer stops.
+        for (_, _, process) in running:
+            process.terminate()
+            process.join()
+
+
+def iter_workbooks(xlsx_filepaths, workers=LOADER_WORKERS, verbose=True, chunk_size=COPY_CHUNK_SIZE):
+    """Merges the values of the workbooks into a single stream for the writer.
+    A single workbook is streamed as it is read. Several are parsed in
+    parallel (see "iter_parsed_workbooks") and, when they overlap, only the
+    first value of each (category, action, month) is kept, in the order the
+    workbooks were given.
+    """
+    if len(xlsx_filepaths) == 1:
+        yield from iter_xlsx(xlsx_filepaths[0])
+        return
+
+    # One byte per month of each series, so what is remembered is bounded by
+    # the months spanned and not by the number of values.
+    seen = collections.defaultdict(bytearray)
+    duplicates = 0
+
+    for value in iter_parsed_workbooks(xlsx_filepaths, workers, chunk_size, verbose):
+        (category, action, date, _) = value
+        months = seen[(category, action)]
+        month = date.year * 12 + date.month - 1
+
+        if month < len(months) and months[month]:
+            duplicates += 1
+            continue
+
+        if month >= len(months):
+            months.extend(bytes(month + 1 - len(months)))
+        months[month] = 1
+        yield value
+
+    if verbose and duplicates:
+        logging.info('{} overlapping values ignored.'.format(duplicates))
+
+
+def load_xlsx(source, verbose=True, chunk_size=COPY_CHUNK_SIZE, workers=LOADER_WORKERS):
+    """Loads one or more workbooks (see "resolve_workbooks") through a single
+    bulk writer.
+    """
+    xlsx_filepaths = resolve_workbooks(source)
+    if verbose:
+        logging.info('Loading data from {} file(s) matching "{}".'.format(len(xlsx_filepaths), source))
+
+    return populate_database(iter_workbooks(xlsx_filepaths, workers, verbose, chunk_size), verbose=verbose,
+                             chunk_size=chunk_size)
+
+
+def fingerprint_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_maintenance_sql(filename):
+    with open('{}/{}'.format(MAINTENANCE_PATH, filename)) as f:
+        return f.read()
+
+
+def schema_exists():
     conn = psycopg2.connect(**DATABASE_PARAMS)
     cur = conn.cursor()
-    cur.execute(sql)
+
+    cur.execute(read_maintenance_sql('get-schema.sql'))
+    (exists,) = cur.fetchone()
+
+    cur.close()
+    conn.close()
+
+    return exists
+
+
+def sync_database(values, fingerprint, source, force=False, verbose=True, chunk_size=COPY_CHUNK_SIZE):
+    """Brings "tesouro_direto_series" in line with the values without dropping
+    anything: the values are copied to a staging table, diffed against the
+    table by (category, action, expire_at) and only the differences are
+    applied, in a single transaction. Ids of unchanged rows are kept.
+
+    Sources whose fingerprint was already synced are skipped unless "force"
+    is set. Returns a summary of the changes, or None when skipped.
+    """
+    conn = psycopg2.connect(**DATABASE_PARAMS)
+    cur = conn.cursor()
+
+    start = time.perf_counter()
+    cur.execute(read_maintenance_sql('begin-sync.sql'))
+
+    cur.execute(read_maintenance_sql('get-load.sql'), (fingerprint,))
+    previous = cur.fetchall()
+    if previous and not force:
+        conn.rollback()
+        cur.close()
+        conn.close()
+
+        if verbose:
+            logging.info('"{}" already synced at {} as "{}", nothing to do.\n'.format(
+                source, previous[0][1], previous[0][0]))
+        return None
+
+    rows = copy_values(cur, values, chunk_size, table='tesouro_direto_staging')
+
+    cur.execute(read_maintenance_sql('sync-upsert.sql'))
+    upserted = cur.fetchall()
+    inserted = sum(1 for (is_insert,) in upserted if is_insert)
+    updated = len(upserted) - inserted
+
+    cur.execute(read_maintenance_sql('sync-delete.sql'))
+    deleted = cur.rowcount
+
+    cur.execute(read_maintenance_sql('register-load.sql'), (fingerprint, source, inserted, updated, deleted))
+    conn.commit()
+
+    cur.close()
+    conn.close()
+
+    summary = {
+        'rows': rows,
+        'inserted': inserted,
+        'updated': updated,
+        'deleted': deleted,
+        'unchanged': rows - inserted - updated
+    }
+
+    if verbose:
+        logging.info('"{}" synced in {:.2f}s: {} rows read, {} inserted, {} updated, {} deleted, {} unchanged.\n'.format(
+            source, time.perf_counter() - start, summary['rows'], summary['inserted'], summary['updated'],
+            summary['deleted'], summary['unchanged']))
+
+    return summary
+
+
+def sync_xlsx(source, force=False, verbose=True, chunk_size=COPY_CHUNK_SIZE, workers=LOADER_WORKERS):
+    xlsx_filepaths = resolve_workbooks(source)
+    if verbose:
+        logging.info('Syncing data from {} file(s) matching "{}".'.format(len(xlsx_filepaths), source))
+
+    # The fingerprint of a set of workbooks changes if any of them, or the
+    # order in which they take precedence, changes.
+    digest = hashlib.sha256()
+    for xlsx_filepath in xlsx_filepaths:
+        digest.update('{}:{}\n'.format(os.path.basename(xlsx_filepath), fingerprint_file(xlsx_filepath)).encode('utf8'))
+
+    return sync_database(iter_workbooks(xlsx_filepaths, workers, verbose, chunk_size), digest.hexdigest(), source,
+                         force=force, verbose=verbose, chunk_size=chunk_size)
+
+
+def check_yearly_aggregates(repair=False, verbose=True):
+    """Compares "tesouro_direto_yearly" with the totals computed from the raw
+    series and, if "repair" is set, rebuilds it when they differ. Returns the
+    mismatching (category, action, year) rows found.
+    """
+    conn = psycopg2.connect(**DATABASE_PARAMS)
+    cur = conn.cursor()
+
+    cur.execute(read_maintenance_sql('check-yearly.sql'))
+    mismatches = cur.fetchall()
+    conn.rollback()
+
+    if verbose:
+        for (category, action, year, stored_amount, expected_amount, stored_count, expected_count) in mismatches:
+            logging.warning('Yearly total of {} {} {} is {} ({} rows), expected {} ({} rows).'.format(
+                category, action, year, stored_amount, stored_count, expected_amount, expected_count))
+        logging.info('{} inconsistent yearly totals found.\n'.format(len(mismatches)))
+
+    if mismatches and repair:
+        cur.execute(read_maintenance_sql('rebuild-yearly.sql'))
+        conn.commit()
+
+        if verbose:
+            logging.info('Yearly totals rebuilt from raw data.\n')
+
+    cur.close()
+    conn.close()
+
+    return mismatches
+
+
+def compact_changes(retention_hours=CHANGE_LOG_RETENTION_HOURS, verbose=True):
+    """Deletes the entries of "tesouro_direto_changes" older than
+    "retention_hours" that later entries supersede. Meant to be scheduled,
+    e.g. daily with cron. Returns the number of entries deleted.
+    """
+    conn = psycopg2.connect(**DATABASE_PARAMS)
+    cur = conn.cursor()
+
+    start = time.perf_counter()
+    cur.execute(read_maintenance_sql('compact-changes.sql'), {'retention_hours': retention_hours})
+    deleted = cur.rowcount
     conn.commit()
+
     cur.close()
     conn.close()
 
+    if verbose:
+        logging.info('Change log compacted in {:.2f}s: {} entries older than {} hours deleted.\n'.format(
+            time.perf_counter() - start, deleted, retention_hours))
+
+    return deleted
+
 
 if __name__ == '__main__':
-    logging.info('Preparing to load system.\n')
+    parser = argparse.ArgumentParser(description='Loads and maintains the database. By default the workbook is '
+                                                 'synced incrementally into the existing tables.')
+    parser.add_argument('--source', default='input-data.xlsx',
+                        help='workbook, directory of workbooks or glob, relative to "resources" '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=LOADER_WORKERS,
+                        help='processes used to parse the workbooks (default: %(default)s)')
+    parser.add_argument('--reload', action='store_true',
+                        help='drop and recreate the database, then load the workbook from scratch')
+    parser.add_argument('--force', action='store_true',
+                        help='sync the workbook even if it was synced before')
+    parser.add_argument('--create-schema', action='store_true',
+                        help='run "create-all.sql" before syncing even if the tables exist, e.g. to add the '
+                             'columns and indexes of a newer version')
+    parser.add_argument('--check-yearly', action='store_true',
+                        help='only check the yearly totals against the raw series')
+    parser.add_argument('--rebuild-yearly', action='store_true',
+                        help='check the yearly totals and rebuild them if inconsistent')
+    parser.add_argument('--compact-changes', action='store_true',
+                        help='only compact the change log, see CHANGE_LOG_RETENTION_HOURS')
+    parser.add_argument('--chunk-size', type=int, default=COPY_CHUNK_SIZE,
+                        help='rows sent per COPY chunk (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.check_yearly or args.rebuild_yearly:
+        check_yearly_aggregates(repair=args.rebuild_yearly)
+    elif args.compact_changes:
+        compact_changes()
+    elif not args.reload:
+        logging.info('Preparing to sync system.\n')
+
+        # "create-all.sql" recreates the triggers, locking the live tables, so
+        # it only runs on a new database or when asked to.
+        if args.create_schema or not schema_exists():
+            create_database()
+        sync_xlsx(args.source, force=args.force, chunk_size=args.chunk_size, workers=args.workers)
+
+        logging.info('System synced.\n')
+    else:
+        logging.info('Preparing to load system.\n')
 
-    drop_database()
-    create_database()
-    values = read_xlsx('input-data.xlsx')
-    populate_database(values)
+        drop_database()
+        create_database()
+        load_xlsx(args.source, chunk_size=args.chunk_size, workers=args.workers)
 
-    logging.info('System loaded.\n')
+        logging.info('System loaded.\n')
@@ -1,13 +1,26 @@
+import datetime
+import falcon
+import falcon.testing
 import json
 import os
+import psycopg2
 import requests
 import sys
+import threading
+import time
 import unittest
 
 sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
 
-from src.basics import DATABASE_PARAMS, TITULO_TESOURO_CATEGORIES, TITULO_TESOURO_ACTIONS
-from src.system_loader import drop_database, create_database, read_xlsx, populate_database
+from src.basics import DATABASE_PARAMS, TITULO_TESOURO_CATEGORIES, TITULO_TESOURO_ACTIONS, SLOW_QUERY_ENDPOINT_ENABLED
+from src.database import ConnectionPool
+from src.endpoints import EndpointExpositor
+from src.queries import QueryCatalog
+from src.response_cache import ResponseCache
+from src.series_engine import SeriesEngine
+from src.services import TituloTesouroCRUD
+from src.system_loader import drop_database, create_database, read_xlsx, populate_database, compact_changes, \
+    sync_database
 
 
 class TestRequestHandler(unittest.TestCase):
@@ -100,8 +113,403 @@ class TestTituloTesouroRefinedRequestHandler(TestRequestHandler):
         self.assertEqual(resp.json()['err'], 'One of the ids was not found.')
 
 
+    def test_compare_aligned_by_month(self):
+        resp = requests.get('{}/comparar'.format(TestRequestHandler.BASE_URL), params={
+            'ids': [1, 33],
+            'data_inicio': '2015-01',
+            'data_fim': '2015-06'
+        })
+
+        self.assertEqual(resp.status_code, 200)
+        ret = resp.json()['success']
+        self.assertEqual([serie['id'] for serie in ret['series']], [1, 33])
+        self.assertEqual([(row['ano'], row['mes']) for row in ret['comparacao']],
+                         [(2015, month) for month in range(1, 7)])
+
+        for row in ret['comparacao']:
+            self.assertEqual(len(row['valores']), 2)
+            self.assertEqual(row['diferencas'], [0.0, round(row['valores'][1] - row['valores'][0], 2)])
+
+        self.assertEqual(ret['totais']['valores'],
+                         [round(sum(row['valores'][i] for row in ret['comparacao']), 2) for i in range(2)])
+
+    def test_compare_grouped_by_year(self):
+        resp = requests.get('{}/comparar/'.format(TestRequestHandler.BASE_URL), params={
+            'ids': [1, 33],
+            'data_inicio': '2015-01',
+            'data_fim': '2016-12',
+            'group_by': 'true'
+        })
+
+        self.assertEqual(resp.status_code, 200)
+        ret = resp.json()['success']
+        self.assertEqual([row['ano'] for row in ret['comparacao']], [2015, 2016])
+        self.assertEqual(ret['totais']['valores'],
+                         [round(sum(row['valores'][i] for row in ret['comparacao']), 2) for i in range(2)])
+
+
+    def test_read_history_by_pages(self):
+        params = {'data_inicio': '2010-01', 'data_fim': '2015-12'}
+        history = requests.get('{}/5'.format(TestRequestHandler.BASE_URL), params=params).json()['success']
+
+        pages = list()
+        resp = requests.get('{}/5'.format(TestRequestHandler.BASE_URL), params=dict(params, limit=25))
+        while True:
+            self.assertEqual(resp.status_code, 200)
+            page = resp.json()['success']
+            self.assertLessEqual(len(page['historico']), 25)
+            pages.extend(page['historico'])
+
+            if page['next'] is None:
+                break
+            resp = requests.get('http://localhost:8000{}'.format(page['next']))
+
+        self.assertEqual(pages, history['historico'])
+
+    def test_read_by_action_with_invalid_page(self):
+        resp = requests.get('{}/venda/5'.format(TestRequestHandler.BASE_URL), params={'limit': 0})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json()['err'], '"limit" must be a positive int.')
+
+        resp = requests.get('{}/venda/5'.format(TestRequestHandler.BASE_URL), params={'cursor': '2015-05'})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json()['err'], 'Invalid "cursor".')
+
+    def test_response_cache_invalidated_by_writes(self):
+        url = '{}/5'.format(TestRequestHandler.BASE_URL)
+
+        hits = lambda: 'titulo_tesouro_response_cache_events_total{event="hits"}' in \
+            requests.get('http://localhost:8000/metrics').text
+
+        # The notifications of the load of the data drop the entries of the
+        # category until the workers are through them.
+        first = requests.get(url).json()
+        deadline = time.monotonic() + 10
+        while not hits() and time.monotonic() < deadline:
+            self.assertEqual(requests.get(url).json(), first)
+        self.assertTrue(hits())
+
+        resp = requests.put(url, data=json.dumps({'valor': 12.34}))
+        self.assertEqual(resp.status_code, 200)
+
+        amounts = lambda history: [row[key] for row in history for key in ('valor_venda', 'valor_resgate')]
+        self.assertNotIn('R$\xa012.34', amounts(first['success']['historico']))
+        self.assertIn('R$\xa012.34', amounts(requests.get(url).json()['success']['historico']))
+
+    def test_event_stream(self):
+        events = requests.get('{}/eventos'.format(TestRequestHandler.BASE_URL),
+                              params={'categoria_titulo': 'NTN-C'}, stream=True)
+
+        self.assertEqual(events.status_code, 200)
+        self.assertTrue(events.headers['Content-Type'].startswith('text/event-stream'))
+
+        lines = events.iter_lines(decode_unicode=True)
+        self.assertEqual(next(lines), 'retry: 1000')
+
+        # Records 1 and 5 are of categories LTN and NTN-C.
+        for titulo_id in (1, 5):
+            resp = requests.put('{}/{}'.format(TestRequestHandler.BASE_URL, titulo_id),
+                                data=json.dumps({'valor': 12.34}))
+            self.assertEqual(resp.status_code, 200)
+
+        # The inserts of the load of the data may still be coming.
+        for line in lines:
+            if line == 'event: update':
+                break
+        data = next(lines)
+        events.close()
+
+        self.assertEqual(json.loads(data[len('data: '):]),
+                         {'op': 'update', 'categoria_titulo': 'NTN-C', 'ação': 'venda', 'registros': 1})
+
+    def test_changes(self):
+        url = '{}/changes'.format(TestRequestHandler.BASE_URL)
+
+        resp = requests.get(url, params={'limit': 5})
+
+        self.assertEqual(resp.status_code, 200)
+        page = resp.json()['success']
+        self.assertEqual(page['colunas'], ['seq', 'op', 'id', 'categoria_titulo', 'acao', 'mes', 'ano', 'valor'])
+        self.assertEqual(len(page['mudancas']), 5)
+        self.assertTrue(page['mais'])
+        # A new log starts with a truncate, then come the inserts of the load.
+        self.assertEqual([row[1] for row in page['mudancas']], ['truncate'] + ['insert'] * 4)
+        self.assertEqual(page['watermark'], page['mudancas'][-1][0])
+
+        watermark = requests.get(url, params={'since': page['watermark']}).json()['success']['watermark']
+        resp = requests.put('{}/5'.format(TestRequestHandler.BASE_URL), data=json.dumps({'valor': 12.34}))
+        self.assertEqual(resp.status_code, 200)
+
+        changes = requests.get(url, params={'since': watermark}).json()['success']
+
+        self.assertEqual(len(changes['mudancas']), 1)
+        self.assertEqual(changes['mudancas'][0][:5], [changes['watermark'], 'update', 5, 'NTN-C', 'venda'])
+        self.assertEqual(changes['mudancas'][0][7], 12.34)
+        self.assertGreater(changes['watermark'], watermark)
+        self.assertFalse(changes['mais'])
+
+        changes = requests.get(url, params={'since': changes['watermark']}).json()['success']
+
+        self.assertEqual(changes['mudancas'], list())
+        self.assertEqual(changes['watermark'], changes['since'])
+
+        resp = requests.get(url, params={'since': '-1'})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json()['err'], '"since" must be a non-negative int.')
+
+    def test_changes_compaction(self):
+        url = '{}/changes'.format(TestRequestHandler.BASE_URL)
+
+        for amount in (12.34, 56.78):
+            requests.put('{}/5'.format(TestRequestHandler.BASE_URL), data=json.dumps({'valor': amount}))
+
+        # Only the entries already sequenced, by a read, are compacted.
+        before = requests.get(url).json()['success']['mudancas']
+        compact_changes(retention_hours=0, verbose=False)
+        after = requests.get(url).json()['success']['mudancas']
+
+        self.assertEqual([row[1] for row in before if row[2] == 5], ['insert', 'update', 'update'])
+        self.assertEqual([(row[1], row[7]) for row in after if row[2] == 5], [('update', 56.78)])
+        self.assertEqual(len(after), len(before) - 2)
+        self.assertEqual(after[0][1], 'truncate')
+
+    def test_history_with_a_single_action(self):
+        # Record 1 is of category LTN, which has no register in 2030.
+        resp = requests.post(TestRequestHandler.BASE_URL, data=json.dumps({
+            'categoria_titulo': 'LTN',
+            'mês': 5,
+            'ano': 2030,
+            'ação': 'venda',
+            'valor': 12.34
+        }))
+        self.assertEqual(resp.status_code, 201)
+
+        interval = {'data_inicio': '2030-01', 'data_fim': '2030-12'}
+        resp = requests.get('{}/1'.format(TestRequestHandler.BASE_URL), params=interval)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['success']['historico'],
+                         [{'mes': 5, 'ano': 2030, 'valor_venda': 'R$\xa012.34', 'valor_resgate': None}])
+
+        resp = requests.get('{}/1'.format(TestRequestHandler.BASE_URL), params=dict(interval, group_by='true'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['success']['historico'],
+                         [{'ano': 2030, 'valor_venda': 'R$\xa012.34', 'valor_resgate': None}])
+
+    def test_sync_deletes_only_within_the_months_of_the_workbook(self):
+        resp = requests.post(TestRequestHandler.BASE_URL, data=json.dumps({
+            'categoria_titulo': 'LTN',
+            'mês': 5,
+            'ano': 2030,
+            'ação': 'venda',
+            'valor': 12.34
+        }))
+        self.assertEqual(resp.status_code, 201)
+
+        # A workbook of 2010 only, that lacks June.
+        values = [value for value in read_xlsx('input-data.xlsx', verbose=False)
+                  if value[2].year == 2010 and value[2].month != 6]
+        summary = sync_database(iter(values), 'partial', 'partial.xlsx', verbose=False)
+
+        self.assertEqual(summary['deleted'], len(TITULO_TESOURO_CATEGORIES) * len(TITULO_TESOURO_ACTIONS))
+        self.assertEqual(summary['inserted'] + summary['updated'], 0)
+
+        conn = psycopg2.connect(**DATABASE_PARAMS)
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT count(*), count(*) FILTER (WHERE year = 2010 AND month_key % 12 = 5) '
+                            'FROM tesouro_direto_series')
+                (count, june_2010) = cur.fetchone()
+        finally:
+            conn.close()
+
+        self.assertEqual(june_2010, 0)
+        self.assertEqual(count, 1488 - summary['deleted'] + 1)
+
+    def test_create_database_adds_month_columns(self):
+        url = '{}/1'.format(TestRequestHandler.BASE_URL)
+        params = {'data_inicio': '2010-03', 'data_fim': '2012-08', 'group_by': 'true'}
+        before = requests.get(url, params=params).json()['success']['historico']
+
+        # As in a database created before the columns, and their indexes.
+        conn = psycopg2.connect(**DATABASE_PARAMS)
+        try:
+            with conn.cursor() as cur:
+                cur.execute('ALTER TABLE tesouro_direto_series DROP COLUMN month_key, DROP COLUMN year')
+            conn.commit()
+        finally:
+            conn.close()
+
+        create_database(verbose=False)
+
+        # With "limit", so that the response is not the one cached before.
+        after = requests.get(url, params=dict(params, limit='10')).json()['success']['historico']
+        self.assertEqual(after, before)
+        self.assertEqual([row['ano'] for row in after], [2010, 2011, 2012])
+
+    def test_read_query_plans(self):
+        # At the size of the dataset a sequential scan can be the best plan, so
+        # a hundred more years of every series are inserted, and analyzed, in a
+        # transaction that is rolled back.
+        catalog = QueryCatalog()
+        conn = psycopg2.connect(**DATABASE_PARAMS)
+
+        try:
+            catalog.prepare(conn)
+
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO tesouro_direto_series (category, action, expire_at, amount)
+                    SELECT category, action, make_timestamp(2100 + n / 12, n %% 12 + 1, 1, 0, 0, 0), 1000 + n
+                    FROM
+                        unnest(enum_range(NULL::category_type)) category,
+                        unnest(enum_range(NULL::action_type)) action,
+                        generate_series(0, %s - 1) n
+                """, (100 * 12,))
+                cur.execute('ANALYZE tesouro_direto_series')
+                cur.execute('ANALYZE tesouro_direto_yearly')
+
+                (start, end) = (datetime.datetime(2105, 3, 1), datetime.datetime(2110, 9, 1))
+                queries = {
+                    'read-history': (('LTN', start, end, None), 'tesouro_direto_series_month'),
+                    'read-history-grouped': (('LTN', start, end, None), 'tesouro_direto_series_month'),
+                    'read-by-action': (('VENDA', 'LTN', start, end, None), 'tesouro_direto_series_action_month')
+                }
+
+                # Prepared statements switch to a generic plan after a few
+                # executions, both must hold.
+                for plan_cache_mode in ('force_custom_plan', 'force_generic_plan'):
+                    cur.execute('SET LOCAL plan_cache_mode = {}'.format(plan_cache_mode))
+
+                    for (name, (params, index)) in queries.items():
+                        with self.subTest(name=name, plan_cache_mode=plan_cache_mode):
+                            plan = '\n'.join(catalog.explain(cur, name, params))
+
+                            self.assertNotIn('Seq Scan on tesouro_direto_series', plan)
+                            self.assertIn(index, plan)
+                            for join in ('Nested Loop', 'Hash Join', 'Merge Join'):
+                                self.assertNotIn(join, plan)
+        finally:
+            conn.rollback()
+            conn.close()
+
+    def test_stream_fails_before_the_response(self):
+        # The error of a query that does not start must reach the handler, not
+        # the middle of a response already sent as 200.
+        pool = ConnectionPool(DATABASE_PARAMS, max_size=1)
+        crud = TituloTesouroCRUD(pool, QueryCatalog())
+        (start, end) = (datetime.datetime(2010, 1, 1), datetime.datetime(2012, 12, 1))
+
+        try:
+            with self.assertRaises(psycopg2.DataError):
+                crud._iter_rows('read-history', ('XYZ', start, end, None))
+
+            rows = [row for chunk in crud._iter_rows('read-history', ('LTN', start, end, None)) for row in chunk]
+            self.assertEqual(len(rows), 36)
+            self.assertEqual(pool.stats()['in_use'], 0)
+        finally:
+            pool.close()
+
+    def test_series_engine_keeps_writes_made_during_a_load(self):
+        # The load is held right after its query, which does not see the row
+        # created meanwhile, as for a write committed after the query began.
+        catalog = QueryCatalog()
+        pool = ConnectionPool(DATABASE_PARAMS, max_size=2, on_connect=catalog.prepare)
+        (queried, resume) = (threading.Event(), threading.Event())
+
+        class HeldQueries(object):
+            def execute(self, cur, name, params=()):
+                catalog.execute(cur, name, params)
+                queried.set()
+                resume.wait(10)
+
+        engine = SeriesEngine(pool, HeldQueries())
+        titulo_id = 10 ** 6
+
+        try:
+            load = threading.Thread(target=engine.load)
+            load.start()
+            self.assertTrue(queried.wait(10))
+
+            create = threading.Thread(target=engine.created,
+                                      args=(titulo_id, 'LTN', 'VENDA', datetime.datetime(2030, 1, 1), 1.0))
+            create.start()
+            time.sleep(0.1)
+            resume.set()
+
+            load.join(10)
+            create.join(10)
+            self.assertEqual(engine.category(titulo_id), 'LTN')
+
+            generation = engine.generation
+            engine.updated(titulo_id + 1, None, 2.0, datetime.datetime(2030, 1, 1))
+            self.assertEqual(engine.generation, generation + 1)
+        finally:
+            resume.set()
+            pool.close()
+
+    def test_response_cache_skips_bodies_of_a_stale_engine(self):
+        # A change notified while the engine answers leaves the body possibly
+        # older than the version read before it: neither cached nor tagged.
+        catalog = QueryCatalog()
+        pool = ConnectionPool(DATABASE_PARAMS, max_size=2, on_connect=catalog.prepare)
+        engine = SeriesEngine(pool, catalog)
+        crud = TituloTesouroCRUD(pool, catalog, engine, response_cache=ResponseCache(10, 1024 * 1024))
+
+        app = falcon.API()
+        EndpointExpositor(app, crud).expose()
+        client = falcon.testing.TestClient(app)
+
+        read_history = engine.read_history
+        def notified_while_reading(*args):
+            crud.changed({'op': 'UPDATE', 'categoria_titulo': 'LTN'}, pid=-1)
+            return read_history(*args)
+
+        try:
+            engine.read_history = notified_while_reading
+            resp = client.simulate_get('/titulo_tesouro/5')
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn('ETag', resp.headers)
+            self.assertEqual(crud.response_cache.stats()['entries'], 0)
+
+            engine.read_history = read_history
+            resp = client.simulate_get('/titulo_tesouro/5')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('ETag', resp.headers)
+            self.assertEqual(crud.response_cache.stats()['entries'], 1)
+        finally:
+            pool.close()
+
+
 class TestTituloTesouroRequestHandler(TestRequestHandler):
 
+    def test_metrics(self):
+        requests.get('{}/1'.format(TestRequestHandler.BASE_URL))
+
+        resp = requests.get('http://localhost:8000/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('titulo_tesouro_request_duration_seconds_bucket', resp.text)
+        self.assertIn('route="/titulo_tesouro/{titulo_id}",status="404"', resp.text)
+        self.assertIn('titulo_tesouro_query_duration_seconds_count{query="get-version"}', resp.text)
+
+    def test_slow_queries(self):
+        resp = requests.get('http://localhost:8000/admin/consultas_lentas')
+
+        # Only exposed with SLOW_QUERY_ENDPOINT_ENABLED=true, which the tests
+        # expect to be set as for the server.
+        if not SLOW_QUERY_ENDPOINT_ENABLED:
+            self.assertEqual(resp.status_code, 404)
+            return
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(set(resp.json()['success']), {'pid', 'limite_ms', 'taxa_explain', 'consultas'})
+        self.assertIsInstance(resp.json()['success']['consultas'], list)
+
     def test_create_with_no_post_body(self):
         resp = requests.post(TestRequestHandler.BASE_URL)
 
@@ -329,6 +737,98 @@ class TestTituloTesouroRequestHandler(TestRequestHandler):
         self.assertIn('duplicate key value violates unique constraint "tesouro_direto_series_category_action_expire_at_key"',
             resp.json()['err'])
 
+    def test_create_batch_with_valid_post_body(self):
+        resp = requests.post(TestRequestHandler.BASE_URL,
+            data=json.dumps([{
+            'categoria_titulo': 'NTN-B',
+            'mês': 4,
+            'ano': 2017,
+            'ação': 'venda',
+            'valor': 15000
+        }, {
+            'categoria_titulo': 'NTN-B',
+            'mês': 4,
+            'ano': 2017,
+            'ação': 'resgate',
+            'valor': 1500.5
+        }]))
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json(), {
+            'success': [{
+                'id': 1,
+                'categoria_titulo': 'NTN-B',
+                'mês': 4,
+                'ano': 2017,
+                'ação': 'VENDA',
+                'valor': 15000.00,
+                'index': 0
+            }, {
+                'id': 2,
+                'categoria_titulo': 'NTN-B',
+                'mês': 4,
+                'ano': 2017,
+                'ação': 'RESGATE',
+                'valor': 1500.50,
+                'index': 1
+            }],
+            'err': []
+        })
+
+    def test_create_batch_with_invalid_record_aborts(self):
+        resp = requests.post(TestRequestHandler.BASE_URL,
+            data=json.dumps([{
+            'categoria_titulo': 'NTN-B',
+            'mês': 4,
+            'ano': 2017,
+            'ação': 'venda',
+            'valor': 15000
+        }, {
+            'categoria_titulo': 'NTN-B',
+            'mês': 13,
+            'ano': 2017,
+            'ação': 'venda',
+            'valor': 15000
+        }]))
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json(), {
+            'success': [],
+            'err': [{
+                'index': 1,
+                'err': '"month" must be in interval [1, 12].'
+            }]
+        })
+
+        resp = requests.delete('{}/1'.format(TestRequestHandler.BASE_URL))
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_create_batch_with_existing_record_skips(self):
+        record = {
+            'categoria_titulo': 'NTN-B',
+            'mês': 4,
+            'ano': 2017,
+            'ação': 'venda',
+            'valor': 15000
+        }
+
+        resp = requests.post(TestRequestHandler.BASE_URL, data=json.dumps(record))
+
+        self.assertEqual(resp.status_code, 201)
+
+        resp = requests.post(TestRequestHandler.BASE_URL, params={'on_error': 'skip'},
+            data=json.dumps([record, dict(record, mês=5)]))
+
+        self.assertEqual(resp.status_code, 207)
+        self.assertEqual(resp.json()['err'], [{
+            'index': 0,
+            'err': 'Record already exists.'
+        }])
+        self.assertEqual(len(resp.json()['success']), 1)
+        self.assertEqual(resp.json()['success'][0]['mês'], 5)
+        self.assertEqual(resp.json()['success'][0]['index'], 1)
+
     def test_delete_with_non_integer_id(self):
         resp = requests.delete('{}/three'.format(TestRequestHandler.BASE_URL))
 
@@ -350,6 +850,25 @@ class TestTituloTesouroRequestHandler(TestRequestHandler):
         self.assertIn('err', resp.json())
         self.assertEqual('"titulo_id" has no register.', resp.json()['err'])
 
+    def test_id_beyond_integer_range(self):
+        url = '{}/{}'.format(TestRequestHandler.BASE_URL, 2 ** 31)
+
+        for resp in (requests.get(url), requests.put(url, data=json.dumps({'valor': 10})), requests.delete(url)):
+            self.assertEqual(resp.status_code, 404)
+            self.assertIn('err', resp.json())
+
+    def test_id_beyond_bigint_range(self):
+        titulo_id = 10 ** 20
+        url = '{}/{}'.format(TestRequestHandler.BASE_URL, titulo_id)
+
+        for resp in (requests.get(url),
+                     requests.get('{}/venda/{}'.format(TestRequestHandler.BASE_URL, titulo_id)),
+                     requests.get('{}/comparar'.format(TestRequestHandler.BASE_URL), params={'ids': [titulo_id, 1]}),
+                     requests.put(url, data=json.dumps({'valor': 10})),
+                     requests.delete(url)):
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json()['err'], '"titulo_id" must be at most {}.'.format(2 ** 63 - 1))
+
     def test_delete_with_existing_id(self):
         resp = requests.post(TestRequestHandler.BASE_URL,
             data=json.dumps({
@@ -379,6 +898,74 @@ class TestTituloTesouroRequestHandler(TestRequestHandler):
             'success': 'Deleted.'
         })
 
+    def test_delete_many_by_ids(self):
+        resp = requests.post(TestRequestHandler.BASE_URL,
+            data=json.dumps([{
+            'categoria_titulo': 'NTN-B',
+            'mês': month,
+            'ano': 2017,
+            'ação': 'venda',
+            'valor': 666
+        } for month in (4, 5)]))
+
+        self.assertEqual(resp.status_code, 201)
+
+        resp = requests.delete(TestRequestHandler.BASE_URL,
+            data=json.dumps({
+            'ids': [1, 2, 7]
+        }))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {
+            'success': {
+                'afetados': 2,
+                'ids_nao_encontrados': [7]
+            }
+        })
+
+    def test_delete_many_by_filter_without_dates(self):
+        next_year = datetime.date.today().year + 1
+        resp = requests.post(TestRequestHandler.BASE_URL,
+            data=json.dumps([{
+            'categoria_titulo': 'NTN-B',
+            'mês': 5,
+            'ano': year,
+            'ação': 'venda',
+            'valor': 666
+        } for year in (2017, next_year)]))
+
+        self.assertEqual(resp.status_code, 201)
+
+        resp = requests.delete(TestRequestHandler.BASE_URL,
+            data=json.dumps({
+            'filtro': {
+                'categoria_titulo': 'NTN-B',
+                'data_fim': '2017-12'
+            }
+        }))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['success']['afetados'], 1)
+
+        resp = requests.delete(TestRequestHandler.BASE_URL,
+            data=json.dumps({
+            'filtro': {
+                'categoria_titulo': 'NTN-B'
+            }
+        }))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['success']['afetados'], 1)
+
+    def test_delete_many_without_selection(self):
+        resp = requests.delete(TestRequestHandler.BASE_URL,
+            data=json.dumps({
+            'filtro': {}
+        }))
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('err', resp.json())
+
     def test_update_with_no_body(self):
         resp = requests.put('{}/1'.format(TestRequestHandler.BASE_URL))
 
@@ -459,6 +1046,81 @@ class TestTituloTesouroRequestHandler(TestRequestHandler):
             }
         })
 
+    def test_update_many_by_filter(self):
+        resp = requests.post(TestRequestHandler.BASE_URL,
+            data=json.dumps([{
+            'categoria_titulo': category,
+            'mês': 5,
+            'ano': 2017,
+            'ação': 'venda',
+            'valor': 666
+        } for category in ('NTN-B', 'LTN')]))
+
+        self.assertEqual(resp.status_code, 201)
+
+        resp = requests.patch(TestRequestHandler.BASE_URL,
+            data=json.dumps({
+            'filtro': {
+                'categoria_titulo': 'NTN-B',
+                'data_inicio': '2017-01',
+                'data_fim': '2017-12'
+            },
+            'valor': 777
+        }))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {
+            'success': {
+                'afetados': 1,
+                'ids_nao_encontrados': []
+            }
+        })
+
+    def test_update_many_with_non_updatable_field(self):
+        resp = requests.patch(TestRequestHandler.BASE_URL,
+            data=json.dumps({
+            'ids': [1],
+            'mês': 6
+        }))
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('err', resp.json())
+
+    def test_read_with_if_none_match(self):
+        resp = requests.post(TestRequestHandler.BASE_URL,
+            data=json.dumps([{
+            'categoria_titulo': 'NTN-B',
+            'mês': 5,
+            'ano': 2017,
+            'ação': action,
+            'valor': 666
+        } for action in ('venda', 'resgate')]))
+
+        self.assertEqual(resp.status_code, 201)
+
+        resp = requests.get('{}/1'.format(TestRequestHandler.BASE_URL))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('ETag', resp.headers)
+        self.assertIn('Last-Modified', resp.headers)
+        etag = resp.headers['ETag']
+
+        resp = requests.get('{}/1'.format(TestRequestHandler.BASE_URL), headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 304)
+
+        resp = requests.put('{}/2'.format(TestRequestHandler.BASE_URL),
+            data=json.dumps({
+            'valor': 777
+        }))
+
+        self.assertEqual(resp.status_code, 200)
+
+        resp = requests.get('{}/1'.format(TestRequestHandler.BASE_URL), headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
     def test_update_categoria_titulo(self):
         resp = requests.post(TestRequestHandler.BASE_URL,
             data=json.dumps({
@@ -0,0 +1,51 @@
+import decimal
+import os
+import random
+import sys
+import unittest
+
+from babel.numbers import format_currency
+
+sys.path.insert(0, os.environ.get('PROJECT_ROOT_PATH'))
+
+from src.formatting import BRL, CurrencyFormatter
+
+
+class TestCurrencyFormatter(unittest.TestCase):
+
+    SAMPLES = 20000
+
+    def _values(self):
+        generator = random.Random(2018)
+
+        values = [0, 0.0, -0.0, 0.005, 0.015, 0.125, 2.675, -3.5, 1e15, 999999.995, 1234567.891,
+                  decimal.Decimal('0.005'), decimal.Decimal('-12.345'), decimal.Decimal('1234.5000')]
+        for _ in range(self.SAMPLES):
+            value = round(generator.uniform(-1e7, 1e7), generator.randint(0, 6))
+            values.append(value)
+            values.append(decimal.Decimal(str(value)))
+            values.append(generator.randint(0, 10 ** 9) / 1000)
+
+        return values
+
+    def test_default_locale_matches_babel(self):
+        values = self._values()
+
+        self.assertEqual(BRL.format_many(values), [format_currency(value, 'BRL') for value in values])
+
+    def test_other_locales_match_babel(self):
+        values = self._values()[:2000]
+
+        for locale in ('pt_BR', 'en_US', 'de_CH', 'fr_FR', 'hi_IN', 'ar_EG'):
+            formatter = CurrencyFormatter('BRL', locale)
+
+            self.assertEqual(formatter.format_many(values),
+                             [format_currency(value, 'BRL', locale=locale) for value in values], locale)
+
+    def test_non_finite_values_match_babel(self):
+        for value in (float('inf'), float('-inf'), decimal.Decimal('Infinity')):
+            self.assertEqual(BRL.format(value), format_currency(value, 'BRL'))
+
+
+if __name__ == '__main__':
+    unittest.main()
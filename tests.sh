@@ -9,3 +9,5 @@ echo "Tests for class TituloTesouroRequestHandler"
 python3 src/test_endpoints.py TestTituloTesouroRequestHandler
 echo "Tests for class TituloTesouroRefinedRequestHandler"
 python3 src/test_endpoints.py TestTituloTesouroRefinedRequestHandler
+echo "Tests for class CurrencyFormatter"
+python3 src/test_formatting.py